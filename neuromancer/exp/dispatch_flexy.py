@@ -55,6 +55,7 @@ for system in systems:
                                       '-gpu 0 ' + \
                                       '-lr 0.003 ' + \
                                       '-epochs 10000 ' + \
+                                      '-resume_every 100 ' + \
                                       '-location %s ' % args.results + \
                                       '-system_data %s ' % 'datafile' + \
                                       '-system %s ' % system + \
@@ -84,6 +85,7 @@ for system in systems:
                                   '-gpu 0 ' + \
                                   '-lr 0.003 ' + \
                                   '-epochs 10000 ' + \
+                                  '-resume_every 100 ' + \
                                   '-location %s ' % args.results + \
                                   '-system_data %s ' % 'datafile' + \
                                   '-system %s ' % system + \
@@ -0,0 +1,38 @@
+"""
+Flexy system identification grid of dispatch_flexy.py run in process on a single multi-core node.
+Datasets are loaded once per nsteps and shared by the worker processes, and successive halving
+stops poorly performing configurations after min_epochs, 3*min_epochs, ... epochs.
+
+python sweep_flexy.py -nprocs 32 -min_epochs 100
+"""
+import argparse
+
+from neuromancer.sweep import Sweep, grid
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-nprocs', type=int, help='Number of worker processes, defaults to the number of cores', default=None)
+parser.add_argument('-epochs', type=int, help='Epoch budget of a full run', default=10000)
+parser.add_argument('-min_epochs', type=int, help='Epochs of the first successive halving rung, 0 disables halving',
+                    default=100)
+parser.add_argument('-eta', type=int, help='Successive halving reduction factor', default=3)
+parser.add_argument('-nsamples', type=int, help='Number of samples for each experimental configuration',
+                    default=10)
+parser.add_argument('-results', type=str, help='Where to save runs and results.json', default='sweep_flexy')
+
+args = parser.parse_args()
+
+constrained = {'unconstr': {'Q_con_x': 0.0, 'Q_con_fdu': 0.0, 'Q_dx': 0.0, 'Q_sub': 0.0},
+               'constr': {'Q_con_x': 0.2, 'Q_con_fdu': 0.2, 'Q_dx': 0.2, 'Q_sub': 0.2}}
+configs = [{**config, **weights} for weights in constrained.values()
+           for config in grid(ssm_type=['blocknlin', 'blackbox'],
+                              linear_map=['linear', 'pf', 'softSVD'],
+                              nonlinear_map=['mlp', 'residual_mlp', 'rnn'],
+                              nsteps=[1, 8, 16, 32, 64])]
+
+base = {'system': 'flexy_air', 'lr': 0.003, 'epochs': args.epochs, 'nx_hidden': 10, 'bias': True,
+        'logger': 'stdout', 'verbosity': args.epochs, 'data_plots': 'off'}
+
+results = Sweep('neuromancer.train_scripts.system_id', configs, base=base, savedir=args.results,
+                nsamples=args.nsamples, nprocs=args.nprocs, min_epochs=args.min_epochs or None, eta=args.eta).run()
+for r in results[:10]:
+    print(r['config'], r['seed'], r['epochs'], r['best_devloss'])
@@ -0,0 +1,204 @@
+"""
+Best model checkpointing into preallocated buffers and resumable training state.
+
+"""
+# python base imports
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+# machine learning/data science imports
+import torch
+import numpy as np
+
+
+def shadow(state_dict):
+    """
+    Preallocated copy of a state dict which later snapshots are copied into.
+
+    :param state_dict: (dict {str: Tensor})
+    :return: (dict {str: Tensor}) Detached clones of the state dict tensors
+    """
+    return {k: v.detach().clone() for k, v in state_dict.items()}
+
+
+def copy_state(target, state_dict):
+    """
+    In place copy of a state dict into a shadow buffer.
+
+    :param target: (dict {str: Tensor}) Shadow buffer created by shadow
+    :param state_dict: (dict {str: Tensor}) State dict with the same keys and shapes
+    """
+    with torch.no_grad():
+        for k, v in state_dict.items():
+            target[k].copy_(v)
+
+
+def rng_state():
+    """
+    States of the python, numpy and torch random number generators in a form torch.load accepts with weights_only.
+
+    :return: (dict)
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state):
+    """
+    Restores random number generator states returned by rng_state.
+
+    :param state: (dict)
+    """
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    random.setstate(state['python'])
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    def __init__(self, model, ema_decay=None, savedir=None, every=None, resume_every=None):
+        """
+        Keeps the best weights of a model in a single preallocated shadow buffer so that improvements during training
+        cost a copy instead of an allocation of all parameters.
+
+        :param model: (nn.Module) Model to checkpoint
+        :param ema_decay: (float) Optional decay of an exponential moving average of the weights updated on each
+                          call to update_ema, e.g. after every optimizer step
+        :param savedir: (str) Optional folder to periodically write best.pth (and ema.pth) to for crash recovery
+        :param every: (int) Number of epochs between disk writes. Writes happen in a background thread from a
+                      separate preallocated buffer and are skipped while the previous write is still running.
+        :param resume_every: (int) Number of epochs between writes of the full training state to savedir/resume.pth.
+                             When set, training resumes automatically from an existing resume.pth,
+                             e.g. after a preempted cluster job is requeued or a sweep extends the epoch budget.
+        """
+        self.model = model
+        self.best = shadow(model.state_dict())
+        self.ema_decay = ema_decay
+        self.ema = shadow(model.state_dict()) if ema_decay is not None else None
+        self.savedir = savedir
+        self.every = every
+        self.resume_every = resume_every
+        self.write_buffers = None
+        self.executor = None
+        self.pending = None
+        if self.savedir is not None:
+            os.makedirs(self.savedir, exist_ok=True)
+
+    def save_best(self, model=None, member=None):
+        """
+        Copies the weights of model, by default the managed model, into the best buffer.
+
+        :param model: (nn.Module) Model with the same architecture as the managed one, e.g. a snapshot used for evaluation
+        :param member: (int) Only copy the slice of this member of an Ensemble, whose state is stacked along the first dimension
+        """
+        state_dict = (self.model if model is None else model).state_dict()
+        if member is not None:
+            state_dict = {k: v[member] for k, v in state_dict.items()}
+            copy_state({k: v[member] for k, v in self.best.items()}, state_dict)
+        else:
+            copy_state(self.best, state_dict)
+
+    def load_best(self, best, ema=None):
+        """
+        Copies restored best and moving average weights into the buffers.
+
+        :param best: (dict {str: Tensor})
+        :param ema: (dict {str: Tensor}) Ignored unless the manager keeps a moving average
+        """
+        copy_state(self.best, best)
+        if self.ema is not None and ema is not None:
+            copy_state(self.ema, ema)
+
+    def update_ema(self):
+        """
+        ema = decay*ema + (1 - decay)*weights for floating point entries, other entries are copied.
+        """
+        if self.ema is None:
+            return
+        with torch.no_grad():
+            for k, v in self.model.state_dict().items():
+                if torch.is_floating_point(v):
+                    self.ema[k].mul_(self.ema_decay).add_(v, alpha=1.0 - self.ema_decay)
+                else:
+                    self.ema[k].copy_(v)
+
+    def buffers(self):
+        """
+        :return: (dict {str: dict}) Checkpointed state dicts by file name
+        """
+        buffers = {'best.pth': self.best}
+        if self.ema is not None:
+            buffers['ema.pth'] = self.ema
+        return buffers
+
+    def periodic(self, epoch):
+        """
+        Writes the checkpointed buffers to savedir every self.every epochs without blocking training.
+
+        :param epoch: (int)
+        """
+        if self.savedir is None or self.every is None or epoch % self.every != 0:
+            return
+        if self.pending is not None and not self.pending.done():
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.write_buffers = {name: shadow(state) for name, state in self.buffers().items()}
+        for name, state in self.buffers().items():
+            copy_state(self.write_buffers[name], state)
+        self.pending = self.executor.submit(self.write, self.write_buffers)
+
+    @property
+    def resume_path(self):
+        return None if self.savedir is None or self.resume_every is None else os.path.join(self.savedir, 'resume.pth')
+
+    def save_resume(self, state, epoch, final=False, done=False):
+        """
+        Writes the training state every self.resume_every epochs and once training ends.
+        The state is written synchronously so that it is consistent with the optimizer.
+
+        :param state: (callable) Returns the training state as a dict of tensors and python primitives
+        :param epoch: (int) Last completed epoch
+        :param final: (bool) Whether training ended, the state is then written regardless of resume_every
+        :param done: (bool) Whether training stopped early, a resumed run then skips straight to evaluation.
+                     A run which used up its epochs continues when it is restarted with more epochs.
+        """
+        if self.resume_path is None or not (final or (epoch + 1) % self.resume_every == 0):
+            return
+        torch.save({**state(), 'epoch': epoch, 'done': done}, f'{self.resume_path}.tmp')
+        os.replace(f'{self.resume_path}.tmp', self.resume_path)
+
+    def load_resume(self):
+        """
+        :return: (dict) Training state written by save_resume or None if there is nothing to resume from
+        """
+        if self.resume_path is None or not os.path.exists(self.resume_path):
+            return None
+        return torch.load(self.resume_path, map_location='cpu')
+
+    def write(self, buffers=None):
+        """
+        Writes state dicts to savedir. Each file is written to a temporary path first and moved into place,
+        so a crash during a write never leaves a truncated checkpoint behind.
+
+        :param buffers: (dict {str: dict}) State dicts by file name, defaults to the checkpointed buffers
+        """
+        for name, state in (self.buffers() if buffers is None else buffers).items():
+            path = os.path.join(self.savedir, name)
+            torch.save(state, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+
+    def close(self):
+        """
+        Waits for a pending write and releases the writer thread.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.pending = None
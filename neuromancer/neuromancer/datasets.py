@@ -6,20 +6,21 @@ import os
 from typing import Dict
 import warnings
 import random
+import hashlib
+import json
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # machine learning/data science imports
 from scipy.io import loadmat
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import torch
 
 # ecosystem imports
 import psl as emulators
 
-# local imports
-import neuromancer.plot as plot
-
 
 def min_max_denorm(M, Mmin, Mmax):
     """
@@ -35,15 +36,22 @@ def min_max_denorm(M, Mmin, Mmax):
 
 def batch_mh_data(data, nsteps):
     """
-    moving horizon batching
+    moving horizon batching. Windows are a strided view of data so samples are not copied nsteps times.
+    Consecutive windows overlap in memory, every sample of data is shared by up to nsteps windows.
+    Numpy views are read-only, tensor views and tensors wrapping the numpy views with to_tensor are writable
+    aliases, so an in place write to one window changes the overlapping windows and data itself.
+    get_batch materializes the windows of a batch into contiguous memory.
 
-    :param data: np.array shape=(nsim, dim)
+    :param data: np.array or torch.Tensor shape=(nsim, dim)
     :param nsteps: (int) n-step prediction horizon
-    :return: np.array shape=(nsteps, nsamples, dim)
+    :return: np.array or torch.Tensor shape=(nsteps, nsamples, dim)
     """
     end_step = data.shape[0] - nsteps
-    data = np.asarray([data[k:k+nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-    return data.transpose(1, 0, 2)  # nsteps X nsamples X nfeatures
+    if isinstance(data, torch.Tensor):
+        data = data.unfold(0, nsteps, 1)[:end_step]  # nchunks X nfeatures X nsteps
+        return data.permute(2, 0, 1)  # nsteps X nsamples X nfeatures
+    data = np.lib.stride_tricks.sliding_window_view(data, nsteps, axis=0)[:end_step]  # nchunks X nfeatures X nsteps
+    return data.transpose(2, 0, 1)  # nsteps X nsamples X nfeatures
 
 
 def batch_data(data, nsteps):
@@ -80,10 +88,7 @@ def unbatch_mh_data(data):
     :param data: (torch.Tensor or np.array, shape=(nsteps, nsamples, dim)
     :return:  (torch.Tensor, shape=(nsim, 1, dim)
     """
-    data_unmove = np.asarray([data[0, k, :] for k in range(0, data.shape[1])])
-    if isinstance(data, torch.Tensor):
-        data_unmove = torch.Tensor(data_unmove)
-    return data_unmove.reshape(-1, 1, data_unmove.shape[-1])
+    return data[0].reshape(-1, 1, data.shape[-1])
 
 
 def unbatch_data(data):
@@ -99,6 +104,25 @@ def unbatch_data(data):
         return data.transpose(1, 0, 2).reshape(-1, 1, data.shape[-1])
 
 
+def to_tensor(data, device='cpu'):
+    """
+    Convert data to a float32 tensor on device. Float32 arrays are wrapped without a copy on the cpu
+    so strided moving horizon views from batch_mh_data stay views. The returned tensor is then a writable alias
+    of the read-only array and of the overlapping windows, it must not be modified in place.
+
+    :param data: (np.array or torch.Tensor)
+    :param device: (str) String identifier of device to place data on, e.g. 'cpu', 'cuda:0'
+    :return: (torch.Tensor)
+    """
+    if isinstance(data, torch.Tensor):
+        return data.float().to(device)
+    data = np.asarray(data, dtype=np.float32)
+    with warnings.catch_warnings():
+        # read-only views are never written to in place, batches are materialized by get_batch
+        warnings.filterwarnings('ignore', message='The given NumPy array is not writable', category=UserWarning)
+        return torch.from_numpy(data).to(device)
+
+
 class DataDict(dict):
     """
     So we can add a name property to the dataset dictionaries
@@ -106,6 +130,109 @@ class DataDict(dict):
     pass
 
 
+def nstep_samples(data):
+    """
+    Number of samples along the batch dimension of an nstep dataset.
+
+    :param data: (dict, str: 3-d np.array or torch.Tensor) dims=(nsteps, nsamples, dim)
+    :return: (int)
+    """
+    return list(data.values())[0].shape[1]
+
+
+def get_batch(data, idx, device='cpu'):
+    """
+    Select samples along the batch dimension of an nstep dataset and place them on device.
+    Arrays (including np.memmap arrays streamed from disk) are only read and converted for the selected samples.
+    Batches are contiguous copies, never aliases of the overlapping moving horizon windows of batch_mh_data,
+    so they can be modified in place.
+
+    :param data: (dict, str: 3-d np.array or torch.Tensor) dims=(nsteps, nsamples, dim)
+    :param idx: (slice or 1-d np.array) Indices of samples to select
+    :param device: (str) String identifier of device to place batch on, e.g. 'cpu', 'cuda:0'
+    :return: (DataDict, str: 3-d torch.Tensor) dims=(nsteps, len(idx), dim)
+    """
+    batch = DataDict()
+    for k, v in data.items():
+        if isinstance(v, torch.Tensor):
+            v = v[:, idx] if isinstance(idx, slice) else v[:, torch.as_tensor(idx, device=v.device)]
+            batch[k] = v.to(device).contiguous()
+        else:
+            batch[k] = torch.tensor(v[:, idx], dtype=torch.float32).to(device)
+    batch.name = data.name
+    return batch
+
+
+def batch_iterator(data, batch_size, shuffle=True, device='cpu'):
+    """
+    Iterate over mini-batches of an nstep dataset along the batch dimension.
+
+    :param data: (dict, str: 3-d np.array or torch.Tensor) dims=(nsteps, nsamples, dim)
+    :param batch_size: (int) Number of samples per mini-batch. The last mini-batch may be smaller.
+    :param shuffle: (bool) Whether to randomly permute samples before batching
+    :param device: (str) String identifier of device to place batches on
+    :return: generator of (DataDict, str: 3-d torch.Tensor) dims=(nsteps, batch_size, dim)
+    """
+    nsamples = nstep_samples(data)
+    order = np.random.permutation(nsamples) if shuffle else np.arange(nsamples)
+    for start in range(0, nsamples, batch_size):
+        # sorted indices give contiguous reads for arrays memory mapped from disk
+        yield get_batch(data, np.sort(order[start:start + batch_size]), device=device)
+
+
+def memmap_data(data, path):
+    """
+    Write an nstep dataset to .npy files and reopen them as read-only memory maps.
+
+    :param data: (dict, str: 3-d np.array or torch.Tensor) dims=(nsteps, nsamples, dim)
+    :param path: (str) Directory to write arrays to
+    :return: (DataDict, str: np.memmap) Memory mapped arrays with the same name as data
+    """
+    os.makedirs(path, exist_ok=True)
+    mapped = DataDict()
+    for k, v in data.items():
+        if isinstance(v, torch.Tensor):
+            v = v.detach().cpu().numpy()
+        filename = os.path.join(path, f'{k}.npy')
+        np.save(filename, np.asarray(v, dtype=np.float32))
+        mapped[k] = np.load(filename, mmap_mode='r')
+    mapped.name = data.name
+    return mapped
+
+
+plot_policies = ['eager', 'background', 'manual', 'off']
+plot_executor = None
+
+
+def save_traj_plot(data, figname):
+    """
+    Plot sequences with plot.plot_traj and write the figure to figname.
+    matplotlib is imported on the first call so runs that never plot do not load it.
+
+    :param data: (dict, str: 2-d np.array) Sequences to plot
+    :param figname: (str) Path of the image file
+    """
+    import matplotlib.pyplot as plt
+    import neuromancer.plot as plot
+    plot.plot_traj(data, figname=figname)
+    plt.close(plt.gcf())
+
+
+def submit_plot(data, figname):
+    """
+    Render a plot on the background plotting thread. A single thread is shared by all datasets
+    since pyplot is not thread safe.
+
+    :param data: (dict, str: 2-d np.array) Sequences to plot
+    :param figname: (str) Path of the image file
+    :return: (concurrent.futures.Future)
+    """
+    global plot_executor
+    if plot_executor is None:
+        plot_executor = ThreadPoolExecutor(max_workers=1)
+    return plot_executor.submit(save_traj_plot, data, figname)
+
+
 def normalize(M, Mmin=None, Mmax=None):
         """
         :param M: (2-d np.array) Data to be normalized
@@ -125,7 +252,7 @@ class Dataset:
 
     def __init__(self, system=None, nsim=10000, ninit=0, norm=['Y'], batch_type='batch',
                  nsteps=1, device='cpu', sequences=dict(), name='openloop',
-                 savedir='test'):
+                 savedir='test', cache=None, plot='eager'):
         """
 
         :param system: (str) Identifier for dataset.
@@ -138,6 +265,13 @@ class Dataset:
         :param sequences: (dict str: np.array) Dictionary of supplemental data
         :param name: (str) String identifier of dataset type, must be ['static', 'openloop', 'closedloop']
         :param savedir: (str) Where to save plots of dataset time sequences.
+        :param cache: (str) Optional directory of the preprocessed dataset cache. Normalized and shifted sequences
+                      are stored there as memory mapped .npy files under a key computed from the dataset
+                      configuration and source data, and reused by later instances with the same key.
+        :param plot: (str) Plotting policy for dataset time sequences, one of plot_policies.
+                     'eager' plots during construction, 'background' renders on a background thread
+                     (needs a non-interactive matplotlib backend such as Agg), 'manual' defers plots
+                     until save_plots is called and 'off' never plots.
 
          returns: Dataset Object with public properties:
                     train_data: dict(str: Tensor)
@@ -155,6 +289,10 @@ class Dataset:
         self.system, self.nsim, self.ninit, self.norm, self.nsteps, self.device = system, nsim, ninit, norm, nsteps, device
         self.batch_type = batch_type
         self.sequences = sequences
+        self.cache = cache
+        self.init_plots(plot)
+        if self.cache is not None and self.load_cache():
+            return
         self.data = self.load_data()
         self.data = {**self.data, **self.sequences}
         self.min_max_norms, self.dims, self.nstep_data, self.shift_data = dict(), dict(), dict(), dict()
@@ -166,6 +304,111 @@ class Dataset:
         self.data = self.norm_data(self.data, self.norm)
         self.train_data, self.dev_data, self.test_data = self.make_nstep()
         self.train_loop, self.dev_loop, self.test_loop = self.make_loop()
+        if self.cache is not None:
+            self.save_cache()
+
+    def init_plots(self, plot):
+        """
+        :param plot: (str) Plotting policy, one of plot_policies
+        """
+        assert plot in plot_policies, f'Plotting policy must be one of {plot_policies}'
+        self.plot = plot
+        self.pending_plots, self.plot_jobs = [], []
+
+    def queue_plot(self, data, figname):
+        """
+        Plot sequences according to the plotting policy of the dataset.
+
+        :param data: (dict, str: 2-d np.array) Sequences to plot
+        :param figname: (str) Path of the image file
+        """
+        if self.plot == 'eager':
+            save_traj_plot(data, figname)
+        elif self.plot == 'background':
+            self.plot_jobs.append(submit_plot(dict(data), figname))
+        elif self.plot == 'manual':
+            self.pending_plots.append((dict(data), figname))
+
+    def save_plots(self):
+        """
+        Render plots deferred by the 'manual' policy and wait for plots rendered in the background.
+        """
+        for data, figname in self.pending_plots:
+            save_traj_plot(data, figname)
+        for job in self.plot_jobs:
+            job.result()
+        self.pending_plots, self.plot_jobs = [], []
+
+    def source_fingerprint(self):
+        """
+        Description of the source data that is hashed into the cache key together with the dataset configuration.
+
+        :return: (str)
+        """
+        return f'{type(self).__name__}:{self.system}'
+
+    def cache_key(self):
+        """
+        Content address of the preprocessed dataset, combining the source data with system name, nsim, ninit,
+        norm, nsteps, batch type and the supplemental sequences.
+
+        :return: (str) Hex digest
+        """
+        config = [self.source_fingerprint(), self.nsim, self.ninit, sorted(self.norm), self.nsteps,
+                  self.batch_type, self.name]
+        digest = hashlib.sha1(json.dumps(config, default=str).encode())
+        for k in sorted(self.sequences):
+            v = np.ascontiguousarray(self.sequences[k])
+            digest.update(f'{k}{v.dtype}{v.shape}'.encode())
+            digest.update(v.tobytes())
+        return digest.hexdigest()
+
+    def save_cache(self):
+        """
+        Write normalized sequences, shifted sequences, min_max_norms and dims to the cache directory.
+        Files are written to a temporary directory first so concurrent runs never see a partial entry.
+        """
+        path = os.path.join(self.cache, self.cache_key())
+        if os.path.exists(path):
+            return
+        tmp = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        for prefix, arrays in [('data', self.data), ('shift', self.shift_data)]:
+            for k, v in arrays.items():
+                np.save(os.path.join(tmp, f'{prefix}_{k}.npy'), np.asarray(v))
+        np.savez(os.path.join(tmp, 'min_max_norms.npz'), **self.min_max_norms)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'data': list(self.data), 'shift': list(self.shift_data), 'dims': self.dims}, f)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # another process finished the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def load_cache(self):
+        """
+        Restore the dataset from the cache directory if an entry for cache_key exists.
+        Sequences are opened as copy-on-write memory maps and n-step samples are rebuilt from the shifted
+        sequences, which are views for both batch types.
+
+        :return: (bool) Whether the dataset was restored
+        """
+        path = os.path.join(self.cache, self.cache_key())
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return False
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.data = {k: np.load(os.path.join(path, f'data_{k}.npy'), mmap_mode='c') for k in meta['data']}
+        self.shift_data = {k: np.load(os.path.join(path, f'shift_{k}.npy'), mmap_mode='c') for k in meta['shift']}
+        self.dims = {k: tuple(v) if isinstance(v, list) else v for k, v in meta['dims'].items()}
+        with np.load(os.path.join(path, 'min_max_norms.npz')) as norms:
+            self.min_max_norms = {k: norms[k] for k in norms.files}
+        batch = batch_mh_data if self.batch_type == 'mh' else batch_data
+        self.nstep_data = {k: batch(v, self.nsteps) for k, v in self.shift_data.items()}
+        self.train_data, self.dev_data, self.test_data = self.split_train_test_dev(self.nstep_data)
+        self.train_data.name, self.dev_data.name, self.test_data.name = 'nstep_train', 'nstep_dev', 'nstep_test'
+        self.train_loop, self.dev_loop, self.test_loop = self.make_loop(visualize=False)
+        return True
 
     def norm_data(self, data, norm):
         """
@@ -196,8 +439,8 @@ class Dataset:
         for k, v in self.data.items():
             if k + 'p' not in self.shift_data or overwrite:
                 self.dims[k + 'p'], self.dims[k + 'f'] = v.shape, v.shape
-                self.shift_data[k + 'p'] = v[:-self.nsteps]
-                self.shift_data[k + 'f'] = v[self.nsteps:]
+                self.shift_data[k + 'p'] = v[:-self.nsteps].astype(np.float32)
+                self.shift_data[k + 'f'] = v[self.nsteps:].astype(np.float32)
 
                 if self.batch_type == 'mh':
                     self.nstep_data[k + 'p'] = batch_mh_data(self.shift_data[k + 'p'], self.nsteps)
@@ -205,19 +448,19 @@ class Dataset:
                 else:
                     self.nstep_data[k + 'p'] = batch_data(self.shift_data[k + 'p'], self.nsteps)
                     self.nstep_data[k + 'f'] = batch_data(self.shift_data[k + 'f'], self.nsteps)
-        plot.plot_traj(self.data, figname=os.path.join(self.savedir, f'{self.system}.png'))
-        plt.close('all')
+        self.queue_plot(self.data, os.path.join(self.savedir, f'{self.system}.png'))
         train_data, dev_data, test_data = self.split_train_test_dev(self.nstep_data)
         train_data.name, dev_data.name, test_data.name = 'nstep_train', 'nstep_dev', 'nstep_test'
         return train_data, dev_data, test_data
 
-    def make_loop(self):
+    def make_loop(self, visualize=True):
         """
         Unbatches data to original format with extra 1-dimension at the batch dimension.
         Length of sequences has been shortened to account for shift of data for sequence to sequence modeling.
         Length of sequences has been potentially shortened to be evenly divided by nsteps:
             nsim = (nsim - shift) - (nsim % nsteps)
 
+        :param visualize: (bool) Whether to plot the open loop sequences to savedir
         :return: train_loop (dict str: 3-way np.array} Dictionary with values of shape nsim % X 1 X dim
                  dev_loop  see train_data
                  test_loop  see train_data
@@ -237,8 +480,8 @@ class Dataset:
             for k in self.train_data.keys():
                 assert np.array_equal(all_loop[k], self.shift_data[k][:all_loop[k].shape[0]]), \
                     f'Reshaped data {k} is not equal to truncated original data'
-            plot.plot_traj(all_loop, figname=os.path.join(self.savedir, f'{self.system}_open.png'))
-            plt.close('all')
+            if visualize:
+                self.queue_plot(all_loop, os.path.join(self.savedir, f'{self.system}_open.png'))
 
         elif self.name == 'closedloop':
             nstep_data = dict()
@@ -250,7 +493,7 @@ class Dataset:
         train_loop.name, dev_loop.name, test_loop.name = 'loop_train', 'loop_dev', 'loop_test'
         for dset in train_loop, dev_loop, test_loop, self.train_data, self.dev_data, self.test_data:
             for k, v in dset.items():
-                dset[k] = torch.tensor(v, dtype=torch.float32).to(self.device)
+                dset[k] = to_tensor(v, self.device)
         return train_loop, dev_loop, test_loop
 
     def add_data(self, sequences, norm=[], overwrite=False):
@@ -272,6 +515,16 @@ class Dataset:
         self.train_data, self.dev_data, self.test_data = self.make_nstep(overwrite=overwrite)
         self.train_loop, self.dev_loop, self.test_loop = self.make_loop()
 
+    def stream_train_data(self, path=None):
+        """
+        Move the training set to memory mapped files on disk so mini-batches can be streamed
+        by the Trainer without holding the full training set in memory.
+
+        :param path: (str) Directory to write arrays to. Defaults to savedir/train_data
+        """
+        path = os.path.join(self.savedir, 'train_data') if path is None else path
+        self.train_data = memmap_data(self.train_data, path)
+
     def del_data(self, keys):
         """
         Delete a sequence from the dataset.
@@ -349,6 +602,17 @@ class Dataset:
 
 class FileDataset(Dataset):
 
+    def source_fingerprint(self):
+        """
+        Adds path, size and modification time of the data file so edited files invalidate cached entries.
+
+        :return: (str)
+        """
+        file_path = systems_datapaths.get(self.system, self.system)
+        stat = os.stat(file_path) if os.path.exists(file_path) else None
+        return f'{super().source_fingerprint()}:{os.path.abspath(file_path)}:' \
+               f'{stat and stat.st_size}:{stat and stat.st_mtime_ns}'
+
     def load_data(self):
         """
         Load data from files. system argument to init should be the name of a registered dataset in systems_datapaths
@@ -380,13 +644,232 @@ class FileDataset(Dataset):
         return data
 
 
+csv_columns = {'Y': 'y', 'U': 'u', 'D': 'd', 'exp_id': 'exp_id'}
+
+
+def ingest_csv(file_path, store, chunksize=1000000):
+    """
+    Convert a multi-experiment CSV log into a binary columnar store that can be memory mapped with ExperimentStore.
+    The file is read in chunks of rows and columns are grouped into Y, U, D and exp_id with the same regular
+    expressions as FileDataset.load_data. Per column minima and maxima and an index of contiguous experiment runs
+    are accumulated in the same pass. An existing store of the same, unmodified file is reused.
+
+    :param file_path: (str) Path to the CSV file
+    :param store: (str) Directory of the store
+    :param chunksize: (int) Number of rows read at once
+    :return: (ExperimentStore)
+    """
+    stat = os.stat(file_path)
+    source = [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+    meta_path = os.path.join(store, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)['source'] == source:
+                return ExperimentStore(store)
+        os.remove(meta_path)
+    os.makedirs(store, exist_ok=True)
+    header = list(pd.read_csv(file_path, nrows=0).columns)
+    columns = {k: [c for c in header if re.search(regex, c)] for k, regex in csv_columns.items()}
+    columns = {k: v for k, v in columns.items() if len(v) > 0}
+    files = {k: open(os.path.join(store, f'{k}.bin'), 'wb') for k in columns}
+    mins = {k: np.full(len(v), np.inf) for k, v in columns.items()}
+    maxs = {k: np.full(len(v), -np.inf) for k, v in columns.items()}
+    runs, nrows = [], 0
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        for k, cols in columns.items():
+            v = chunk[cols].to_numpy(dtype=np.float32)
+            files[k].write(v.tobytes())
+            mins[k], maxs[k] = np.minimum(mins[k], v.min(axis=0)), np.maximum(maxs[k], v.max(axis=0))
+        if 'exp_id' in columns:
+            ids = chunk[columns['exp_id'][0]].to_numpy(dtype=np.float32)
+            starts = np.flatnonzero(np.diff(ids, prepend=np.nan) != 0)
+            for start, stop in zip(starts, np.append(starts[1:], len(ids))):
+                if runs and start == 0 and runs[-1][0] == ids[0]:
+                    runs[-1][2] = nrows + int(stop)
+                else:
+                    runs.append([float(ids[start]), nrows + int(start), nrows + int(stop)])
+        nrows += len(chunk)
+    for f in files.values():
+        f.close()
+    meta = {'source': source, 'nrows': nrows, 'columns': columns, 'runs': runs,
+            'min': {k: v.tolist() for k, v in mins.items()}, 'max': {k: v.tolist() for k, v in maxs.items()}}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return ExperimentStore(store)
+
+
+class ExperimentStore:
+
+    def __init__(self, path):
+        """
+        Read-only view of a store written by ingest_csv.
+
+        :param path: (str) Directory of the store
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.nrows, self.columns, self.runs = meta['nrows'], meta['columns'], meta['runs']
+        self.data = {k: np.memmap(os.path.join(path, f'{k}.bin'), dtype=np.float32, mode='r',
+                                  shape=(self.nrows, len(v))) for k, v in self.columns.items()}
+        self.min = {k: np.array(v) for k, v in meta['min'].items()}
+        self.max = {k: np.array(v) for k, v in meta['max'].items()}
+
+    def min_max(self, key, rows=slice(None)):
+        """
+        :param key: (str) Sequence name
+        :param rows: (slice) Rows the statistics are computed over, stored statistics are used for all rows
+        :return: (2-tuple of np.array) Column minima and maxima
+        """
+        if rows.indices(self.nrows) == (0, self.nrows, 1):
+            return self.min[key], self.max[key]
+        v = self.data[key][rows]
+        step = max(1, 2 ** 24 // max(1, v.shape[1]))
+        mins = np.min([v[i:i + step].min(axis=0) for i in range(0, len(v), step)], axis=0)
+        maxs = np.max([v[i:i + step].max(axis=0) for i in range(0, len(v), step)], axis=0)
+        return mins, maxs
+
+    def experiment_runs(self, rows=slice(None)):
+        """
+        :param rows: (slice) Rows experiments are restricted to
+        :return: (dict, float: list of 2-tuples) Sorted experiment ids with their (start, stop) row ranges
+        """
+        start, stop, _ = rows.indices(self.nrows)
+        experiments = dict()
+        for exp_id, a, b in self.runs:
+            a, b = max(a, start), min(b, stop)
+            if a < b:
+                experiments.setdefault(exp_id, []).append((a, b))
+        return dict(sorted(experiments.items()))
+
+
+def experiment_windows(length, nsteps, batch_type='batch'):
+    """
+    :param length: (int) Number of rows of an experiment
+    :param nsteps: (int) n-step prediction horizon
+    :param batch_type: (str) 'batch' or 'mh'
+    :return: (2-tuple of int) Number of windows of the past and future sequences and the stride between them
+    """
+    length = length - nsteps
+    if batch_type == 'mh':
+        return max(length - nsteps, 0), 1
+    return max(length // nsteps, 0), nsteps
+
+
+def experiment_rows(ranges, positions):
+    """
+    Rows of a sequence at positions along the concatenation of row ranges.
+
+    :param ranges: (2-d np.array, shape=(nranges, 2)) (start, stop) row ranges in order of concatenation
+    :param positions: (np.array of int) Positions along the concatenated ranges
+    :return: (np.array of int) Row indices
+    """
+    offsets = np.concatenate([[0], np.cumsum(ranges[:, 1] - ranges[:, 0])])
+    r = np.searchsorted(offsets, positions, side='right') - 1
+    return ranges[r, 0] + positions - offsets[r]
+
+
+def read_rows(data, rows, vmin=None, vmax=None):
+    """
+    :param data: (2-d np.array or np.memmap) Unnormalized sequence
+    :param rows: (np.array of int) Sorted row indices
+    :param vmin: (np.array) Optional minima of a min-max normalization
+    :param vmax: (np.array) Optional maxima of a min-max normalization
+    :return: (np.array, dtype=np.float32) Selected rows, normalized in float32 if vmin and vmax are given
+    """
+    v = np.asarray(data[rows], dtype=np.float32)
+    if vmin is not None:
+        v, _, _ = normalize(v, np.asarray(vmin, dtype=np.float32), np.asarray(vmax, dtype=np.float32))
+    return v
+
+
+class ExperimentWindows:
+
+    def __init__(self, data, experiments, nsteps, shift=0, batch_type='batch', vmin=None, vmax=None):
+        """
+        nstep windows of a sequence over experiments given as row ranges, the samples batch_data or batch_mh_data
+        make of each experiment shifted by shift rows, concatenated along the batch dimension.
+        Only window start positions are kept, windows are read and normalized when a batch is indexed, e.g. by get_batch.
+
+        :param data: (2-d np.array or np.memmap) Unnormalized sequence
+        :param experiments: (list of list of 2-tuples) (start, stop) row ranges of data of every experiment
+        :param nsteps: (int) n-step prediction horizon
+        :param shift: (int) Offset of the windows, 0 for past and nsteps for future sequences
+        :param batch_type: (str) 'batch' for consecutive or 'mh' for moving horizon windows
+        :param vmin: (np.array) Optional minima of a min-max normalization
+        :param vmax: (np.array) Optional maxima of a min-max normalization
+        """
+        self.data, self.nsteps, self.vmin, self.vmax = data, nsteps, vmin, vmax
+        self.ranges = np.array([r for ranges in experiments for r in ranges], dtype=np.int64).reshape(-1, 2)
+        starts, position = [], 0
+        for ranges in experiments:
+            length = sum(b - a for a, b in ranges)
+            nwindows, stride = experiment_windows(length, nsteps, batch_type)
+            starts.append(position + shift + stride * np.arange(nwindows))
+            position += length
+        self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        self.shape = (nsteps, len(self.starts), data.shape[1])
+
+    def __getitem__(self, index):
+        """
+        :param index: (tuple) Steps and samples, e.g. [:, idx] as indexed by get_batch
+        :return: (np.array, dtype=np.float32) dims=(nsteps, nsamples, dim)
+        """
+        steps, samples = index
+        positions = np.reshape(self.starts[samples], (-1, 1)) + np.arange(self.nsteps)
+        windows = read_rows(self.data, experiment_rows(self.ranges, positions.ravel()), self.vmin, self.vmax)
+        return windows.reshape(*positions.shape, -1).transpose(1, 0, 2)[steps]
+
+
+class ExperimentLoops:
+
+    def __init__(self, sequences, experiments, nsteps, batch_type='batch', device='cpu', name=None):
+        """
+        Open loop sequences of experiments given as row ranges, as made by MultiExperimentDataset._make_loop.
+        An experiment is read and normalized when it is accessed.
+
+        :param sequences: (dict, str: 3-tuple) Unnormalized sequence with optional normalization minima and maxima
+        :param experiments: (list of list of 2-tuples) (start, stop) row ranges of every experiment
+        :param nsteps: (int) n-step prediction horizon
+        :param batch_type: (str) 'batch' or 'mh', see ExperimentWindows
+        :param device: (str) String identifier of device to place sequences on
+        :param name: (str) Name of the returned DataDicts
+        """
+        self.sequences, self.experiments = sequences, experiments
+        self.nsteps, self.batch_type, self.device, self.name = nsteps, batch_type, device, name
+
+    def __len__(self):
+        return len(self.experiments)
+
+    def __getitem__(self, i):
+        """
+        :param i: (int) Experiment index
+        :return: (DataDict, str: torch.Tensor) dims=(length, 1, dim)
+        """
+        ranges = np.array(self.experiments[i], dtype=np.int64).reshape(-1, 2)
+        nwindows, _ = experiment_windows(int((ranges[:, 1] - ranges[:, 0]).sum()), self.nsteps, self.batch_type)
+        # moving horizon windows unbatch to their first samples, consecutive windows to all of theirs
+        length = nwindows if self.batch_type == 'mh' else nwindows * self.nsteps
+        loop = DataDict()
+        for k, (data, vmin, vmax) in self.sequences.items():
+            for suffix, shift in [('p', 0), ('f', self.nsteps)]:
+                rows = experiment_rows(ranges, shift + np.arange(length))
+                loop[k + suffix] = to_tensor(read_rows(data, rows, vmin, vmax)[:, None], self.device)
+        loop.name = self.name
+        return loop
+
+
 class MultiExperimentDataset(FileDataset):
     def __init__(self, system='fsw_phase_2', nsim=10000000, ninit=0, norm=['Y'], batch_type='batch',
                  nsteps=1, device='cpu', sequences=dict(), name='openloop',
-                 savedir='test', split=[.5, .25]):
+                 savedir='test', split=[.5, .25], plot='eager', store=None):
         """
         :param split: (2-tuple of float) First index is proportion of experiments from train, second is proportion from dev,
                        leftover are for test set.
+        :param plot: (str) Plotting policy for dataset time sequences, see Dataset
+        :param store: (str) Optional directory of a binary store for CSV logs, see ingest_csv. The log is ingested
+                      in chunks once and sequences are memory mapped. Experiments are kept as row ranges of the store,
+                      nstep data are ExperimentWindows and loops ExperimentLoops, which read and normalize
+                      samples in float32 as they are used instead of loading the whole file.
 
          returns: Dataset Object with public properties:
                     train_data: dict(str: Tensor)
@@ -403,36 +886,66 @@ class MultiExperimentDataset(FileDataset):
         os.makedirs(self.savedir, exist_ok=True)
         self.system, self.nsim, self.ninit, self.norm, self.nsteps, self.device = system, nsim, ninit, norm, nsteps, device
         self.batch_type = batch_type
+        self.init_plots(plot)
         self.min_max_norms = dict()
-        self.data = self.load_data()
-        self.data = {**self.data, **sequences}
-        self.data = self.norm_data(self.data, self.norm)
-        plot.plot_traj(self.data, figname=os.path.join(self.savedir, f'{self.system}.png'))
-        plt.close('all')
+        self.store = store
+        if self.store is None:
+            self.data = self.load_data()
+            self.data = {**self.data, **sequences}
+            self.data = self.norm_data(self.data, self.norm)
+            self.queue_plot(self.data, os.path.join(self.savedir, f'{self.system}.png'))
+        else:
+            # memory mapped sequences stay unnormalized, experiments are normalized as they are read
+            self.data = self.load_store()
+            self.data = {**self.data, **self.norm_data(sequences, [k for k in self.norm if k not in self.data])}
         self.experiments = self.split_data_by_experiment()
-        self.nstep_data, self.loop_data = self.make_nstep_loop()
-        self.nstep_data, self.loop_data = self.to_tensor(self.nstep_data), self.to_tensor(self.loop_data)
-        self.split_train_test_dev(split)
-        self.train_data = self.listDict_to_dictTensor(self.train_data)
-        self.dev_data = self.listDict_to_dictTensor(self.dev_data)
-        self.test_data = self.listDict_to_dictTensor(self.test_data)
+        if self.store is None:
+            self.nstep_data, self.loop_data = self.make_nstep_loop()
+            self.nstep_data, self.loop_data = self.to_tensor(self.nstep_data), self.to_tensor(self.loop_data)
+            self.split_train_test_dev(split)
+            self.train_data = self.listDict_to_dictTensor(self.train_data)
+            self.dev_data = self.listDict_to_dictTensor(self.dev_data)
+            self.test_data = self.listDict_to_dictTensor(self.test_data)
+        else:
+            self.nstep_data = self.loop_data = self.experiments
+            self.split_train_test_dev(split)
+            self.train_data, self.train_loop = self.store_nstep_loop(self.train_data)
+            self.dev_data, self.dev_loop = self.store_nstep_loop(self.dev_data)
+            self.test_data, self.test_loop = self.store_nstep_loop(self.test_data)
         self.dims = self.get_dims()
         self.name_data()
 
+    def load_store(self):
+        """
+        Ingest the CSV file into the store if needed and compute normalization statistics for the rows in use.
+
+        :return: (dict, str: np.memmap) Unnormalized memory mapped sequences
+        """
+        file_path = systems_datapaths.get(self.system, self.system)
+        if not os.path.exists(file_path):
+            raise ValueError(f'No file at {file_path}')
+        self.experiment_store = ingest_csv(file_path, self.store)
+        rows = slice(self.ninit, self.nsim + self.ninit)
+        for k in self.norm:
+            if k in self.experiment_store.data:
+                vmin, vmax = self.experiment_store.min_max(k, rows)
+                self.min_max_norms.update({k + 'min': vmin, k + 'max': vmax})
+        return {k: v[rows] for k, v in self.experiment_store.data.items()}
+
     def listDict_to_dictTensor(self, ld):
         return DataDict([(k, torch.cat([dic[k] for dic in ld], dim=1)) for k in ld[0]])
 
     def split_train_test_dev(self, split):
         if type(split) is dict:
             # TODO fix this indexing hack for more general indexing outside of FSW context
-            self.train_data = np.array(self.nstep_data)[np.array(split['train']) - 1]
-            self.train_loop = np.array(self.loop_data)[np.array(split['train']) - 1]
+            self.train_data = [self.nstep_data[i - 1] for i in split['train']]
+            self.train_loop = [self.loop_data[i - 1] for i in split['train']]
 
-            self.dev_data = np.array(self.nstep_data)[np.array(split['dev']) - 1]
-            self.dev_loop = np.array(self.loop_data)[np.array(split['dev']) - 1]
+            self.dev_data = [self.nstep_data[i - 1] for i in split['dev']]
+            self.dev_loop = [self.loop_data[i - 1] for i in split['dev']]
 
-            self.test_data = np.array(self.nstep_data)[np.array(split['test']) - 1]
-            self.test_loop = np.array(self.loop_data)[np.array(split['test']) - 1]
+            self.test_data = [self.nstep_data[i - 1] for i in split['test']]
+            self.test_loop = [self.loop_data[i - 1] for i in split['test']]
 
         elif type(split) is list:
             num_exp = len(self.nstep_data)
@@ -465,6 +978,8 @@ class MultiExperimentDataset(FileDataset):
         return self.dims
 
     def split_data_by_experiment(self):
+        if self.store is not None:
+            return self.split_store_by_experiment()
         exp_ids = self.data['exp_id']
         experiments = []
         for id in np.unique(exp_ids):
@@ -473,10 +988,38 @@ class MultiExperimentDataset(FileDataset):
                 experiments[-1][k] = self.data[k][self.data['exp_id'].squeeze() == id]
         return experiments
 
+    def split_store_by_experiment(self):
+        """
+        Experiments of the memory mapped store from its index of contiguous runs, no samples are read.
+
+        :return: (list of list of 2-tuples) (start, stop) row ranges of self.data of every experiment
+        """
+        runs = self.experiment_store.experiment_runs(slice(self.ninit, self.nsim + self.ninit))
+        return [[(a - self.ninit, b - self.ninit) for a, b in ranges] for ranges in runs.values()]
+
+    def store_nstep_loop(self, experiments):
+        """
+        :param experiments: (list of list of 2-tuples) Row ranges of the experiments of a split
+        :return: (2-tuple) nstep data (DataDict, str: ExperimentWindows) and loops (ExperimentLoops) of the split,
+                 normalized with the statistics of the full sequences as they are read
+        """
+        sequences = dict()
+        for k, v in self.data.items():
+            if k in self.norm and k in self.experiment_store.data:
+                sequences[k] = (v, self.min_max_norms[k + 'min'], self.min_max_norms[k + 'max'])
+            else:
+                sequences[k] = (v, None, None)
+        nstep_data = DataDict()
+        for k, (v, vmin, vmax) in sequences.items():
+            for suffix, shift in [('p', 0), ('f', self.nsteps)]:
+                nstep_data[k + suffix] = ExperimentWindows(v, experiments, self.nsteps, shift=shift,
+                                                           batch_type=self.batch_type, vmin=vmin, vmax=vmax)
+        return nstep_data, ExperimentLoops(sequences, experiments, self.nsteps, self.batch_type, device=self.device)
+
     def to_tensor(self, data):
         for i in range(len(data)):
             for k, v in data[i].items():
-                data[i][k] = torch.tensor(v, dtype=torch.float32).to(self.device)
+                data[i][k] = to_tensor(v, self.device)
         return data
 
     def make_nstep_loop(self):
@@ -499,8 +1042,8 @@ class MultiExperimentDataset(FileDataset):
         nstep_data = dict()
         for k, v in data.items():
 
-            shift_data[k + 'p'] = v[:-self.nsteps]
-            shift_data[k + 'f'] = v[self.nsteps:]
+            shift_data[k + 'p'] = v[:-self.nsteps].astype(np.float32)
+            shift_data[k + 'f'] = v[self.nsteps:].astype(np.float32)
             if self.batch_type == 'mh':
                 nstep_data[k + 'p'] = batch_mh_data(shift_data[k + 'p'], self.nsteps)
                 nstep_data[k + 'f'] = batch_mh_data(shift_data[k + 'f'], self.nsteps)
@@ -529,8 +1072,7 @@ class MultiExperimentDataset(FileDataset):
             for k in loop.keys():
                 assert np.array_equal(loop[k].squeeze(1), shift_data[k][:loop[k].shape[0]]), \
                     f'Reshaped data {k} is not equal to truncated original data'
-            plot.plot_traj({k: v.squeeze(1) for k, v in loop.items()}, figname=os.path.join(self.savedir, f'{self.system}_open.png'))
-            plt.close('all')
+            self.queue_plot({k: v.squeeze(1) for k, v in loop.items()}, os.path.join(self.savedir, f'{self.system}_open.png'))
 
         return loop
 
@@ -539,30 +1081,57 @@ class MultiExperimentDataset(FileDataset):
             dset.name = name
 
         for dset, name in zip([self.train_loop, self.dev_loop, self.test_loop], ['loop_train', 'loop_dev', 'loop_test']):
-            for d in dset:
-                d.name = name
+            if isinstance(dset, ExperimentLoops):
+                dset.name = name
+            else:
+                for d in dset:
+                    d.name = name
 
 
 class EmulatorDataset(Dataset):
 
+    def __init__(self, system=None, nsim=10000, ninit=0, norm=['Y'], batch_type='batch',
+                 nsteps=1, device='cpu', sequences=dict(), name='openloop',
+                 savedir='test', cache=None, plot='eager', seed=None):
+        """
+        :param seed: (int) Random seed of the emulator, None keeps the emulator default.
+                     Part of the cache key, so differently seeded simulations are cached separately.
+
+        See Dataset for the remaining arguments.
+        """
+        self.seed = seed
+        super().__init__(system=system, nsim=nsim, ninit=ninit, norm=norm, batch_type=batch_type,
+                         nsteps=nsteps, device=device, sequences=sequences, name=name,
+                         savedir=savedir, cache=cache, plot=plot)
+
+    def source_fingerprint(self):
+        """
+        Adds the emulator seed, the simulated trajectories depend on it.
+
+        :return: (str)
+        """
+        return f'{super().source_fingerprint()}:seed={self.seed}'
+
     def load_data(self):
         """
         dataset creation from the emulator. system argument to init should be the name of a registered emulator
         return: (dict, str: 2-d np.array)
         """
         systems = emulators.systems  # list of available emulators
-        model = systems[self.system](nsim=self.nsim, ninit=self.ninit)  # instantiate model class
+        kwargs = dict() if self.seed is None else {'seed': self.seed}
+        model = systems[self.system](nsim=self.nsim, ninit=self.ninit, **kwargs)  # instantiate model class
         return model.simulate()  # simulate open loop
 
 
 class MultiExperimentEmulatorDataset(MultiExperimentDataset):
     def __init__(self, system='LorenzSystem', nsim=20, ninit=0, norm=['Y', 'X'], batch_type='batch',
                  nsteps=1, device='cpu', sequences=dict(), name='openloop',
-                 savedir='test', split=[.5, .25], nexp=5):
+                 savedir='test', split=[.5, .25], nexp=5, plot='eager'):
         """
         :param split: (2-tuple of float) First index is proportion of experiments from train, second is proportion from dev,
                        leftover are for test set.
         :param sequences: List of (dict str: np.array) List of dictionaries of supplemental data. Should be nexp long.
+        :param plot: (str) Plotting policy for dataset time sequences, see Dataset
 
          returns: Dataset Object with public properties:
                     train_data: dict(str: Tensor)
@@ -578,7 +1147,7 @@ class MultiExperimentEmulatorDataset(MultiExperimentDataset):
 
         super().__init__(system=system, nsim=nsim, ninit=ninit, norm=norm, batch_type=batch_type,
                          nsteps=nsteps, device=device, sequences=sequences, name=name,
-                         savedir=savedir, split=split)
+                         savedir=savedir, split=split, plot=plot)
 
     def _load_data(self, x0=None, nsim=None):
 
@@ -602,11 +1171,17 @@ class MultiExperimentEmulatorDataset(MultiExperimentDataset):
         experiments = []
         initial_data = self._load_data()
         _ = self.norm_data(initial_data, self.norm)
-        for i in range(self.nexp):
-            x0 = np.array([random.uniform(self.min_max_norms['Xmin'][j], self.min_max_norms['Xmax'][j])
-                           for j in range(self.min_max_norms['Xmin'].shape[0])])
-            experiments.append({**self._load_data(x0=x0, nsim=self.nsim//self.nexp),
-                                'exp_id': i*np.ones([self.nsim//self.nexp, 1])})
+        x0s = [np.array([random.uniform(self.min_max_norms['Xmin'][j], self.min_max_norms['Xmax'][j])
+                         for j in range(self.min_max_norms['Xmin'].shape[0])]) for i in range(self.nexp)]
+        model = emulators.systems[self.system](nsim=self.nsim//self.nexp, ninit=self.ninit)
+        if hasattr(model, 'simulate_batch'):
+            # all experiments integrated at once, sliced back to one dict per experiment
+            batch = model.simulate_batch(x0=np.stack(x0s), nsim=self.nsim//self.nexp)
+            data = [{k: v[:, i] for k, v in batch.items()} for i in range(self.nexp)]
+        else:
+            data = [self._load_data(x0=x0, nsim=self.nsim//self.nexp) for x0 in x0s]
+        for i, d in enumerate(data):
+            experiments.append({**d, 'exp_id': i*np.ones([self.nsim//self.nexp, 1])})
         return self.merge_data(experiments)
 
 
@@ -637,7 +1212,7 @@ class DatasetMPP(Dataset):
         self.train_data.name, self.dev_data.name, self.test_data.name = 'train', 'dev', 'test'
         for dset in self.train_data, self.dev_data, self.test_data:
             for k, v in dset.items():
-                dset[k] = torch.tensor(v, dtype=torch.float32).to(self.device)
+                dset[k] = to_tensor(v, self.device)
 
 
 resource_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datasets')
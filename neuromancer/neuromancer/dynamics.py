@@ -30,6 +30,103 @@ import slim
 import neuromancer.blocks as blocks
 
 
+def batch_map(f, sequence):
+    """
+    Apply a single time step map to every step of a sequence with one batched call.
+
+    :param f: (nn.Module) Map taking inputs of shape (nsamples, dim)
+    :param sequence: (torch.Tensor, shape=(nsteps, nsamples, dim))
+    :return: (torch.Tensor, shape=(nsteps, nsamples, f.out_features))
+    """
+    nsteps, nsamples = sequence.shape[:2]
+    return f(sequence.reshape(nsteps * nsamples, -1)).reshape(nsteps, nsamples, -1)
+
+
+class StateBuffer:
+    """
+    Output buffer for a rollout over nsteps. Without autograd steps are written into a tensor preallocated
+    at the first write. With autograd steps are stacked once at the end as copying into slices of a
+    preallocated tensor makes the backward pass copy the full gradient buffer at every step.
+    """
+    def __init__(self, nsteps):
+        self.nsteps = nsteps
+        self.steps, self.buffer = [], None
+
+    def __setitem__(self, i, value):
+        if torch.is_grad_enabled() and value.requires_grad:
+            self.steps.append(value)
+        else:
+            if self.buffer is None:
+                self.buffer = value.new_empty(self.nsteps, *value.shape)
+            self.buffer[i] = value
+
+    def tensor(self):
+        """
+
+        :return: (torch.Tensor, shape=(nsteps, nsamples, dim)) or None if nothing was written
+        """
+        if self.steps:
+            return torch.stack(self.steps)
+        return self.buffer
+
+
+def delayed_features(past, future, timedelay, nsteps):
+    """
+    Time delayed features [s_k-T, ..., s_k] of a sequence for every step k of the prediction horizon
+    computed with a single unfold instead of concatenating windows at every step.
+
+    :param past: (torch.Tensor, shape=(npast, nsamples, dim)) Past sequence, e.g. Up
+    :param future: (torch.Tensor, shape=(nsteps, nsamples, dim)) Future sequence, e.g. Uf
+    :param timedelay: (int) Number of time delays T
+    :param nsteps: (int) Prediction horizon
+    :return: (torch.Tensor, shape=(nsteps, nsamples, (T+1)*dim))
+    """
+    sequence = torch.cat([past[past.shape[0] - timedelay:], future[:nsteps]])  # shape=(T+nsteps, bs, dim)
+    windows = sequence.unfold(0, timedelay + 1, 1)  # shape=(nsteps, bs, dim, T+1)
+    return windows.transpose(2, 3).reshape(nsteps, sequence.shape[1], -1)
+
+
+class DelayLine:
+    """
+    Circular buffer of the last T+1 states of a time delayed model. Pushing a new state overwrites
+    the oldest one so the delayed state is assembled with a single concatenation per step.
+    """
+    def __init__(self, Xtd):
+        """
+
+        :param Xtd: (torch.Tensor, shape=(T+1, nsamples, nx)) Initial delayed states ordered oldest to newest
+        """
+        self.states = list(Xtd.unbind(0))
+        self.ptr = 0
+
+    def push(self, x):
+        self.states[self.ptr] = x
+        self.ptr = (self.ptr + 1) % len(self.states)
+
+    def newest(self):
+        return self.states[self.ptr - 1]
+
+    def delayed(self):
+        """
+
+        :return: (torch.Tensor, shape=(nsamples, (T+1)*nx)) Delayed states ordered oldest to newest
+        """
+        return torch.cat(self.states[self.ptr:] + self.states[:self.ptr], dim=-1)
+
+
+def compile_rollout(model, **kwargs):
+    """
+    Compile the state recurrence of a BlockSSM or BlackSSM with torch.compile where available.
+
+    :param model: (BlockSSM or BlackSSM)
+    :param kwargs: Keyword arguments passed to torch.compile
+    :return: (BlockSSM or BlackSSM) The same model with a compiled rollout method
+    """
+    if hasattr(torch, 'compile'):
+        model.rollout = torch.compile(model.rollout, **kwargs)
+    return model
+
+
 class BlockSSM(nn.Module):
     def __init__(self, fx, fy, fu=None, fd=None, fe=None,
                  xou=torch.add, xod=torch.add, xoe=torch.add, residual=False, name='block_ssm',
@@ -83,6 +180,7 @@ class BlockSSM(nn.Module):
         new_keys = {**default_keys, **input_keys}
         return [new_keys['x0'], new_keys['Yf'], new_keys['Uf'], new_keys['Df']]
 
+    @slim.cached()
     def forward(self, data):
         """
 
@@ -91,37 +189,50 @@ class BlockSSM(nn.Module):
         """
         x_in, y_out, u_in, d_in = self.input_keys
         nsteps = data[y_out].shape[0]
-        X, Y, FD, FU, FE = [], [], [], [], []
+        # input and disturbance maps do not depend on the state so are evaluated for the whole horizon at once
+        FU = batch_map(self.fu, data[u_in][:nsteps]) if self.fu is not None else None
+        FD = batch_map(self.fd, data[d_in][:nsteps]) if self.fd is not None else None
+        X, FE = self.rollout(data[x_in], FU, FD, nsteps)
+        Y = batch_map(self.fy, X)
+
+        output = dict()
+        for tensor, name in zip([X, Y, FU, FD, FE],
+                                ['X_pred', 'Y_pred', 'fU', 'fD', 'fE']):
+            if tensor is not None:
+                output[f'{name}_{self.name}'] = tensor
+        output[f'reg_error_{self.name}'] = self.reg_error()
+        return output
 
-        x = data[x_in]
+    def rollout(self, x, FU, FD, nsteps: int):
+        """
+        State recurrence over the prediction horizon writing states into a preallocated buffer.
+
+        :param x: (torch.Tensor, shape=(nsamples, nx)) Initial state
+        :param FU: (torch.Tensor, shape=(nsteps, nsamples, nx)) Input map evaluated over the horizon or None
+        :param FD: (torch.Tensor, shape=(nsteps, nsamples, nx)) Disturbance map evaluated over the horizon or None
+        :param nsteps: (int) Prediction horizon
+        :return: X (torch.Tensor, shape=(nsteps, nsamples, nx)) States,
+                 FE (torch.Tensor, shape=(nsteps, nsamples, nx)) Error terms or None
+        """
+        X, FE = StateBuffer(nsteps), StateBuffer(nsteps)
+        # unbind once so the backward pass does not scatter into a full size gradient at every step
+        FU = FU.unbind(0) if FU is not None else None
+        FD = FD.unbind(0) if FD is not None else None
         for i in range(nsteps):
             x_prev = x
             x = self.fx(x)
-            if self.fu is not None:
-                fu = self.fu(data[u_in][i])
-                x = self.xou(x, fu)
-                FU.append(fu)
-            if self.fd is not None:
-                fd = self.fd(data[d_in][i])
-                x = self.xod(x, fd)
-                FD.append(fd)
+            if FU is not None:
+                x = self.xou(x, FU[i])
+            if FD is not None:
+                x = self.xod(x, FD[i])
             if self.fe is not None:
                 fe = self.fe(x)
                 x = self.xoe(x, fe)
-                FE.append(fe)
+                FE[i] = fe
             if self.residual:
-                x += x_prev
-            y = self.fy(x)
-            X.append(x)
-            Y.append(y)
-
-        output = dict()
-        for tensor_list, name in zip([X, Y, FU, FD, FE],
-                                     ['X_pred', 'Y_pred', 'fU', 'fD', 'fE']):
-            if tensor_list:
-                output[f'{name}_{self.name}'] = torch.stack(tensor_list)
-        output[f'reg_error_{self.name}'] = self.reg_error()
-        return output
+                x = x + x_prev
+            X[i] = x
+        return X.tensor(), FE.tensor()
 
     def check_features(self):
         self.nx, self.ny = self.fx.in_features, self.fy.out_features
@@ -163,35 +274,49 @@ class BlackSSM(nn.Module):
         self.out_features = self.fy.out_features
         # self.check_features()                     # TODO: this should be included
 
+    @slim.cached()
     def forward(self, data):
         """
         """
         x_in, y_out, u_in, d_in = self.input_keys
         nsteps = data[y_out].shape[0]
-        X, Y, FE = [], [], []
+        # Concatenate u and d if they are available in the dataset once for the whole horizon.
+        inputs = [data[k][:nsteps] for k in [u_in, d_in] if k in data]
+        UD = torch.cat(inputs, dim=-1) if inputs else data[x_in].new_empty(nsteps, data[x_in].shape[0], 0)
+        X, FE = self.rollout(data[x_in], UD)
+        Y = batch_map(self.fy, X)
 
-        x = data[x_in]
+        output = dict()
+        for tensor, name in zip([X, Y, FE],
+                                ['X_pred', 'Y_pred', 'fE']):
+            if tensor is not None:
+                output[f'{name}_{self.name}'] = tensor
+        output[f'reg_error_{self.name}'] = self.reg_error()
+        return output
+
+    def rollout(self, x, UD):
+        """
+        State recurrence over the prediction horizon writing states into a preallocated buffer.
+
+        :param x: (torch.Tensor, shape=(nsamples, nx)) Initial state
+        :param UD: (torch.Tensor, shape=(nsteps, nsamples, nu+nd)) Concatenated inputs and disturbances
+        :return: X (torch.Tensor, shape=(nsteps, nsamples, nx)) States,
+                 FE (torch.Tensor, shape=(nsteps, nsamples, nx)) Error terms or None
+        """
+        nsteps = UD.shape[0]
+        X, FE = StateBuffer(nsteps), StateBuffer(nsteps)
+        UD = UD.unbind(0)
         for i in range(nsteps):
             x_prev = x
-            # Concatenate x with u and d if they are available in the dataset.
-            x = torch.cat([x] + [data[k][i] for k in [u_in, d_in] if k in data], dim=1)
-            x = self.fxud(x)
+            x = self.fxud(torch.cat([x, UD[i]], dim=1))
             if self.fe is not None:
                 fe = self.fe(x)
                 x = self.xoe(x, fe)
-                FE.append(fe)
+                FE[i] = fe
             if self.residual:
-                x += x_prev
-            y = self.fy(x)
-            X.append(x)
-            Y.append(y)
-        output = dict()
-        for tensor_list, name in zip([X, Y, FE],
-                                     ['X_pred', 'Y_pred', 'fE']):
-            if tensor_list:
-                output[f'{name}_{self.name}'] = torch.stack(tensor_list)
-        output[f'reg_error_{self.name}'] = self.reg_error()
-        return output
+                x = x + x_prev
+            X[i] = x
+        return X.tensor(), FE.tensor()
 
     def reg_error(self):
         """
@@ -245,6 +370,7 @@ class TimeDelayBlockSSM(BlockSSM):
         self.check_features()
         self.timedelay = timedelay
 
+    @slim.cached()
     def forward(self, data):
         """
 
@@ -253,44 +379,38 @@ class TimeDelayBlockSSM(BlockSSM):
         """
         x_in, y_out, u_in_f, u_in_p, d_in_f, d_in_p = self.input_keys
         nsteps = data[y_out].shape[0]
-        X, Y, FD, FU, FE = [], [], [], [], []
-
-        if u_in_f in data and u_in_p in data:
-            Utd = torch.cat([data[u_in_p][-self.timedelay:], data[u_in_f]])  # shape=(T+nsteps, bs, nu)
-        if d_in_f in data and d_in_p in data:
-            Dtd = torch.cat([data[d_in_p][-self.timedelay:], data[d_in_f]])  # shape=(T+nsteps, bs, nd)
-        Xtd = data[x_in]                                                     # shape=(T+1, bs, nx)
+        # delayed inputs and disturbances do not depend on the state so their maps are evaluated for the whole horizon
+        FU = batch_map(self.fu, delayed_features(data[u_in_p], data[u_in_f], self.timedelay, nsteps)) \
+            if self.fu is not None else None
+        FD = batch_map(self.fd, delayed_features(data[d_in_p], data[d_in_f], self.timedelay, nsteps)) \
+            if self.fd is not None else None
+        FU_steps = FU.unbind(0) if FU is not None else None
+        FD_steps = FD.unbind(0) if FD is not None else None
+        X, Y, FE = StateBuffer(nsteps), StateBuffer(nsteps), StateBuffer(nsteps)
+
+        Xtd = DelayLine(data[x_in])                                          # shape=(T+1, bs, nx)
         for i in range(nsteps):
-            x_prev = Xtd[-1]
-            x_delayed = torch.cat([Xtd[k, :, :] for k in range(Xtd.shape[0])], dim=-1)  # shape=(bs, T*nx)
+            x_prev = Xtd.newest()
+            x_delayed = Xtd.delayed()                                        # shape=(bs, (T+1)*nx)
             x = self.fx(x_delayed)
-            if self.fu is not None:
-                Utd_i = Utd[i:i + self.timedelay + 1]
-                u_delayed = torch.cat([Utd_i[k, :, :] for k in range(Utd_i.shape[0])], dim=-1)  # shape=(bs, T*nu)
-                fu = self.fu(u_delayed)
-                x = self.xou(x, fu)
-                FU.append(fu)
-            if self.fd is not None:
-                Dtd_i = Dtd[i:i + self.timedelay + 1]
-                d_delayed = torch.cat([Dtd_i[k, :, :] for k in range(Dtd_i.shape[0])], dim=-1)  # shape=(bs, T*nu)
-                fd = self.fd(d_delayed)
-                x = self.xod(x, fd)
-                FD.append(fd)
+            if FU_steps is not None:
+                x = self.xou(x, FU_steps[i])
+            if FD_steps is not None:
+                x = self.xod(x, FD_steps[i])
             if self.fe is not None:
                 fe = self.fe(x_delayed)
                 x = self.xoe(x, fe)
-                FE.append(fe)
+                FE[i] = fe
             if self.residual:
-                x += x_prev
-            Xtd = torch.cat([Xtd, x.unsqueeze(0)])[1:]
-            y = self.fy(x_delayed)
-            X.append(x)
-            Y.append(y)
+                x = x + x_prev
+            Xtd.push(x)
+            X[i] = x
+            Y[i] = self.fy(x_delayed)
         output = dict()
-        for tensor_list, name in zip([X, Y, FU, FD, FE],
-                                     ['X_pred', 'Y_pred', 'fU', 'fD', 'fE']):
-            if tensor_list:
-                output[f'{name}_{self.name}'] = torch.stack(tensor_list)
+        for tensor, name in zip([X.tensor(), Y.tensor(), FU, FD, FE.tensor()],
+                                ['X_pred', 'Y_pred', 'fU', 'fD', 'fE']):
+            if tensor is not None:
+                output[f'{name}_{self.name}'] = tensor
         output[f'reg_error_{self.name}'] = self.reg_error()
         return output
 
@@ -337,46 +457,38 @@ class TimeDelayBlackSSM(BlackSSM):
         self.timedelay = timedelay
         self.input_keys = self.keys(input_keys)
 
+    @slim.cached()
     def forward(self, data):
         """
         """
         x_in, y_out, u_in_f, u_in_p, d_in_f, d_in_p = self.input_keys
         nsteps = data[y_out].shape[0]
-        X, Y, FE = [], [], []
+        # delayed input and disturbance features for the whole horizon
+        UDtd = [delayed_features(data[p], data[f], self.timedelay, nsteps)
+                for f, p in [(u_in_f, u_in_p), (d_in_f, d_in_p)] if f in data and p in data]
+        UDtd = torch.cat(UDtd, dim=-1).unbind(0) if UDtd else None
+        X, Y, FE = StateBuffer(nsteps), StateBuffer(nsteps), StateBuffer(nsteps)
 
-        if u_in_f in data and u_in_p in data:
-            Utd = torch.cat([data[u_in_p][-self.timedelay:], data[u_in_f]])  # shape=(T+nsteps, bs, nu)
-        if d_in_f in data and d_in_p in data:
-            Dtd = torch.cat([data[d_in_p][-self.timedelay:], data[d_in_f]])  # shape=(T+nsteps, bs, nd)
-        Xtd = data[x_in]                                                     # shape=(T+1, bs, nx)
+        Xtd = DelayLine(data[x_in])                                          # shape=(T+1, bs, nx)
         for i in range(nsteps):
-            x_prev = Xtd[-1]
-            x_delayed = torch.cat([Xtd[k, :, :] for k in range(Xtd.shape[0])], dim=-1)  # shape=(bs, T*nx)
-            features_delayed = x_delayed
-            if u_in_f in data and u_in_p in data:
-                Utd_i = Utd[i:i + self.timedelay + 1]
-                u_delayed = torch.cat([Utd_i[k, :, :] for k in range(Utd_i.shape[0])], dim=-1)  # shape=(bs, T*nu)
-                features_delayed = torch.cat([features_delayed, u_delayed], dim=-1)
-            if d_in_f in data and d_in_p in data:
-                Dtd_i = Dtd[i:i + self.timedelay + 1]
-                d_delayed = torch.cat([Dtd_i[k, :, :] for k in range(Dtd_i.shape[0])], dim=-1)  # shape=(bs, T*nu)
-                features_delayed = torch.cat([features_delayed, d_delayed], dim=-1)
+            x_prev = Xtd.newest()
+            x_delayed = Xtd.delayed()                                        # shape=(bs, (T+1)*nx)
+            features_delayed = torch.cat([x_delayed, UDtd[i]], dim=-1) if UDtd is not None else x_delayed
             x = self.fxud(features_delayed)
-            Xtd = torch.cat([Xtd, x.unsqueeze(0)])[1:]
+            Xtd.push(x)
             if self.fe is not None:
                 fe = self.fe(x_delayed)
                 x = self.xoe(x, fe)
-                FE.append(fe)
+                FE[i] = fe
             if self.residual:
-                x += x_prev
-            y = self.fy(x_delayed)
-            X.append(x)
-            Y.append(y)
+                x = x + x_prev
+            X[i] = x
+            Y[i] = self.fy(x_delayed)
         output = dict()
-        for tensor_list, name in zip([X, Y, FE],
-                                     ['X_pred', 'Y_pred', 'fE']):
-            if tensor_list:
-                output[f'{name}_{self.name}'] = torch.stack(tensor_list)
+        for tensor, name in zip([X.tensor(), Y.tensor(), FE.tensor()],
+                                ['X_pred', 'Y_pred', 'fE']):
+            if tensor is not None:
+                output[f'{name}_{self.name}'] = tensor
         output[f'reg_error_{self.name}'] = self.reg_error()
         return output
 
@@ -669,4 +781,4 @@ if __name__ == '__main__':
     fxud = blocks.MLP(insize, nx, hsizes=[64, 64, 64])
     fy = blocks.MLP(nx_td, ny, hsizes=[64, 64, 64])
     model = TimeDelayBlackSSM(fxud, fy, timedelay=T, input_keys={'Xtd': 'X', 'Yf': 'Yf_fresh'})
-    output = model(data)
\ No newline at end of file
+    output = model(data)
\ No newline at end of file
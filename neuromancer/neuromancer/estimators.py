@@ -11,6 +11,9 @@ generic mapping:
 x = estim(ym,x0,u,d)
 """
 
+# python base imports
+import warnings
+
 # pytorch imports
 import torch
 import torch.nn as nn
@@ -269,11 +272,17 @@ class LinearKalmanFilter(nn.Module):
     """
     Time-Varying Linear Kalman Filter
     """
-    def __init__(self, model=None, name='kalman_estim'):
+    def __init__(self, model=None, name='kalman_estim', steady_state=False, tol=1e-9, max_iter=100):
         """
 
         :param model: Dynamics model. Should be a block dynamics model with potential input non-linearity.
         :param name: Identifier for tracking output.
+        :param steady_state: (bool) Filter with the steady-state gain from the discrete algebraic Riccati equation
+                             instead of propagating the error covariance. The filter is then a fixed linear
+                             recursion which is evaluated for the whole batch in one scan, and the gain is
+                             computed once while gradients are disabled and the weights do not change.
+        :param tol: (float) Relative tolerance of the Riccati equation solver
+        :param max_iter: (int) Maximum number of doubling iterations of the Riccati equation solver
         """
         super().__init__()
         assert model is not None
@@ -282,6 +291,9 @@ class LinearKalmanFilter(nn.Module):
         assert isinstance(model.fy, slim.LinearBase)
         self.model = model
         self.name = name
+        self.steady_state = steady_state
+        self.tol = tol
+        self.max_iter = max_iter
         self.Q_init = nn.Parameter(torch.eye(model.nx), requires_grad=False)
         self.R_init = nn.Parameter(torch.eye(model.ny), requires_grad=False)
         self.P_init = nn.Parameter(torch.eye(model.nx), requires_grad=False)
@@ -291,29 +303,128 @@ class LinearKalmanFilter(nn.Module):
     def reg_error(self):
         return torch.tensor(0.0)
 
+    def gain(self, P, C, R):
+        """
+        Kalman gain L = P C (R + C^T P C)^-1 for a symmetric predicted covariance P via a Cholesky solve.
+
+        :param P: (torch.Tensor, shape=(nx, nx)) Predicted estimation error covariance
+        :param C: (torch.Tensor, shape=(nx, ny)) Output matrix, y = x C
+        :param R: (torch.Tensor, shape=(ny, ny)) Measurement noise covariance
+        :return: (torch.Tensor, shape=(nx, ny))
+        """
+        CP = torch.mm(C.T, P)
+        return torch.cholesky_solve(CP, torch.linalg.cholesky(R + torch.mm(CP, C))).T
+
+    def riccati(self, A, C, Q, R):
+        """
+        Stabilizing solution of the filter Riccati equation P = A^T P A - A^T P C (R + C^T P C)^-1 C^T P A + Q
+        by the structured doubling algorithm, which converges quadratically and is differentiable.
+        Warns if the relative tolerance is not reached within max_iter iterations, e.g. when (A, C) is not detectable
+        and no stabilizing solution exists.
+
+        :param A: (torch.Tensor, shape=(nx, nx)) State transition matrix, x_next = x A
+        :param C: (torch.Tensor, shape=(nx, ny)) Output matrix, y = x C
+        :param Q: (torch.Tensor, shape=(nx, nx)) Process noise covariance
+        :param R: (torch.Tensor, shape=(ny, ny)) Measurement noise covariance
+        :return: (torch.Tensor, shape=(nx, nx)) Steady-state predicted estimation error covariance
+        """
+        eye = torch.eye(A.shape[0], dtype=A.dtype, device=A.device)
+        G = torch.mm(C, torch.cholesky_solve(C.T, torch.linalg.cholesky(R)))
+        H, converged = Q, False
+        for _ in range(self.max_iter):
+            W = eye + torch.mm(G, H)
+            WA, WG = torch.linalg.solve(W, A), torch.linalg.solve(W, G)
+            H_next = H + torch.mm(A.T, torch.mm(H, WA))
+            G = G + torch.mm(A, torch.mm(WG, A.T))
+            A = torch.mm(A, WA)
+            norm = torch.linalg.norm(H_next)
+            if not torch.isfinite(norm):
+                # the iterates of an unstable undetectable mode overflow
+                break
+            converged = torch.linalg.norm(H_next - H) <= self.tol * norm
+            H = H_next
+            if converged:
+                break
+        if not converged:
+            warnings.warn(f'Riccati equation did not converge to tol={self.tol} within max_iter={self.max_iter} '
+                          f'iterations, the steady-state Kalman gain may be inaccurate.', RuntimeWarning)
+        return (H + H.T) / 2
+
+    def steady_state_gain(self, A, C):
+        """
+        Steady-state Kalman gain, reused without gradients until the weights of the model or the noise
+        covariances are modified.
+
+        :param A: (torch.Tensor, shape=(nx, nx)) State transition matrix
+        :param C: (torch.Tensor, shape=(nx, ny)) Output matrix
+        :return: (torch.Tensor, shape=(nx, ny))
+        """
+        if torch.is_grad_enabled():
+            return self.gain(self.riccati(A, C, self.Q_init, self.R_init), C, self.R_init)
+        params = [*self.model.fx.parameters(), *self.model.fy.parameters(), self.Q_init, self.R_init]
+        version = tuple((p._version, p.data_ptr()) for p in params)
+        cache = self.__dict__.get('gain_cache')
+        if cache is None or cache[0] != version:
+            cache = (version, self.gain(self.riccati(A, C, self.Q_init, self.R_init), C, self.R_init))
+            self.__dict__['gain_cache'] = cache
+        return cache[1]
+
     def forward(self, data):
+        """
+        Filters the whole past sequence Yp. Sequences padded at the end to a common length, see
+        MultiSequenceOpenLoopSimulator, come with a boolean mask of valid samples, shape=(nsteps, nsamples, 1),
+        and the state estimate of a sequence is kept unchanged over its padded steps.
+        """
+        Yp, U, D = data['Yp'], data['Up'][:len(data['Yp'])], data['Dp'][:len(data['Yp'])]
+        mask = data['mask'][:len(Yp)] if 'mask' in data else None
+        with slim.cached():
+            # state transition and output matrices are materialized once for the whole loop
+            A, C = self.model.fx.cached_W(), self.model.fy.cached_W()
+            if self.steady_state:
+                x = self.steady_state_forward(Yp, U, D, A, C, mask)
+            else:
+                x = self.time_varying_forward(Yp, U, D, A, C, mask)
+        return {f'x0_{self.name}': x, f'reg_error_{self.name}': self.reg_error()}
+
+    def time_varying_forward(self, Yp, U, D, A, C, mask=None):
         x = self.x0_estim
         Q = self.Q_init
         R = self.R_init
         P = self.P_init
-        L = self.L_init  # KF gain
-        eye = torch.eye(self.model.nx).to(data['Yp'].device)
-
         # State estimation loop on past data
-        Yp, U, D = data['Yp'], data['Up'], data['Dp']
-        for ym, u, d in zip(Yp, U[:len(Yp)], D[:len(Yp)]):
+        for k, (ym, u, d) in enumerate(zip(Yp, U, D)):
             # PREDICT STEP:
-            x = self.model.fx(x) + self.model.fu(u) + self.model.fd(d)
-            y = self.model.fy(x)
-            # estimation error covariance
-            P = torch.mm(self.model.fx.effective_W(), torch.mm(P, self.model.fx.effective_W().T)) + Q
+            x_next = self.model.fx(x) + self.model.fu(u) + self.model.fd(d)
+            y = self.model.fy(x_next)
+            # estimation error covariance, the transition matrix acts on row vectors
+            P = torch.mm(A.T, torch.mm(P, A)) + Q
             # UPDATE STEP:
-            x = x + torch.mm((ym - y), L.T)
-            L_inverse_part = torch.inverse(R + torch.mm(self.model.fy.effective_W().T,
-                                                        torch.mm(P, self.model.fy.effective_W())))
-            L = torch.mm(torch.mm(P, self.model.fy.effective_W()), L_inverse_part)
-            P = eye - torch.mm(L, torch.mm(self.model.fy.effective_W().T, P))
-        return {f'x0_{self.name}': x, f'reg_error_{self.name}': self.reg_error()}
+            L = self.gain(P, C, R)  # KF gain
+            x_next = x_next + torch.mm((ym - y), L.T)
+            # the covariance does not depend on the data, sequences only differ in where they end
+            x = x_next if mask is None else torch.where(mask[k], x_next, x)
+            P = P - torch.mm(L, torch.mm(C.T, P))
+        return x
+
+    def steady_state_forward(self, Yp, U, D, A, C, mask=None):
+        """
+        With a constant gain L the predict and update steps collapse into the affine recursion
+        x_k = x_k-1 A (I - C L^T) + e_k, where e_k collects the input, disturbance, measurement and bias terms
+        of all steps and samples, computed up front in batched calls.
+        """
+        L = self.steady_state_gain(A, C)
+        nsteps, nsamples = Yp.shape[:2]
+        eye = torch.eye(self.model.nx, dtype=A.dtype, device=A.device)
+        M = eye - torch.mm(C, L.T)
+        AM = torch.mm(A, M)
+        zero = torch.zeros(1, self.model.nx, dtype=A.dtype, device=A.device)
+        fu = self.model.fu(U.reshape(nsteps * nsamples, -1)).reshape(nsteps, nsamples, -1)
+        fd = self.model.fd(D.reshape(nsteps * nsamples, -1)).reshape(nsteps, nsamples, -1)
+        E = torch.matmul(self.model.fx(zero) + fu + fd, M) + torch.matmul(Yp - self.model.fy(zero), L.T)
+        x = self.x0_estim.expand(nsamples, -1)
+        for k, e in enumerate(E.unbind(0)):
+            x = torch.addmm(e, x, AM) if mask is None else torch.where(mask[k], torch.addmm(e, x, AM), x)
+        return x
 
 
 estimators = {'fullyObservable': FullyObservable,
@@ -416,10 +527,11 @@ if __name__ == '__main__':
     fx, fu, fd = [slim.Linear(insize, nx) for insize in [nx, nu, nd]]
     fy = slim.Linear(nx, ny)
     model = BlockSSM(fx, fy, fu, fd)
-    est = LinearKalmanFilter(model=model)
-    est_out = est(data)
-    for k, v in est_out.items():
-        print(f'{k}: {v.shape}')
+    for steady_state in [False, True]:
+        est = LinearKalmanFilter(model=model, steady_state=steady_state)
+        est_out = est(data)
+        for k, v in est_out.items():
+            print(f'{k}: {v.shape}')
 
 
 
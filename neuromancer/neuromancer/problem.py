@@ -2,11 +2,16 @@
 
 """
 # python base imports
+from copy import deepcopy
 from typing import Dict, List, Callable
 
 # machine learning/data science imports
 import torch
 import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+# ecosystem imports
+import slim
 
 
 class Objective(nn.Module):
@@ -63,16 +68,18 @@ class Problem(nn.Module):
         loss = 0.0
         for objective in self.objectives:
             outputs[objective.name] = objective(variables)
-            loss += outputs[objective.name]
+            loss = loss + outputs[objective.name]
         for constraint in self.constraints:
             outputs[constraint.name] = constraint(variables)
-            loss += outputs[constraint.name]
+            loss = loss + outputs[constraint.name]
         return {'loss': loss, **outputs}
 
     def forward(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
 
-        output_dict = self.step(data)
-        loss_dict = self._calculate_loss(output_dict)
+        # structured linear maps materialize their weights once per pass
+        with slim.cached():
+            output_dict = self.step(data)
+            loss_dict = self._calculate_loss(output_dict)
         output_dict = {**loss_dict, **output_dict}
         return {f'{data.name}_{k}': v for k, v in output_dict.items()}
 
@@ -86,6 +93,60 @@ class Problem(nn.Module):
         return input_dict
 
 
+class Ensemble(nn.Module):
+
+    def __init__(self, problems: List[Problem]):
+        """
+        Replicas of a Problem with identical structure, e.g. built with different random seeds, trained as a single model.
+        Parameters of the members are stacked along a leading member dimension and one vectorized forward pass
+        evaluates all members, which keeps the vector units busy for models far too small to do so on their own.
+
+        Outputs carry a leading member dimension. Per member scalars such as losses are averaged under their usual key,
+        which leaves each member with its own gradient up to a constant factor, and are reported individually
+        as {key}_member{i}. Trainer selects the best weights and stops early for each member on its own metric.
+
+        :param problems: list of Problem objects with the same architecture
+        """
+        super().__init__()
+        self.nmembers = len(problems)
+        params, buffers = stack_module_state(problems)
+        self.param_names, self.buffer_names = list(params), list(buffers)
+        self.members = nn.ParameterList([nn.Parameter(v.detach(), requires_grad=v.requires_grad)
+                                       for v in params.values()])
+        for k, v in enumerate(buffers.values()):
+            self.register_buffer(f'member_buffer_{k}', v)
+        # stateless template of a member, kept out of the module tree so it owns no parameters
+        self.__dict__['template'] = deepcopy(problems[0]).to('meta')
+
+    def forward(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        params = dict(zip(self.param_names, self.members))
+        buffers = {k: getattr(self, f'member_buffer_{i}') for i, k in enumerate(self.buffer_names)}
+        output = vmap(lambda p, b: functional_call(self.template, (p, b), (data,)),
+                      randomness='different')(params, buffers)
+        members = dict()
+        for k, v in output.items():
+            if v.dim() == 1:
+                members.update({f'{k}_member{i}': m for i, m in enumerate(v.unbind(0))})
+                output[k] = v.mean()
+        return {**output, **members}
+
+    def member(self, i: int) -> Problem:
+        """
+        :param i: (int) Index of the member
+        :return: (Problem) Standalone copy of the i-th member
+        """
+        problem = deepcopy(self.template).to_empty(device=self.members[0].device)
+        state = {**{k: v[i] for k, v in zip(self.param_names, self.members)},
+                 **{k: getattr(self, f'member_buffer_{j}')[i] for j, k in enumerate(self.buffer_names)}}
+        persistent = problem.state_dict()
+        problem.load_state_dict({k: v for k, v in state.items() if k in persistent})
+        with torch.no_grad():
+            # buffers registered with persistent=False are left out of state dicts
+            for k in set(state) - set(persistent):
+                problem.get_buffer(k).copy_(state[k])
+        return problem
+
+
 if __name__ == '__main__':
     nx, ny, nu, nd = 15, 7, 5, 3
     Np = 2
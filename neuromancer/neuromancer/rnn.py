@@ -7,6 +7,22 @@ import torch.nn.functional as F
 import slim
 
 
+def compile_rnn(model, **kwargs):
+    """
+    Compile the hidden state recurrence of an RNN with torch.compile where available.
+    RNNs whose cells run through the fused torch RNN kernels, see RNN.torch_forward, do not use the recurrence
+    and are returned unchanged.
+
+    :param model: (RNN)
+    :param kwargs: Keyword arguments passed to torch.compile
+    :return: (RNN) The same model with a compiled recurrence method
+    """
+    if hasattr(torch, 'compile'):
+        model.recurrence = torch.compile(model.recurrence, **kwargs)
+        model.compile_kwargs = kwargs
+    return model
+
+
 class RNNCell(nn.Module):
     def __init__(self, input_size, hidden_size, bias=False, nonlin=F.gelu, Linear=slim.Linear, linargs=dict()):
         """
@@ -59,10 +75,25 @@ class RNN(nn.Module):
         self.rnn_cells = nn.ModuleList(rnn_cells)
         self.num_layers = len(rnn_cells)
         self.init_states = nn.ParameterList([nn.Parameter(torch.zeros(1, cell.hidden_size)) for cell in self.rnn_cells])
+        # cells of plain linear maps with a tanh or relu nonlinearity are evaluated by the fused torch.nn.RNN kernels
+        # on the parameters of the cells
+        self.torch_nonlin = {nn.Tanh: 'tanh', nn.ReLU: 'relu'}.get(nonlin) if Linear is slim.Linear else None
+        self.bias = bias
 
     def reg_error(self):
         return torch.mean(torch.stack([cell.reg_error() for cell in self.rnn_cells]))
 
+    def __getstate__(self):
+        # compiled recurrences can not be pickled, they are compiled again when the model is unpickled
+        state = self.__dict__.copy()
+        state.pop('recurrence', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'compile_kwargs' in state:
+            compile_rnn(self, **state['compile_kwargs'])
+
     def forward(self, sequence, init_states=None):
         """
         :param sequence: a tensor(s) of shape (seq_len, batch, input_size)
@@ -74,18 +105,58 @@ class RNN(nn.Module):
         assert len(sequence.shape) == 3, 'RNN takes order 3 tensor with shape=(seq_len, nsamples, dim)'
         if init_states is None:
             init_states = self.init_states
+        if self.torch_nonlin is not None:
+            return self.torch_forward(sequence, init_states)
+        nsteps, nsamples = sequence.shape[:2]
         final_hiddens = []
-        for h, cell in zip(init_states, self.rnn_cells):
-            states = []
-            for seq_idx, cell_input in enumerate(sequence):
-                h = cell(cell_input, h)
-                states.append(h.unsqueeze(0))
-            sequence = torch.cat(states, 0)
-            final_hiddens.append(h)
-        final_hiddens = final_hiddens
-        assert torch.equal(sequence[-1, :, :], final_hiddens[-1])
+        with slim.cached():
+            for h, cell in zip(init_states, self.rnn_cells):
+                # input projections do not depend on the hidden state so are evaluated for all steps at once
+                inputs = cell.lin_in(sequence.reshape(nsteps * nsamples, -1)).reshape(nsteps, nsamples, -1)
+                sequence = self.recurrence(cell, inputs, h)
+                final_hiddens.append(sequence[-1])
         return sequence, torch.stack(final_hiddens)
 
+    def recurrence(self, cell, inputs, h):
+        """
+        Hidden state recurrence of a single layer. Without autograd states are written into a preallocated
+        output, with autograd they are stacked once at the end.
+
+        :param cell: (RNNCell)
+        :param inputs: (torch.Tensor, shape=(seq_len, batch, hidden_size)) Input projections lin_in(x) of all steps
+        :param h: (torch.Tensor, shape=(batch, hidden_size)) Initial hidden state
+        :return: (torch.Tensor, shape=(seq_len, batch, hidden_size)) Hidden states
+        """
+        if torch.is_grad_enabled():
+            states = []
+            for x in inputs.unbind(0):
+                h = cell.nonlin(cell.lin_hidden(h) + x)
+                states.append(h)
+            return torch.stack(states)
+        states = inputs.new_empty(inputs.shape)
+        for i, x in enumerate(inputs.unbind(0)):
+            h = cell.nonlin(cell.lin_hidden(h) + x)
+            states[i] = h
+        return states
+
+    def torch_forward(self, sequence, init_states):
+        """
+        Forward pass through the kernels of torch.nn.RNN using the weights of the cells.
+        The kernels are called directly, as torch.nn.RNN.forward does, so the pass can be traced with torch.jit.trace.
+
+        :param sequence: (torch.Tensor, shape=(seq_len, batch, input_size))
+        :param init_states: h_0 (num_layers, batch or 1, hidden_size)
+        :return: output (seq_len, batch, hidden_size), h_n (num_layers, batch, hidden_size)
+        """
+        params = []
+        for cell in self.rnn_cells:
+            params += [cell.lin_in.linear.weight, cell.lin_hidden.linear.weight]
+            if self.bias:
+                params += [cell.lin_in.linear.bias, cell.lin_hidden.linear.bias]
+        h0 = torch.stack([h.expand(sequence.shape[1], -1) for h in init_states])
+        kernel = torch._VF.rnn_tanh if self.torch_nonlin == 'tanh' else torch._VF.rnn_relu
+        return kernel(sequence, h0, params, self.bias, self.num_layers, 0.0, self.training, False, False)
+
 
 if __name__ == '__main__':
     x = torch.rand(20, 5, 8)
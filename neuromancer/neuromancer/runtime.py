@@ -0,0 +1,248 @@
+"""
+Deployable inference artifacts for the estimator, policy and dynamics pipeline of a trained control problem.
+
+export traces the components into a single frozen TorchScript module and stores a json spec of its inputs and
+outputs inside the same file. load only needs torch, so a controller process starts without importing
+the training stack (mlflow, matplotlib, scipy, psl or the rest of neuromancer).
+
+    example = {k: v[:, :1] for k, v in dataset.dev_data.items()}
+    export('controller.ts', [estimator, policy], example, outputs=['U_pred_policy'])
+
+    pipeline = load('controller.ts')
+    u = pipeline({'Yp': Yp, 'Rf': Rf, 'Y_minf': Y_minf, 'Y_maxf': Y_maxf, 'Df': Df})['U_pred_policy'][0]
+
+MPCRuntime runs such a pipeline in a receding horizon loop with preallocated input windows and latency statistics.
+
+    mpc = MPCRuntime('controller.ts', threads=1, warmup=1000, budget=1e-3)
+    mpc.fill('Rf', R[:nsteps])
+    for k in range(nsim):
+        u = mpc.step({'Yp': measure(), 'Rf': R[k + nsteps]})
+        send_control(u)
+    print(mpc.latency())
+"""
+# python base imports
+import json
+import time
+from array import array
+
+# machine learning/data science imports
+import torch
+import torch.nn as nn
+
+
+class Pipeline(nn.Module):
+    def __init__(self, components, input_keys, output_keys):
+        """
+        Components evaluated in sequence on positional tensors, the traceable form of a Problem forward pass.
+
+        :param components: (list of nn.Module) Components taking and returning dicts of tensors, e.g. estimator and policy
+        :param input_keys: (list of str) Names of the positional inputs
+        :param output_keys: (list of str) Names of the returned tensors
+        """
+        super().__init__()
+        self.components = nn.ModuleList(components)
+        self.input_keys, self.output_keys = list(input_keys), list(output_keys)
+
+    def forward(self, *inputs):
+        data = dict(zip(self.input_keys, inputs))
+        for component in self.components:
+            data.update(component(data))
+        return tuple(data[k] for k in self.output_keys)
+
+
+def trace(components, example, outputs, jit=True):
+    """
+    Pipeline of components specialized to the shapes of example inputs.
+
+    :param components: (list of nn.Module) Components in evaluation order, e.g. [estimator, policy, dynamics]
+    :param example: (dict {str: Tensor}) Example inputs, keys no component reads are left out of the pipeline
+    :param outputs: (list of str) Keys of the component outputs returned by the pipeline
+    :param jit: (bool) Whether to trace and freeze the pipeline into TorchScript
+    :return: (nn.Module or torch.jit.ScriptModule, dict) Pipeline and its spec of input and output names and shapes
+    """
+    inputs = [k for k in example if any(k in component.input_keys for component in components)]
+    pipeline = Pipeline(components, inputs, outputs).eval()
+    args = tuple(example[k] for k in inputs)
+    with torch.no_grad():
+        if jit:
+            pipeline = torch.jit.freeze(torch.jit.trace(pipeline, args, check_trace=False))
+        result = pipeline(*args)
+    spec = {'inputs': {k: list(v.shape) for k, v in zip(inputs, args)},
+            'outputs': {k: list(v.shape) for k, v in zip(outputs, result)}}
+    return pipeline, spec
+
+
+def export(path, components, example, outputs):
+    """
+    Traces components on example inputs and writes a self-contained TorchScript artifact.
+    The artifact is specialized to the shapes of the example, e.g. windows of a single sample for control.
+
+    :param path: (str) File to write
+    :param components: (list of nn.Module) Components in evaluation order, e.g. [estimator, policy, dynamics]
+    :param example: (dict {str: Tensor}) Example inputs, keys no component reads are left out of the artifact
+    :param outputs: (list of str) Keys of the component outputs returned by the artifact
+    :return: (dict) Spec of the artifact
+    """
+    frozen, spec = trace(components, example, outputs)
+    torch.jit.save(frozen, path, _extra_files={'spec.json': json.dumps(spec)})
+    return spec
+
+
+class Artifact:
+    def __init__(self, module, spec):
+        """
+        :param module: (torch.jit.ScriptModule) Pipeline loaded from an artifact
+        :param spec: (dict) Input and output names and shapes
+        """
+        self.module, self.spec = module, spec
+        self.input_keys, self.output_keys = list(spec['inputs']), list(spec['outputs'])
+
+    def __call__(self, data):
+        """
+        :param data: (dict {str: Tensor}) Inputs of the pipeline, other keys are ignored
+        :return: (dict {str: Tensor}) Outputs of the pipeline
+        """
+        with torch.inference_mode():
+            outputs = self.module(*[data[k] for k in self.input_keys])
+        return dict(zip(self.output_keys, outputs))
+
+
+def load(path, map_location='cpu'):
+    """
+    :param path: (str) Artifact written by export
+    :param map_location: (str) Device to load the pipeline to
+    :return: (Artifact)
+    """
+    extra_files = {'spec.json': ''}
+    module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return Artifact(module.eval(), json.loads(extra_files['spec.json']))
+
+
+class MPCRuntime:
+    def __init__(self, controller, example=None, outputs=None, control_key='U_pred_policy', jit=True, threads=1,
+                 warmup=100, budget=None, history=100000):
+        """
+        Receding horizon controller loop with a bounded per-step cost. Every input window lives in a preallocated
+        ring buffer of twice its length, so that the current window is always a contiguous precomputed view and
+        a step writes one sample per updated window and evaluates the pipeline without building new inputs.
+
+        :param controller: (Artifact, str or list of nn.Module) Artifact, path of an artifact written by export
+                           or components evaluated in order, e.g. [estimator, policy]
+        :param example: (dict {str: Tensor}) Example inputs fixing the window shapes, required for components
+        :param outputs: (list of str) Output keys of the components, defaults to [control_key]. The outputs of
+                        an artifact are fixed at export, given keys must be among them
+        :param control_key: (str) Output key of the control plan returned by step
+        :param jit: (bool) Whether to trace and freeze components into TorchScript
+        :param threads: (int) Number of intra-op threads, fixed for the process to avoid scheduling jitter
+        :param warmup: (int) Number of steps run on the initial windows before latencies are recorded,
+                       which lets TorchScript specialize its execution plan
+        :param budget: (float) Latency budget of a step in seconds, steps exceeding it are counted in overruns
+        :param history: (int) Number of most recent step latencies kept for percentiles
+        """
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(threads)
+        except RuntimeError:
+            # can only be set once per process, before any inter-op parallel work
+            pass
+        # denormal arithmetic is orders of magnitude slower on most CPUs and a source of latency spikes
+        torch.set_flush_denormal(True)
+        if isinstance(controller, str):
+            controller = load(controller)
+        outputs = [control_key] if outputs is None else list(outputs)
+        if isinstance(controller, Artifact):
+            self.module, self.spec = controller.module, controller.spec
+        else:
+            self.module, self.spec = trace(controller, example, outputs, jit=jit)
+        self.input_keys, self.output_keys = list(self.spec['inputs']), list(self.spec['outputs'])
+        missing = [k for k in [*outputs, control_key] if k not in self.spec['outputs']]
+        if missing:
+            raise ValueError(f'Outputs {missing} are not returned by the controller, its outputs are {self.output_keys}')
+        self.control_key, self.control_index = control_key, self.output_keys.index(control_key)
+        self.buffers, self.views, self.position = dict(), dict(), dict()
+        for k, shape in self.spec['inputs'].items():
+            n = shape[0]
+            self.buffers[k] = torch.zeros([2 * n] + shape[1:])
+            self.views[k] = [self.buffers[k][p + 1:p + 1 + n] for p in range(n)]
+            self.position[k] = n - 1
+        self.budget = budget
+        self.history = history
+        self.latencies = array('q', bytes(8 * history))
+        self.nsteps_run, self.overruns = 0, 0
+        self.outputs = None
+        for _ in range(warmup):
+            self.evaluate()
+        self.reset_latency()
+
+    def push(self, key, value):
+        """
+        Appends the newest sample to a window. For past windows, e.g. Yp, this is the latest measurement,
+        for preview windows, e.g. Rf, the sample at the end of the horizon.
+
+        :param key: (str) Input name
+        :param value: (Tensor, array or float) Sample of shape (1, dim) or broadcastable to it
+        """
+        buffer, n = self.buffers[key], self.buffers[key].shape[0] // 2
+        p = (self.position[key] + 1) % n
+        buffer[p] = value
+        buffer[p + n] = buffer[p]
+        self.position[key] = p
+
+    def fill(self, key, window):
+        """
+        Overwrites a whole window, e.g. the reference preview before the loop starts.
+
+        :param key: (str) Input name
+        :param window: (Tensor or array) Samples in chronological order, shape (nsteps, 1, dim) or broadcastable to it
+        """
+        n = self.buffers[key].shape[0] // 2
+        window = torch.as_tensor(window, dtype=self.buffers[key].dtype).reshape(self.views[key][0].shape)
+        self.buffers[key][:n] = window.roll(self.position[key] + 1, dims=0)
+        self.buffers[key][n:] = self.buffers[key][:n]
+
+    def window(self, key):
+        """
+        :return: (Tensor) Current window of an input in chronological order, a view into the ring buffer
+        """
+        return self.views[key][self.position[key]]
+
+    def evaluate(self):
+        with torch.inference_mode():
+            self.outputs = self.module(*[self.views[k][self.position[k]] for k in self.input_keys])
+        return self.outputs
+
+    def step(self, values=dict()):
+        """
+        One control update: appends new samples to the windows, evaluates the pipeline and records the latency.
+
+        :param values: (dict {str: Tensor, array or float}) Newest sample of each updated window
+        :return: (Tensor) First step of the control plan control_key
+        """
+        start = time.perf_counter_ns()
+        for k, v in values.items():
+            self.push(k, v)
+        u = self.evaluate()[self.control_index][0]
+        elapsed = time.perf_counter_ns() - start
+        self.latencies[self.nsteps_run % self.history] = elapsed
+        self.nsteps_run += 1
+        if self.budget is not None and elapsed > self.budget * 1e9:
+            self.overruns += 1
+        return u
+
+    def reset_latency(self):
+        self.nsteps_run, self.overruns = 0, 0
+
+    def latency(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        :param percentiles: (tuple of float) Percentiles of the recorded step latencies
+        :return: (dict {str: float}) Latency percentiles and maximum in microseconds, number of steps and overruns
+        """
+        n = min(self.nsteps_run, self.history)
+        stats = {'steps': self.nsteps_run, 'overruns': self.overruns}
+        if n == 0:
+            return stats
+        latencies = torch.frombuffer(self.latencies, dtype=torch.int64)[:n].double() / 1e3
+        q = torch.tensor(percentiles, dtype=torch.float64) / 100
+        stats.update({f'p{p}_us': v.item() for p, v in zip(percentiles, torch.quantile(latencies, q))})
+        stats['max_us'] = latencies.max().item()
+        return stats
@@ -8,9 +8,8 @@ signal generator components for training
 import numpy as np
 import torch
 import torch.nn as nn
-import random
 
-from neuromancer.datasets import normalize, EmulatorDataset, FileDataset, systems
+from neuromancer.datasets import EmulatorDataset, FileDataset, systems
 import psl
 from collections import defaultdict
 import dill
@@ -34,15 +33,167 @@ def freeze_weight(model, module_names=['']):
             freeze_weight(parent, ['->'.join(freeze_path[1:])])
 
 
+def seeded_generator(seed=None, device='cpu'):
+    """
+    Random number generator for signal generation on device.
+
+    :param seed: (int) Seed of the generator. None draws a seed from the global torch generator,
+                 so that torch.manual_seed makes the signals reproducible.
+    :param device: (str) Device of the generator and generated signals
+    :return: (torch.Generator)
+    """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(torch.randint(2**62, (1,))) if seed is None else seed)
+    return generator
+
+
+def scale(signal, xmin, xmax):
+    """
+    :param signal: (torch.Tensor) Signal with values in [0, 1]
+    :param xmin: (float or torch.Tensor) Minimum value, broadcast against signal
+    :param xmax: (float or torch.Tensor) Maximum value, broadcast against signal
+    :return: (torch.Tensor) Signal scaled to [xmin, xmax]
+    """
+    xmin = torch.as_tensor(xmin, dtype=signal.dtype, device=signal.device)
+    xmax = torch.as_tensor(xmax, dtype=signal.dtype, device=signal.device)
+    return xmin + (xmax - xmin) * signal
+
+
+def periodic(nsim, nx, nsamples=1, periods=1, xmin=0.0, xmax=1.0, form='sin', generator=None, device='cpu'):
+    """
+    Periodic signals as psl.Periodic, with a number of periods drawn for each sample and signal.
+
+    :param nsim: (int) Number time steps
+    :param nx: (int) Number signals
+    :param nsamples: (int) Number of independent samples
+    :param periods: (int or tuple) Number of periods over nsim steps or an inclusive (min, max) range to draw from
+    :param xmin: (float or torch.Tensor) signal minimum value
+    :param xmax: (float or torch.Tensor) signal maximum value
+    :param form: (str) form of the periodic signal 'sin' or 'cos'
+    :param generator: (torch.Generator) Random number generator on device
+    :param device: (str)
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    low, high = (periods, periods) if isinstance(periods, int) else periods
+    numPeriods = torch.randint(min(low, nsim), min(high, nsim) + 1, (nsamples, nx), generator=generator, device=device)
+    samples_period = nsim // numPeriods
+    t = torch.arange(nsim, device=device).view(-1, 1, 1)
+    phase = 2 * np.pi * (t % samples_period) / samples_period
+    base = 0.5 + 0.5 * (torch.sin(phase) if form == 'sin' else torch.cos(phase))
+    return scale(base, xmin, xmax)
+
+
+def white_noise(nsim, nx, nsamples=1, xmin=0.0, xmax=1.0, generator=None, device='cpu'):
+    """
+    Uniform white noise as psl.WhiteNoise.
+
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    return scale(torch.rand(nsim, nsamples, nx, generator=generator, device=device), xmin, xmax)
+
+
+def step(nsim, nx, nsamples=1, tstep=None, xmin=0.0, xmax=1.0, generator=None, device='cpu'):
+    """
+    Step change from xmin to xmax as psl.Step.
+
+    :param tstep: (int) Time of the step, drawn for each sample and signal when None
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    if tstep is None:
+        tstep = torch.randint(nsim, (nsamples, nx), generator=generator, device=device)
+    t = torch.arange(nsim, device=device).view(-1, 1, 1)
+    return scale((t >= tstep).float().expand(nsim, nsamples, nx), xmin, xmax)
+
+
+def steps(nsim, nx, nsamples=1, nchanges=5, xmin=0.0, xmax=1.0, generator=None, device='cpu'):
+    """
+    Piecewise constant signals with nchanges random levels of equal duration as psl.Steps.
+
+    :param nchanges: (int) Number of levels
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    values = torch.rand(nchanges, nsamples, nx, generator=generator, device=device)
+    step_length = int(np.ceil(nsim / nchanges))
+    return scale(values.repeat_interleave(step_length, dim=0)[:nsim], xmin, xmax)
+
+
+def random_walk(nsim, nx, nsamples=1, sigma=0.05, xmin=0.0, xmax=1.0, generator=None, device='cpu'):
+    """
+    Gaussian random walks starting at xmin and reflected at the bounds, similar to psl.RandomWalk.
+
+    :param sigma: (float) Standard deviation of the increments relative to xmax - xmin
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    increments = sigma * torch.randn(nsim, nsamples, nx, generator=generator, device=device)
+    increments[0] = 0.0
+    walk = torch.cumsum(increments, dim=0).remainder(2.0)
+    return scale(torch.where(walk > 1.0, 2.0 - walk, walk), xmin, xmax)
+
+
+def spline(nsim, nx, nsamples=1, npoints=30, xmin=0.0, xmax=1.0, generator=None, device='cpu'):
+    """
+    Smooth periodic trajectories through npoints triangularly distributed values as psl.SplineSignal,
+    interpolated with cubic Catmull-Rom splines.
+
+    :param npoints: (int) Number of interpolated values
+    :return: (torch.Tensor, shape=(nsim, nsamples, nx))
+    """
+    # the mean of two uniform samples is triangularly distributed with mode 0.5
+    values = torch.rand(2, npoints, nsamples, nx, generator=generator, device=device).mean(0)
+    dt = int(np.ceil(nsim / npoints))
+    t = torch.arange(nsim, device=device)
+    idx, s = t // dt, ((t % dt) / dt).view(-1, 1, 1)
+    p0, p1, p2, p3 = [values[(idx + k) % npoints] for k in (-1, 0, 1, 2)]
+    base = p1 + 0.5 * s * (p2 - p0 + s * (2 * p0 - 5 * p1 + 4 * p2 - p3 + s * (3 * (p1 - p2) + p3 - p0)))
+    return scale(base, xmin, xmax)
+
+
+def minmax(signal, dim=0):
+    """
+    Min-max normalization over the time dimension as datasets.normalize, constant signals map to 0.
+
+    :param signal: (torch.Tensor)
+    :param dim: (int) Time dimension
+    :return: (torch.Tensor)
+    """
+    smin, smax = signal.amin(dim, keepdim=True), signal.amax(dim, keepdim=True)
+    return torch.nan_to_num((signal - smin) / (smax - smin), nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def nstep_windows(signal, nsteps):
+    """
+    Consecutive non-overlapping windows of a sequence, each window paired with the one following it.
+
+    :param signal: (torch.Tensor, shape=((nbatch + 1) * nsteps, nx))
+    :param nsteps: (int) Window length
+    :return: (tuple of torch.Tensor, shape=(nsteps, nbatch, nx)) Past and future windows
+    """
+    windows = signal.reshape(-1, nsteps, signal.shape[-1])
+    return windows[:-1].transpose(0, 1), windows[1:].transpose(0, 1)
+
+
 class SignalGeneratorDynamics(nn.Module):
-    def __init__(self, dynamics, estimator, nsteps, xmax=1.0, xmin=0.0, name='signal_dynamics'):
-        super().__init__()
+    def __init__(self, dynamics, estimator, nsteps, xmax=1.0, xmin=0.0, name='signal_dynamics',
+                 parallel=False, device='cpu', seed=None):
         """
-        dynamics 
-        
+        Synthetic output trajectories of a frozen dynamics model excited by random periodic signals.
+        Every nstep window of the excitation is a fresh periodic signal with nsteps//4 to nsteps//2 periods.
+
+        :param dynamics: (BlockSSM) Dynamics model
+        :param estimator: State estimator providing the initial states of the trajectories
+        :param nsteps: (int) Prediction horizon
+        :param xmax: (float) Maximum value of the excitation signals
+        :param xmin: (float) Minimum value of the excitation signals
+        :param name: (str) Output keys are name + 'p' and name + 'f'
+        :param parallel: (bool) Roll out nbatch independent trajectories of 2*nsteps steps in a single batched call,
+                         each from the estimate of its own excitation, split into a p and an f window.
+                         By default a single trajectory of (nbatch + 1)*nsteps steps is split into consecutive
+                         windows, so that the samples of a batch are successive windows of one trajectory.
+        :param device: (str) Device signals are generated on
+        :param seed: (int) Seed of the random number generator, drawn from the global torch generator when None
         """
+        super().__init__()
         self.nsteps = nsteps
-        self.nbatch = None
         self.nu = dynamics.nu
         self.nd = dynamics.nd
         self.ny = dynamics.ny
@@ -51,146 +202,160 @@ class SignalGeneratorDynamics(nn.Module):
         self.estimator_input_keys = estimator.input_keys
         self.data_dims_in = {k: v[-1] for k, v in estimator.data_dims.items() if k in estimator.input_keys}
         self.xmax, self.xmin, self.name = xmax, xmin, name
+        self.parallel = parallel
+        self.device = device
+        self.generator = seeded_generator(seed, device)
         self.estimator, self.dynamics = estimator, dynamics
         freeze_weight(self.estimator)
         freeze_weight(self.dynamics)
 
+    def excitation(self, nwindows, nsamples, dim):
+        """
+        :return: (torch.Tensor, shape=(nwindows*nsteps, nsamples, dim)) Consecutive periodic windows
+        """
+        periods = (max(1, self.nsteps // 4), max(1, self.nsteps // 2))
+        signal = periodic(self.nsteps, dim, nsamples=nwindows * nsamples, periods=periods, xmin=self.xmin,
+                          xmax=self.xmax, generator=self.generator, device=self.device)
+        return signal.view(self.nsteps, nwindows, nsamples, dim).transpose(0, 1).reshape(-1, nsamples, dim)
+
     def forward(self, data):
         with torch.no_grad():
             key = list(data.keys())[0]
-            # nsim = data[key].shape[1]*data[key].shape[0] + self.nsteps
-            current_nbatch = data[key].shape[1]
-            if self.nbatch is None:
-                self.nbatch = current_nbatch
-            state_estimator_input = dict()
-            for input_signal, dim in self.data_dims_in.items():
-                numPeriods = random.randint(self.nsteps // 4, self.nsteps // 2)
-                if numPeriods > self.nsteps:
-                    numPeriods = self.nsteps
-                sample = psl.Periodic(nx=dim, nsim=self.nsteps,
-                                      numPeriods=numPeriods,
-                                      xmax=self.xmax, xmin=self.xmin)
-                state_estimator_input[input_signal] = torch.tensor(sample).view(self.nsteps, 1, dim).float()
+            nbatch = data[key].shape[1]
+            nwindows, nsamples = (2, nbatch) if self.parallel else (nbatch + 1, 1)
+            state_estimator_input = {input_signal: self.excitation(1, nsamples, dim)
+                                     for input_signal, dim in self.data_dims_in.items()}
             estimator_output = self.estimator(state_estimator_input)
-            ysignals = []
-            dynamics_input = dict()
-            x0 = estimator_output[f'x0_{self.estimator.name}']
-            # TODO: this is a hack!!! FIX in FY21
-            for i in range(self.nbatch+5):
-                for dim, name in zip([self.ny, self.nu, self.nd], self.dynamics_input_keys):
-                    if dim > 0:
-                        dynamics_input[name] = torch.tensor(psl.Periodic(nx=dim, nsim=self.nsteps,
-                                                            numPeriods=random.randint(self.nsteps//4, self.nsteps//2),
-                                                            xmax=self.xmax, xmin=self.xmin)).view(self.nsteps, 1, dim).float()
-                dynamics_input[f'x0_{self.estimator.name}'] = x0
-                dynamics_output = self.dynamics({**estimator_output, **dynamics_input})
-                x0 = dynamics_output[f'X_pred_{self.dynamics.name}'][-1]
-                ysignals.append(dynamics_output[f'Y_pred_{self.dynamics.name}'])
-
-            if self.nbatch == current_nbatch:
-                # TODO: this is a hack!!! FIX in FY21
-                Yp = torch.stack(ysignals[:-5], dim=1).view(self.nsteps, self.nbatch, self.ny)
-                Yf = torch.stack(ysignals[1:-4], dim=1).view(self.nsteps, self.nbatch, self.ny)
+            dynamics_input = {name: self.excitation(nwindows, nsamples, dim)
+                              for dim, name in zip([self.ny, self.nu, self.nd], self.dynamics_input_keys) if dim > 0}
+            dynamics_input[f'x0_{self.estimator.name}'] = estimator_output[f'x0_{self.estimator.name}']
+            dynamics_output = self.dynamics({**estimator_output, **dynamics_input})
+            Y = dynamics_output[f'Y_pred_{self.dynamics.name}']
+            if self.parallel:
+                Yp, Yf = Y[:self.nsteps], Y[self.nsteps:]
             else:
-                # TODO: this is a hack!!! FIX in FY21
-                # print(ysignals[0].shape)
-                # print(len(ysignals))
-                Yp = torch.cat(ysignals[:-1]).squeeze(1)
-                Yf = torch.cat(ysignals[1:]).squeeze(1)
-                # print(Yp.shape)
-                # print(Yf.shape)
-                end_step_Yp = Yp.shape[0] - self.nsteps
-                end_step_Yf = Yf.shape[0] - self.nsteps
-                # print(end_step_Yp)
-                # print(end_step_Yf)
-                Yp = torch.stack([Yp[k:k + self.nsteps, :] for k in range(0, end_step_Yp)]).transpose(1, 0)  # nsteps X nsamples X nfeatures
-                Yf = torch.stack([Yf[k:k + self.nsteps, :] for k in range(0, end_step_Yf)]).transpose(1, 0)  # nsteps X nsamples X nfeatures
-                Yp = Yp[:, :2993, :]
-                Yf = Yf[:, :2993, :]
+                Yp, Yf = nstep_windows(Y[:, 0], self.nsteps)
         return {self.name + 'p': Yp, self.name + 'f': Yf}
 
 
 class SignalGenerator(nn.Module):
 
-    def __init__(self, nsteps, nx, xmax, xmin, name='signal'):
+    def __init__(self, nsteps, nx, xmax, xmin, name='signal', device='cpu', seed=None):
+        """
+        Generates reference or disturbance sequences on device for every batch. A single sequence spanning
+        the batch is generated, min-max normalized and split into consecutive nstep windows.
+
+        :param nsteps: (int) Prediction horizon
+        :param nx: (int) Number of signals
+        :param xmax: (float) signal maximum value
+        :param xmin: (float) signal minimum value
+        :param name: (str) Output keys are name + 'p' and name + 'f'
+        :param device: (str) Device signals are generated on
+        :param seed: (int) Seed of the random number generator, drawn from the global torch generator when None
+        """
         super().__init__()
         self.nsteps, self.nx = nsteps, nx
         self.xmax, self.xmin, self.name = xmax, xmin, name
-        self.iter = 0
+        self.device = device
+        self.generator = seeded_generator(seed, device)
+
     def get_xmax(self):
         return self.xmax
 
     def get_xmin(self):
         return self.xmin
-# nstep X nsamples x nfeatures
-#
-#     end_step = data.shape[0] - nsteps
-#     data = np.asarray([data[k:k+nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-#     return data.transpose(1, 0, 2)  # nsteps X nsamples X nfeatures
 
-    def forward(self, data):
+    def sequence_generator(self, nsim, xmin, xmax):
+        """
+        :return: (torch.Tensor, shape=(nsim, nx))
+        """
+        raise NotImplementedError
 
+    def forward(self, data):
         key = list(data.keys())[0]
-        nsim = data[key].shape[1]*data[key].shape[0] + self.nsteps
         nbatch = data[key].shape[1]
-
-        xmax, xmin = self.get_xmax(), self.get_xmin()
-        R = self.sequence_generator(nsim, xmax, xmin)
-        R, _, _ = normalize(R)
-
-        Rp, Rf = R[:-self.nsteps], R[self.nsteps:]
-
-        if self.iter == 0:
-            self.nstep_batch_size = nbatch
-        if nbatch == self.nstep_batch_size:
-            Rp = torch.tensor(Rp, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1)
-            Rf = torch.tensor(Rf, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1)
-        else:
-            end_step = Rp.shape[0] - self.nsteps
-            Rp = np.asarray([Rp[k:k+self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rp = torch.tensor(Rp.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
-            Rf = np.asarray([Rf[k:k + self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rf = torch.tensor(Rf.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
+        nsim = (nbatch + 1) * self.nsteps
+        R = minmax(self.sequence_generator(nsim, self.get_xmin(), self.get_xmax()))
+        Rp, Rf = nstep_windows(R, self.nsteps)
         return {self.name + 'p': Rp, self.name + 'f': Rf}
 
 
 class WhiteNoisePeriodicGenerator(SignalGenerator):
 
-    def __init__(self, nsteps, nx, xmax=(0.1, 0.5), xmin=0.0, min_period=5, max_period=30, name='period'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name)
+    def __init__(self, nsteps, nx, xmax=(0.1, 0.5), xmin=0.0, min_period=5, max_period=30, name='period',
+                 device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
+        self.min_period, self.max_period = min_period, max_period
 
-        self.white_noise_generator = lambda nsim, xmin, xmax: psl.WhiteNoise(nx=self.nx, nsim=nsim,
-                                                                             xmax=xmax, xmin=xmin)[:nsim]
-        self.period_generator = lambda nsim, xmin, xmax: psl.Periodic(nx=self.nx, nsim=nsim,
-                                                                      numPeriods=random.randint(min_period, max_period),
-                                                                      xmax=xmax, xmin=xmin)[:nsim]
-        self.sequence_generator = lambda nsim, xmin, xmax: self.period_generator(nsim, xmin, xmax) + self.white_noise_generator(nsim, xmin, 1.0 - xmax)
+    def sequence_generator(self, nsim, xmin, xmax):
+        kwargs = {'generator': self.generator, 'device': self.device}
+        return (periodic(nsim, self.nx, periods=(self.min_period, self.max_period), xmin=xmin, xmax=xmax, **kwargs)
+                + white_noise(nsim, self.nx, xmin=xmin, xmax=1.0 - xmax, **kwargs))[:, 0]
 
     def get_xmax(self):
-        return random.uniform(*self.xmax)
+        return scale(torch.rand((), generator=self.generator, device=self.device), *self.xmax)
 
 
 class PeriodicGenerator(SignalGenerator):
 
-    def __init__(self, nsteps, nx, xmax, xmin, min_period=5, max_period=30, name='period'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name)
-        self.sequence_generator = lambda nsim: psl.Periodic(nx=self.nx, nsim=nsim, numPeriods=random.randint(min_period, max_period),
-                                                            xmax=self.xmax, xmin=self.xmin)
+    def __init__(self, nsteps, nx, xmax, xmin, min_period=5, max_period=30, name='period', device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
+        self.min_period, self.max_period = min_period, max_period
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return periodic(nsim, self.nx, periods=(self.min_period, self.max_period), xmin=xmin, xmax=xmax,
+                        generator=self.generator, device=self.device)[:, 0]
 
 
 class WhiteNoiseGenerator(SignalGenerator):
-    def __init__(self, nsteps, nx, xmax, xmin, name='period'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name)
-        self.sequence_generator = lambda nsim: psl.WhiteNoise(nx=self.nx, nsim=nsim,
-                                                              xmax=self.xmax, xmin=self.xmin)
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return white_noise(nsim, self.nx, xmin=xmin, xmax=xmax, generator=self.generator, device=self.device)[:, 0]
+
+
+class StepGenerator(SignalGenerator):
+
+    def __init__(self, nsteps, nx, xmax, xmin, nchanges=5, name='step', device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
+        self.nchanges = nchanges
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return steps(nsim, self.nx, nchanges=self.nchanges, xmin=xmin, xmax=xmax,
+                     generator=self.generator, device=self.device)[:, 0]
+
+
+class RandomWalkGenerator(SignalGenerator):
+
+    def __init__(self, nsteps, nx, xmax, xmin, sigma=0.05, name='walk', device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
+        self.sigma = sigma
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return random_walk(nsim, self.nx, sigma=self.sigma, xmin=xmin, xmax=xmax,
+                           generator=self.generator, device=self.device)[:, 0]
+
+
+class SplineGenerator(SignalGenerator):
+
+    def __init__(self, nsteps, nx, xmax, xmin, npoints=30, name='spline', device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
+        self.npoints = npoints
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return spline(nsim, self.nx, npoints=self.npoints, xmin=xmin, xmax=xmax,
+                      generator=self.generator, device=self.device)[:, 0]
 
 
 class AddGenerator(SignalGenerator):
-    def __init__(self, SG1, SG2, nsteps, nx, xmax, xmin, name='period'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name)
+    def __init__(self, SG1, SG2, nsteps, nx, xmax, xmin, name='period', device='cpu', seed=None):
+        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device, seed=seed)
         assert SG1.nsteps == SG2.nsteps, 'Nsteps must match to compose sequence generators'
         assert SG1.nx == SG2.nx, 'Nx must match to compose sequence generators'
-        self.sequence_generator = lambda nsim: SG1.sequence_generator(nsim) + SG2.sequence_generator(nsim)
+        self.SG1, self.SG2 = SG1, SG2
+
+    def sequence_generator(self, nsim, xmin, xmax):
+        return (self.SG1.sequence_generator(nsim, self.SG1.get_xmin(), self.SG1.get_xmax())
+                + self.SG2.sequence_generator(nsim, self.SG2.get_xmin(), self.SG2.get_xmax()))
 
 
 if __name__ == '__main__':
@@ -12,6 +12,7 @@ import numpy as np
 
 # ecosystem imports
 from psl import EmulatorBase
+import slim
 
 # lcoal imports
 from neuromancer.datasets import EmulatorDataset, FileDataset, min_max_denorm
@@ -55,9 +56,22 @@ class OpenLoopSimulator(Simulator):
 
 class MultiSequenceOpenLoopSimulator(Simulator):
     def __init__(self, model: Problem, dataset: Dataset, emulator: [EmulatorBase, nn.Module] = None,
-                 eval_sim=True, stack=False):
+                 eval_sim=True, stack=False, batched=True):
+        """
+
+        :param stack: (bool) Stack rather than concatenate the per sequence outputs
+        :param batched: (bool) Simulate all sequences in a single forward pass instead of one pass per sequence.
+                        Sequences are padded at the end to the longest one and the padded batch carries the mask of
+                        valid samples under the key 'mask', shape=(nsteps, nseq, 1). Outputs are cut back to the length
+                        of each sequence before the objectives are evaluated per sequence. Assumes components are causal
+                        in time or skip masked steps like LinearKalmanFilter, return sequences of shape
+                        (nsteps, nseq, dim) and static outputs of shape (nseq, dim), and that outputs of any other
+                        shape, e.g. regularization terms, do not depend on the data. Ensembles are simulated one
+                        sequence at a time.
+        """
         super().__init__(model=model, dataset=dataset, emulator=emulator, eval_sim=eval_sim)
         self.stack = stack
+        self.batched = batched
 
     def agg(self, outputs):
         agg_outputs = dict()
@@ -76,10 +90,54 @@ class MultiSequenceOpenLoopSimulator(Simulator):
                     agg_outputs[k] = torch.cat(agg_outputs[k])
         return agg_outputs
 
+    def pad(self, data):
+        """
+        Stacks sequences along the batch dimension, shorter sequences are padded at the end with their last sample.
+
+        :param data: (list of DataDict) Sequences of shape (nsteps_i, 1, dim), all keys of a sequence of equal length
+        :return: (DataDict, list of int) Padded batch with the mask of valid samples, length of every sequence
+        """
+        lengths = [next(iter(d.values())).shape[0] for d in data]
+        nsteps = max(lengths)
+        batch = DataDict()
+        for k in data[0]:
+            batch[k] = torch.cat([torch.cat([d[k], d[k][-1:].expand(nsteps - n, *d[k].shape[1:])])
+                                  for d, n in zip(data, lengths)], dim=1)
+        steps = torch.arange(nsteps, device=batch[k].device)
+        batch['mask'] = torch.stack([steps < n for n in lengths], dim=1).unsqueeze(-1)
+        batch.name = data[0].name
+        return batch, lengths
+
+    def unpad(self, output, i, nseq, npad):
+        """
+        :param output: (torch.Tensor) Output of a forward pass over a padded batch
+        :param i: (int) Index of the sequence in the batch
+        :param nseq: (int) Number of sequences in the batch
+        :param npad: (int) Number of padded steps at the end of the sequence
+        :return: (torch.Tensor) Output of the i-th sequence as returned by a forward pass over that sequence alone
+        """
+        if output.dim() == 3 and output.shape[1] == nseq:
+            return output[:output.shape[0] - npad, i:i + 1]
+        if output.dim() == 2 and output.shape[0] == nseq:
+            return output[i:i + 1]
+        return output
+
     def simulate(self, data):
+        # sequences, e.g. ExperimentLoops of a memory mapped store, are read once
+        data = list(data)
+        if not self.batched or len(data) == 1 or not isinstance(self.model, Problem):
+            return self.agg([self.model(d) for d in data])
+        batch, lengths = self.pad(data)
+        nsteps = max(lengths)
         outputs = []
-        for d in data:
-            outputs.append(self.model(d))
+        with slim.cached():
+            step_output = self.model.step(batch)
+            for i, n in enumerate(lengths):
+                output_dict = {k: self.unpad(v, i, len(data), nsteps - n)
+                               for k, v in step_output.items() if k != 'mask'}
+                # objectives are evaluated per sequence as in the unbatched simulation
+                output_dict = {**self.model._calculate_loss(output_dict), **output_dict}
+                outputs.append({f'{batch.name}_{k}': v for k, v in output_dict.items()})
         return self.agg(outputs)
 
     def dev_eval(self):
@@ -236,6 +294,170 @@ class ClosedLoopSimulator(Simulator):
                 'Umax': np.concatenate(Umax, 0) if Umax is not None else None}
 
 
+class HistoryBuffer:
+    def __init__(self, nsteps, shape, device='cpu'):
+        """
+        History of the latest nsteps samples kept in a ring buffer of twice the length. Every sample is written twice,
+        so the history in chronological order is always a contiguous, precomputed view and no step copies it.
+
+        :param nsteps: (int) Length of the history
+        :param shape: (tuple of int) Shape of a sample
+        :param device: (str) String identifier of device to keep the buffer on
+        """
+        self.nsteps, self.position = nsteps, nsteps - 1
+        self.buffer = torch.zeros(2 * nsteps, *shape, device=device)
+        self.views = [self.buffer[p + 1:p + 1 + nsteps] for p in range(nsteps)]
+
+    def push(self, sample):
+        """
+        :param sample: (torch.Tensor) Newest sample, replaces the oldest one
+        """
+        self.position = (self.position + 1) % self.nsteps
+        self.buffer[self.position] = sample
+        self.buffer[self.position + self.nsteps] = sample
+
+    def window(self):
+        """
+        :return: (torch.Tensor) View of the history, dims=(nsteps, *shape)
+        """
+        return self.views[self.position]
+
+
+class BatchedClosedLoopSimulator(ClosedLoopSimulator):
+    def __init__(self, model: Problem, dataset: Dataset, emulator: nn.Module = None, device=None):
+        """
+        Closed loop simulation of a batch of independent scenarios (e.g. different references and disturbances)
+        with a single forward pass of the control policy and emulator per time step.
+        Emulator states, Yp and Up history ring buffers and normalization are kept on device as tensors.
+        Emulator must be a neuromancer state space model, e.g. dynamics.BlockSSM, as psl emulators are numpy based.
+
+        :param model: (Problem) Closed loop model returning control actions U_pred
+        :param dataset: (Dataset) Dataset holding min max normalization values
+        :param emulator: (nn.Module) State space model with input_keys (x0, Yf, Uf, Df) to simulate one step at a time
+        :param device: (str) String identifier of device to simulate on. Defaults to the device of the dataset
+        """
+        assert isinstance(emulator, nn.Module), f'{type(emulator)} is not nn.Module.'
+        Simulator.__init__(self, model=model, dataset=dataset, emulator=emulator)
+        self.ninit = 0
+        self.device = torch.device(device if device is not None else getattr(dataset, 'device', 'cpu'))
+        self.x0 = torch.zeros([1, self.emulator.nx])
+        self.norms = {k: torch.tensor(v, dtype=torch.float32, device=self.device)
+                      for k, v in getattr(dataset, 'min_max_norms', dict()).items()}
+
+    def denorm(self, M, name):
+        """
+        On device min max denormalization of sequence name if it was normalized in the dataset.
+
+        :param M: (torch.Tensor) Normalized data
+        :param name: (str) One of 'Y', 'U', 'D'
+        :return: (torch.Tensor) Un-normalized data
+        """
+        if name not in self.dataset.norm:
+            return M
+        return torch.nan_to_num(M * (self.norms[name + 'max'] - self.norms[name + 'min']) + self.norms[name + 'min'])
+
+    def stack_scenarios(self, data):
+        """
+        Stack scenarios along a new batch dimension.
+
+        :param data: (DataDict or list of DataDict, str: 3-d torch.Tensor) dims=(nsteps, nsim, dim)
+        :return: (DataDict, str: 4-d torch.Tensor) dims=(nsteps, nsim, nscenarios, dim)
+        """
+        scenarios = data if isinstance(data, (list, tuple)) else [data]
+        stacked = DataDict({k: torch.stack([torch.as_tensor(d[k]) for d in scenarios], dim=2).float().to(self.device)
+                            for k in scenarios[0]})
+        stacked.name = scenarios[0].name
+        return stacked
+
+    def select_step_data(self, data, i):
+        """
+        Pick the i-th nstep sample of every scenario, the scenarios form the batch dimension.
+
+        :param data: (DataDict, str: 4-d torch.Tensor) dims=(nsteps, nsim, nscenarios, dim)
+        :param i: (int) Simulation step
+        :return: (DataDict, str: 3-d torch.Tensor) dims=(nsteps, nscenarios, dim)
+        """
+        step_data = DataDict({k: v[:, i] for k, v in data.items()})
+        step_data.name = data.name
+        return step_data
+
+    def simulate(self, data, x0=None):
+        """
+        Receding horizon closed loop simulation with the step timing of ClosedLoopSimulator, at each step i > 0:
+          # 1, simulate one step of the emulator for all scenarios with the control actions of step i - 1
+          # 2, forward pass the batch of scenario step data through the model. Measured Yp and Up histories
+               of the data are replaced by the simulated ones once those cover the horizon
+          # 3, select the first control action of each scenario
+          # 4, append emulator outputs and control actions to the Yp and Up history buffers
+
+        :param data: (DataDict or list of DataDict, str: 3-d torch.Tensor) Closed loop data of one or more scenarios
+                     dims=(nsteps, nsim, dim)
+        :param x0: (torch.Tensor) Initial emulator states, dims=(nscenarios, nx). Defaults to zeros
+        :return: (dict, str: torch.Tensor) Un-normalized emulator trajectories of steps 1 to nsim - 1,
+                 dims=(nsim - 1, nscenarios, dim), and model predictions U_pred, dims=(nsteps, nsim, nscenarios, nu)
+        """
+        self.model.eval()
+        self.emulator.eval()
+        data = self.stack_scenarios(data)
+        x_in, y_out, u_in, d_in = self.emulator.input_keys
+        self.nsteps, self.nsim, nscenarios = data['Yp'].shape[:3]
+        x = self.x0.to(self.device).expand(nscenarios, -1) if x0 is None else x0.float().to(self.device)
+
+        Yp = HistoryBuffer(self.nsteps, data['Yp'].shape[2:], device=self.device)
+        Up = HistoryBuffer(self.nsteps, data['Up'].shape[2:], device=self.device) if 'Up' in data else None
+        Y = torch.empty(self.nsim - 1, nscenarios, self.emulator.ny, device=self.device)
+        X = torch.empty(self.nsim - 1, nscenarios, self.emulator.nx, device=self.device)
+        U_pred, U = None, None
+        with torch.no_grad():
+            for i in range(self.nsim):
+                step_data = self.select_step_data(data, i)
+                if i > 0:
+                    # emulator step
+                    emulator_input = {x_in: x, y_out: Yp.window()[:1], u_in: uopt.unsqueeze(0)}
+                    if d_in in step_data:
+                        emulator_input[d_in] = step_data[d_in][:1]
+                    emulator_output = self.emulator(emulator_input)
+                    x = emulator_output[f'X_pred_{self.emulator.name}'][0]
+                    y = emulator_output[f'Y_pred_{self.emulator.name}'][0]
+                    X[i - 1], Y[i - 1] = x, y
+                # simulated histories replace the measured ones once they span the horizon
+                if i > self.nsteps + 1:
+                    step_data['Yp'] = Yp.window()
+                if Up is not None and i > self.nsteps:
+                    step_data['Up'] = Up.window()
+
+                # control policy model
+                step_output = self.model(step_data)
+                u_pred = step_output[[k for k in step_output.keys() if 'U_pred' in k][0]]
+                uopt = u_pred[0]
+                if U_pred is None:
+                    U_pred = torch.empty(u_pred.shape[0], self.nsim, *u_pred.shape[1:], device=self.device)
+                    U = torch.empty(self.nsim - 1, *uopt.shape, device=self.device)
+                U_pred[:, i] = u_pred
+                if i > 0:
+                    U[i - 1] = uopt
+                    Yp.push(y)
+                if Up is not None:
+                    Up.push(uopt)
+
+        output = {'X': X, 'Y': self.denorm(Y, 'Y'), 'U': self.denorm(U, 'U'), 'U_pred': U_pred}
+        for k, name in [('Df', 'D'), ('Rf', 'Y'), ('Y_minf', 'Y'), ('Y_maxf', 'Y'), ('U_minf', 'U'), ('U_maxf', 'U')]:
+            if k in data:
+                output[k[:-1].replace('_', '')] = self.denorm(data[k][0, 1:], name)
+        return output
+
+    def test_eval(self):
+        """
+        Closed loop simulation of the test loop. ClosedLoopSimulator.test_eval simulates the train, dev and test loops
+        in turn and keeps the trajectories of the last one, which are returned here in the same format.
+
+        :return: (dict, str: np.array) Un-normalized emulator trajectories, dims=(nsim - 1, dim),
+                 and (dict, str: torch.Tensor) model predictions U_pred, dims=(nsteps, nsim, nu)
+        """
+        output = self.simulate(self.dataset.test_loop)
+        return {k: v[:, :, 0] if k == 'U_pred' else v[:, 0].cpu().numpy() for k, v in output.items()}
+
+
 if __name__ == '__main__':
 
     systems = {'Reno_full': 'emulator'}
@@ -0,0 +1,179 @@
+"""
+In-process hyperparameter sweeps over the training scripts.
+
+A training script module exposes parse(), dataset_load(args, device) and run(args, dataset) as
+train_scripts/system_id.py and train_scripts/base_control_flexy.py do. Datasets are loaded once per distinct
+setting of the script's DATA PARAMETERS and shared with a pool of worker processes, runs are scheduled over the
+available cores and successive halving stops poorly performing configurations early.
+
+    configs = grid(linear_map=['linear', 'pf'], nsteps=[8, 16])
+    results = Sweep('neuromancer.train_scripts.system_id', configs, base={'system': 'flexy_air'},
+                    nsamples=10, min_epochs=100).run()
+"""
+# python base imports
+import os
+import math
+import json
+import random
+import itertools
+import importlib
+import multiprocessing as mp
+
+# machine learning/data science imports
+import torch
+import numpy as np
+
+# datasets by script and data parameters, loaded in the parent process and inherited by forked workers
+datasets = dict()
+
+
+def grid(**space):
+    """
+    Cartesian product of hyperparameter values.
+
+    grid(linear_map=['linear', 'pf'], nsteps=[8, 16]) -> [{'linear_map': 'linear', 'nsteps': 8}, ...]
+
+    :param space: (dict {str: list}) Values for each command line argument of a training script
+    :return: (list of dict)
+    """
+    return [dict(zip(space.keys(), values)) for values in itertools.product(*space.values())]
+
+
+def to_argv(config):
+    """
+    Command line arguments of a configuration. True values become flags, False and None are left out.
+
+    :param config: (dict {str: object})
+    :return: (list of str)
+    """
+    argv = []
+    for k, v in config.items():
+        if v is True:
+            argv.append(f'-{k}')
+        elif v is not False and v is not None:
+            argv += [f'-{k}'] + ([str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)])
+    return argv
+
+
+def data_key(script, parser, args):
+    """
+    Runs whose DATA PARAMETERS agree share a dataset.
+
+    :param script: (str) Module name of the training script
+    :param parser: (argparse.ArgumentParser) Returned by the script's parse()
+    :param args: (Namespace) Arguments of a run
+    :return: (tuple)
+    """
+    dests = [action.dest for group in parser._action_groups if group.title == 'DATA PARAMETERS'
+             for action in group._group_actions]
+    return (script,) + tuple((k, str(getattr(args, k))) for k in dests)
+
+
+def dataset_load(module, args):
+    device = f'cuda:{args.gpu}' if getattr(args, 'gpu', None) is not None else 'cpu'
+    return module.dataset_load(args, device)
+
+
+def init_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def train(job):
+    """
+    Trains one run in a worker process.
+
+    :param job: (tuple) Run index, script module name, command line arguments, dataset key and random seed
+    :return: (tuple) Run index and scalar metrics of the run, best_devloss is inf for failed or diverged runs
+    """
+    k, script, argv, key, seed = job
+    module = importlib.import_module(script)
+    args = module.parse().parse_args(argv)
+    if key not in datasets:
+        datasets[key] = dataset_load(module, args)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        output = module.run(args, datasets[key])
+    except Exception as e:
+        output = {'best_devloss': math.inf, 'error': repr(e)}
+    # runs whose dev metric never improved on its initial value, e.g. nan losses, rank last
+    if not math.isfinite(output['best_devloss']) or output['best_devloss'] >= np.finfo(np.float32).max:
+        output['best_devloss'] = math.inf
+    return k, output
+
+
+class Sweep:
+    def __init__(self, script='neuromancer.train_scripts.system_id', configs=(dict(),), base=dict(),
+                 savedir='sweep', nsamples=1, nprocs=None, threads=1, min_epochs=None, eta=3):
+        """
+        :param script: (str) Module name of the training script
+        :param configs: (list of dict) Arguments of each configuration, e.g. from grid, overriding base
+        :param base: (dict) Arguments shared by all configurations. The number of epochs is the budget of a full run.
+        :param savedir: (str) Folder for the runs, run k writes to savedir/run_k and results go to savedir/results.json
+        :param nsamples: (int) Number of random seeds per configuration
+        :param nprocs: (int) Number of worker processes, defaults to the number of cores divided by threads
+        :param threads: (int) Number of torch threads per worker
+        :param min_epochs: (int) Epoch budget of the first successive halving rung. Each rung keeps the best 1/eta
+                           of the runs and multiplies their budget by eta until the full epochs are reached.
+                           Runs continue from their resume checkpoints. None trains every run for the full epochs.
+        :param eta: (int) Reduction factor of successive halving
+        """
+        self.script = script
+        self.configs = list(configs)
+        self.base = base
+        self.savedir = savedir
+        self.nsamples = nsamples
+        self.threads = threads
+        self.nprocs = max(1, (os.cpu_count() or 1) // threads) if nprocs is None else nprocs
+        self.min_epochs = min_epochs
+        self.eta = eta
+
+    def runs(self):
+        """
+        :return: (list of tuple) Configuration, seed and command line arguments of every run
+        """
+        runs = []
+        for config in self.configs:
+            for seed in range(self.nsamples):
+                savedir = os.path.join(self.savedir, f'run_{len(runs)}')
+                runs.append((config, seed, to_argv({**self.base, **config, 'savedir': savedir})))
+        return runs
+
+    def run(self):
+        """
+        Loads the datasets, trains all runs over a process pool and writes the results.
+
+        :return: (list of dict) Configuration, seed, trained epochs and metrics of every run, best runs first
+        """
+        module = importlib.import_module(self.script)
+        parser = module.parse()
+        runs = self.runs()
+        keys = []
+        for config, seed, argv in runs:
+            args = parser.parse_args(argv)
+            keys.append(data_key(self.script, parser, args))
+            if keys[-1] not in datasets:
+                datasets[keys[-1]] = dataset_load(module, args)
+        epochs = parser.parse_args(runs[0][2]).epochs
+
+        context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        results = [dict() for _ in runs]
+        alive, budget = list(range(len(runs))), min(self.min_epochs or epochs, epochs)
+        with context.Pool(self.nprocs, initializer=init_worker, initargs=(self.threads,)) as pool:
+            while True:
+                jobs = [(k, self.script, runs[k][2] + ['-epochs', str(budget), '-resume_every', str(epochs)],
+                         keys[k], runs[k][1]) for k in alive]
+                for k, output in pool.imap_unordered(train, jobs):
+                    results[k] = {'epochs': budget, **output}
+                if budget >= epochs:
+                    break
+                alive = sorted(alive, key=lambda k: results[k]['best_devloss'])[:max(1, len(alive) // self.eta)]
+                budget = min(budget * self.eta, epochs)
+
+        results = [{'config': config, 'seed': seed, **output} for (config, seed, argv), output in zip(runs, results)]
+        results = sorted(results, key=lambda r: (-r['epochs'], r['best_devloss']))
+        os.makedirs(self.savedir, exist_ok=True)
+        with open(os.path.join(self.savedir, 'results.json'), 'w') as f:
+            json.dump(results, f, indent=1)
+        return results
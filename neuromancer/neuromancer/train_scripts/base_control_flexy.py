@@ -28,8 +28,10 @@ More detailed description of options in the parse_args()
 # python base imports
 import argparse
 import dill
+import os
 import glob
 import random
+from copy import deepcopy
 # machine learning data science imports
 import numpy as np
 import torch
@@ -44,13 +46,14 @@ from neuromancer.datasets import EmulatorDataset, FileDataset, systems
 import neuromancer.loggers as loggers
 from neuromancer.visuals import VisualizerClosedLoop
 from neuromancer.activations import BLU, SoftExponential
-from neuromancer.simulators import ClosedLoopSimulator
+from neuromancer.simulators import ClosedLoopSimulator, BatchedClosedLoopSimulator
 import neuromancer.policies as policies
 from neuromancer.problem import Objective, Problem
 from neuromancer.trainer import Trainer
+from neuromancer.checkpoints import CheckpointManager
+import neuromancer.runtime as runtime
 import psl
-from neuromancer.datasets import normalize
-from neuromancer.signals import SignalGeneratorDynamics
+from neuromancer.signals import SignalGeneratorDynamics, WhiteNoisePeriodicGenerator
 
 
 def parse():
@@ -70,6 +73,15 @@ def parse():
                            help='Number of epochs to wait before enacting early stopping policy.')
     opt_group.add_argument('-skip_eval_sim', action='store_true',
                            help='Whether to run simulator during evaluation phase of training.')
+    opt_group.add_argument('-eval_every', type=int, default=1,
+                           help='Number of epochs between dev evaluations.')
+    opt_group.add_argument('-eval_budget', type=float, default=None,
+                           help='Maximum fraction of wall time spent in dev evaluations.')
+    opt_group.add_argument('-async_eval', action='store_true',
+                           help='Whether to run dev evaluations on weight snapshots in a background thread.')
+    opt_group.add_argument('-sequential_sim', action='store_true',
+                           help='Whether to simulate the closed loop one sample at a time in numpy '
+                                'instead of batched on device.')
     #################
     # DATA PARAMETERS
     data_group = parser.add_argument_group('DATA PARAMETERS')
@@ -167,6 +179,12 @@ def parse():
                            help='Whether to create visuals, e.g. animations during training loop')
     log_group.add_argument('-trace_movie', action='store_true',
                            help='Whether to plot an animation of the simulated and true dynamics')
+    log_group.add_argument('-resume_every', type=int, default=None,
+                           help='Number of epochs between writes of the full training state to savedir. '
+                                'Training resumes from it automatically when the run is restarted.')
+    log_group.add_argument('-export', action='store_true',
+                           help='Whether to write the trained estimator and policy to savedir/controller.ts, '
+                                'a TorchScript artifact loaded by neuromancer.runtime without the training stack')
     return parser
 
 
@@ -179,12 +197,15 @@ def logging(args):
     else:
         Logger = loggers.BasicLogger(args=args, savedir=args.savedir, verbosity=args.verbosity,
                                      stdout=('nstep_dev_loss', 'loop_dev_loss', 'best_loop_dev_loss',
-                                             'nstep_dev_ref_loss', 'loop_dev_ref_loss'), id=args.id)
+                                             'nstep_dev_ref_loss', 'loop_dev_ref_loss'))
     device = f'cuda:{args.gpu}' if (args.gpu is not None) else 'cpu'
     return Logger, device
 
 
 def dataset_load(args, device):
+    if getattr(args, 'ny', None) is None:
+        args.ny = torch.load(args.model_file, pickle_module=dill,
+                             map_location=torch.device(device)).components[1].fy.out_features
     if systems[args.system] == 'emulator':
         dataset = EmulatorDataset(system=args.system, nsim=args.nsim,
                                   norm=args.norm, nsteps=args.nsteps, device=device, savedir=args.savedir,
@@ -227,127 +248,10 @@ class NoiseGenerator(nn.Module):
     def forward(self, data):
         noisy_data = dict()
         for key in self.keys:
-            noisy_data[key+self.name] = data[key] + self.ratio*torch.randn(data[key].shape)
+            noisy_data[key+self.name] = data[key] + self.ratio*torch.randn_like(data[key])
         return noisy_data
 
 
-class SignalGenerator(nn.Module):
-
-    def __init__(self, nsteps, nx, xmax, xmin, name='signal', device='cpu'):
-        super().__init__()
-        self.nsteps, self.nx = nsteps, nx
-        self.xmax, self.xmin, self.name = xmax, xmin, name
-        self.iter = 0
-        self.nsim = None
-        self.device = device
-
-    def get_xmax(self):
-        return self.xmax
-
-    def get_xmin(self):
-        return self.xmin
-# nstep X nsamples x nfeatures
-#
-#     end_step = data.shape[0] - nsteps
-#     data = np.asarray([data[k:k+nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-#     return data.transpose(1, 0, 2)  # nsteps X nsamples X nfeatures
-
-    def forward(self, data):
-        key = list(data.keys())[0]
-        self.nsim = data[key].shape[1] * data[key].shape[0] + self.nsteps
-        nbatch = data[key].shape[1]
-
-        xmax, xmin = self.get_xmax(), self.get_xmin()
-        R = self.sequence_generator(self.nsim, xmax, xmin)
-        R, _, _ = normalize(R)
-
-        Rp, Rf = R[:-self.nsteps], R[self.nsteps:]
-
-        if self.iter == 0:
-            self.nstep_batch_size = nbatch
-        if nbatch == self.nstep_batch_size:
-            Rp = torch.tensor(Rp, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1).to()
-            Rf = torch.tensor(Rf, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1)
-        else:
-            end_step = Rp.shape[0] - self.nsteps
-            Rp = np.asarray([Rp[k:k+self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rp = torch.tensor(Rp.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
-            Rf = np.asarray([Rf[k:k + self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rf = torch.tensor(Rf.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
-        return {self.name + 'p': Rp.to(self.device), self.name + 'f': Rf.to(self.device)}
-
-
-class WhiteNoisePeriodicGenerator(SignalGenerator):
-
-    def __init__(self, nsteps, nx, xmax=(0.5, 0.1), xmin=0.0, min_period=5, max_period=30, name='period', device='cpu'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device)
-        self.min_period = min_period
-        self.max_period = max_period
-        self.white_noise_generator = lambda nsim, xmin, xmax: psl.WhiteNoise(nx=self.nx, nsim=nsim,
-                                                                             xmax=xmax, xmin=xmin)[:nsim]
-        self.period_generator = lambda nsim, xmin, xmax: psl.Periodic(nx=self.nx, nsim=nsim,
-                                                                      numPeriods=random.randint(self.min_period, self.max_period),
-                                                                      xmax=xmax, xmin=xmin)[:nsim]
-        # self.sequence_generator = lambda nsim, xmin, xmax: self.period_generator(nsim, xmin, xmax) + self.white_noise_generator(nsim, -0.1*xmax, 0.1*xmax)
-        self.sequence_generator = lambda nsim, xmin, xmax: self.period_generator(nsim, xmin, xmax) + self.white_noise_generator(nsim, xmin, 1.0 - xmax)
-
-    def get_xmax(self):
-        return random.uniform(*self.xmax)
-
-
-    def forward(self, data):
-        key = list(data.keys())[0]
-        self.nsim = data[key].shape[1] * data[key].shape[0] + self.nsteps
-        nbatch = data[key].shape[1]
-
-        if self.max_period > self.nsim:
-            self.max_period = self.nsim
-        if self.min_period > self.nsim:
-            self.min_period = self.nsim
-
-        xmax, xmin = self.get_xmax(), self.get_xmin()
-        R = self.sequence_generator(self.nsim, xmax, xmin)
-        R, _, _ = normalize(R)
-
-        Rp, Rf = R[:-self.nsteps], R[self.nsteps:]
-
-        if self.iter == 0:
-            self.nstep_batch_size = nbatch
-        if nbatch == self.nstep_batch_size:
-            Rp = torch.tensor(Rp, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1).to()
-            Rf = torch.tensor(Rf, dtype=torch.float32).view(nbatch, -1, self.nx).transpose(0, 1)
-        else:
-            end_step = Rp.shape[0] - self.nsteps
-            Rp = np.asarray([Rp[k:k+self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rp = torch.tensor(Rp.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
-            Rf = np.asarray([Rf[k:k + self.nsteps, :] for k in range(0, end_step)])  # nchunks X nsteps X nfeatures
-            Rf = torch.tensor(Rf.transpose(1, 0, 2), dtype=torch.float32)  # nsteps X nsamples X nfeatures
-        return {self.name + 'p': Rp.to(self.device), self.name + 'f': Rf.to(self.device)}
-
-
-class PeriodicGenerator(SignalGenerator):
-
-    def __init__(self, nsteps, nx, xmax, xmin, min_period=5, max_period=30, name='period', device='cpu'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device)
-        self.min_period = min_period
-        self.max_period = max_period
-        self.sequence_generator = lambda nsim, xmin, xmax: psl.Periodic(nx=self.nx, nsim=nsim, numPeriods=random.randint(self.min_period, self.max_period),
-                                                            xmax=xmax, xmin=xmin)
-
-class WhiteNoiseGenerator(SignalGenerator):
-    def __init__(self, nsteps, nx, xmax, xmin, name='period', device='cpu'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device)
-        self.sequence_generator = lambda nsim, xmin, xmax: psl.WhiteNoise(nx=self.nx, nsim=nsim,
-                                                              xmax=xmax, xmin=xmin)
-
-class AddGenerator(SignalGenerator):
-    def __init__(self, SG1, SG2, nsteps, nx, xmax, xmin, name='period', device='cpu'):
-        super().__init__(nsteps, nx, xmax, xmin, name=name, device=device)
-        assert SG1.nsteps == SG2.nsteps, 'Nsteps must match to compose sequence generators'
-        assert SG1.nx == SG2.nx, 'Nx must match to compose sequence generators'
-        self.sequence_generator = lambda nsim: SG1.sequence_generator(nsim) + SG2.sequence_generator(nsim)
-
-
 def freeze_weight(model, module_names=['']):
     """
     ['parent->child->child']
@@ -382,12 +286,35 @@ def unfreeze_weight(model, module_names=['']):
             freeze_weight(parent, ['->'.join(freeze_path[1:])])
 
 
+def export_controller(path, estimator, policy, example):
+    """
+    Writes the estimator and policy as a runtime artifact reading raw measurements,
+    as test_policy_flexy runs them on the device. The trained components keep their input keys.
+
+    :param path: (str) File to write
+    :param estimator: (nn.Module) Trained state estimator
+    :param policy: (nn.Module) Trained control policy
+    :param example: (dict {str: Tensor}) Example inputs of a single sample
+    :return: (dict) Spec of the artifact, the control plan U_pred_policy is its first output
+    """
+    estimator, policy = deepcopy(estimator), deepcopy(policy)
+    estimator.input_keys[0] = 'Yp'
+    policy.input_keys[0] = 'Yp'
+    return runtime.export(path, [estimator, policy], example,
+                          outputs=[f'U_pred_{policy.name}', f'x0_{estimator.name}'])
 
-if __name__ == '__main__':
+
+def run(args, dataset=None):
+    """
+    Trains and evaluates a control policy for one configuration.
+
+    :param args: Namespace returned by parse().parse_args()
+    :param dataset: Optional dataset loaded by dataset_load beforehand, e.g. shared by the runs of a sweep
+    :return: (dict {str: float}) Scalar metrics of the best policy, best_devloss is its eval_metric
+    """
     ###############################
     ########## LOGGING ############
     ###############################
-    args = parse().parse_args()
     logger, device = logging(args)
     # device = 'cuda:0'
 
@@ -397,7 +324,8 @@ if __name__ == '__main__':
     # Learned dynamics system ID model setup
     load_model = torch.load(args.model_file, pickle_module=dill, map_location=torch.device(device))
     args.ny = load_model.components[1].fy.out_features
-    dataset = dataset_load(args, device)
+    if dataset is None:
+        dataset = dataset_load(args, device)
     print(dataset.dims)
     for k in range(len(load_model.components)):
         if load_model.components[k].name == 'dynamics':
@@ -511,12 +439,20 @@ if __name__ == '__main__':
     emulator = dynamics_model
     # TODO: hacky solution for policy input keys compatibility with simulator
     policy.input_keys[0] = 'Yp'
-    simulator = ClosedLoopSimulator(model=model, dataset=dataset, emulator=emulator, policy=policy)
+    simulator = (ClosedLoopSimulator if args.sequential_sim else BatchedClosedLoopSimulator)(
+        model=model, dataset=dataset, emulator=emulator)
     trainer = Trainer(model, dataset, optimizer, logger=logger, visualizer=visualizer,
                       simulator=simulator, epochs=args.epochs,
-                      patience=args.patience, warmup=args.warmup)
+                      patience=args.patience, warmup=args.warmup,
+                      eval_every=args.eval_every, eval_budget=args.eval_budget, async_eval=args.async_eval,
+                      checkpoint=CheckpointManager(model, savedir=args.savedir, resume_every=args.resume_every))
     best_model = trainer.train()
-    trainer.evaluate(best_model)
+    output = trainer.evaluate(best_model)
+    if args.export:
+        model.load_state_dict(best_model)
+        example = {k: v[:, :1] for k, v in dataset.dev_data.items()}
+        export_controller(os.path.join(args.savedir, 'controller.ts'), estimator, policy, example)
+        logger.log_artifacts(dict())
     logger.log_metrics({'alive': 0.0})
     logger.clean_up()
 
@@ -526,6 +462,12 @@ if __name__ == '__main__':
         torch.save(model.components[2], './test/best_policy_flexy.pth', pickle_module=dill)
         torch.save(model.components[1], './test/best_estimator_flexy.pth', pickle_module=dill)
         torch.save(model.components[3], './test/best_dynamics_flexy.pth', pickle_module=dill)
+    return {'best_devloss': float(trainer.best_devloss),
+            **{k: v.item() for k, v in output.items() if isinstance(v, torch.Tensor) and v.dim() == 0}}
+
+
+if __name__ == '__main__':
+    run(parse().parse_args())
 
 # TODO: add noiser to control action
 # TODO: UQ via ensemble methods
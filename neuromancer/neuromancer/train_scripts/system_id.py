@@ -35,14 +35,16 @@ import torch.nn as nn
 import slim
 
 # local imports
-from neuromancer.datasets import EmulatorDataset, FileDataset, systems
+from neuromancer.datasets import EmulatorDataset, FileDataset, systems, plot_policies
 import neuromancer.dynamics as dynamics
 import neuromancer.estimators as estimators
 import neuromancer.blocks as blocks
+import neuromancer.rnn as rnn
 import neuromancer.loggers as loggers
-from neuromancer.visuals import VisualizerOpen, VisualizerTrajectories
+from neuromancer.visuals import Visualizer, VisualizerOpen, VisualizerTrajectories
 from neuromancer.trainer import Trainer
-from neuromancer.problem import Problem, Objective
+from neuromancer.checkpoints import CheckpointManager
+from neuromancer.problem import Problem, Objective, Ensemble
 from neuromancer.activations import BLU, SoftExponential
 from neuromancer.simulators import OpenLoopSimulator
 
@@ -70,6 +72,18 @@ def parse():
                            help='Number of epochs to wait before enacting early stopping policy.')
     opt_group.add_argument('-skip_eval_sim', action='store_true',
                            help='Whether to run simulator during evaluation phase of training.')
+    opt_group.add_argument('-batch_size', type=int, default=None,
+                           help='Number of nstep samples per mini-batch. None trains on the full batch.')
+    opt_group.add_argument('-accumulate', type=int, default=1,
+                           help='Number of mini-batches to accumulate gradients over per optimizer step.')
+    opt_group.add_argument('-eval_every', type=int, default=1,
+                           help='Number of epochs between dev evaluations.')
+    opt_group.add_argument('-eval_budget', type=float, default=None,
+                           help='Maximum fraction of wall time spent in dev evaluations.')
+    opt_group.add_argument('-async_eval', action='store_true',
+                           help='Whether to run dev evaluations on weight snapshots in a background thread.')
+    opt_group.add_argument('-ema_decay', type=float, default=None,
+                           help='Decay of an exponential moving average of the weights saved alongside the best model.')
 
     #################
     # DATA PARAMETERS
@@ -86,6 +100,15 @@ def parse():
                                  'None will use a default nsim from the selected dataset or emulator')
     data_group.add_argument('-norm', nargs='+', default=['U', 'D', 'Y'], choices=['U', 'D', 'Y'],
                             help='List of sequences to max-min normalize')
+    data_group.add_argument('-stream_data', action='store_true',
+                            help='Whether to memory map nstep training data from disk and only '
+                                 'move mini-batches to device during training.')
+    data_group.add_argument('-data_cache', type=str, default=None,
+                            help='Directory of the preprocessed dataset cache shared between runs. '
+                                 'None disables caching.')
+    data_group.add_argument('-data_plots', type=str, default='eager', choices=plot_policies,
+                            help='Plotting policy of dataset sequences: plot during construction, '
+                                 'render in a background thread, after training, or never.')
     
     ##################
     # MODEL PARAMETERS
@@ -103,6 +126,11 @@ def parse():
     model_group.add_argument('-nonlinear_map', type=str, default='residual_mlp',
                              choices=['mlp', 'rnn', 'pytorch_rnn', 'linear', 'residual_mlp'])
     model_group.add_argument('-bias', action='store_true', help='Whether to use bias in the neural network models.')
+    model_group.add_argument('-ensemble', type=int, default=1,
+                             help='Number of randomly initialized models trained at once as a vectorized ensemble.')
+    model_group.add_argument('-compile_rnn', action='store_true',
+                             help='Whether to compile the hidden state recurrence of RNN estimators and maps '
+                                  'with torch.compile. Not applied to ensembles.')
     model_group.add_argument('-activation', choices=['relu', 'gelu', 'blu', 'softexp'], default='gelu',
                              help='Activation function for neural networks')
 
@@ -136,6 +164,11 @@ def parse():
                            help='Whether to create visuals, e.g. animations during training loop')
     log_group.add_argument('-trace_movie', action='store_true',
                            help='Whether to plot an animation of the simulated and true dynamics')
+    log_group.add_argument('-checkpoint_every', type=int, default=None,
+                           help='Number of epochs between background writes of the best weights to savedir.')
+    log_group.add_argument('-resume_every', type=int, default=None,
+                           help='Number of epochs between writes of the full training state to savedir. '
+                                'Training resumes from it automatically when the run is restarted.')
     return parser
 
 
@@ -156,29 +189,29 @@ def logging(args):
 def dataset_load(args, device):
     if systems[args.system] == 'emulator':
         dataset = EmulatorDataset(system=args.system, nsim=args.nsim,
-                                  norm=args.norm, nsteps=args.nsteps, device=device, savedir=args.savedir)
+                                  norm=args.norm, nsteps=args.nsteps, device=device, savedir=args.savedir,
+                                  cache=args.data_cache, plot=args.data_plots)
     else:
         dataset = FileDataset(system=args.system, nsim=args.nsim,
-                              norm=args.norm, nsteps=args.nsteps, device=device, savedir=args.savedir)
+                              norm=args.norm, nsteps=args.nsteps, device=device, savedir=args.savedir,
+                              cache=args.data_cache, plot=args.data_plots)
+    if args.stream_data:
+        dataset.stream_train_data()
     return dataset
 
 
-if __name__ == '__main__':
-    ###############################
-    ########## LOGGING ############
-    ###############################
-    args = parse().parse_args()
-    print({k: str(getattr(args, k)) for k in vars(args) if getattr(args, k)})
-    logger, device = logging(args)
+def problem_build(args, dataset, device):
+    """
+    Builds the state estimator, dynamics model and multi-objective loss of a configuration.
 
-    ###############################
-    ########## DATA ###############
-    ###############################
-    dataset = dataset_load(args, device)
+    :param args: Namespace returned by parse().parse_args()
+    :param dataset: Dataset returned by dataset_load
+    :param device: (str)
+    :return: (Problem)
+    """
     ##########################################
     ########## PROBLEM COMPONENTS ############
     ##########################################
-    print(dataset.dims)
     nx = dataset.dims['Y'][-1]*args.nx_hidden
 
     activation = {'gelu': nn.GELU,
@@ -260,18 +293,63 @@ if __name__ == '__main__':
             disturbances_max_influence_ub = Objective([f'fD_dynamics'], lambda x: torch.mean(F.relu(x - dxudmax)),
                                                       weight=args.Q_con_fdu, name='dist_influence_ub')
             constraints += [disturbances_max_influence_lb, disturbances_max_influence_ub]
+    return Problem(objectives, constraints, components).to(device)
+
+
+def run(args, dataset=None):
+    """
+    Trains and evaluates a model for one configuration.
+
+    :param args: Namespace returned by parse().parse_args()
+    :param dataset: Optional dataset loaded by dataset_load beforehand, e.g. shared by the runs of a sweep
+    :return: (dict {str: float}) Scalar metrics of the best model, best_devloss is its eval_metric
+    """
+    ###############################
+    ########## LOGGING ############
+    ###############################
+    logger, device = logging(args)
 
+    ###############################
+    ########## DATA ###############
+    ###############################
+    if dataset is None:
+        dataset = dataset_load(args, device)
+    print(dataset.dims)
     ##########################################
     ########## OPTIMIZE SOLUTION ############
     ##########################################
-    model = Problem(objectives, constraints, components).to(device)
+    if args.ensemble > 1:
+        model = Ensemble([problem_build(args, dataset, device) for _ in range(args.ensemble)])
+        visualizer = Visualizer()
+    else:
+        model = problem_build(args, dataset, device)
+        if args.compile_rnn:
+            # fused tanh and relu RNNs do not use the recurrence and are left as they are
+            for module in model.modules():
+                if isinstance(module, rnn.RNN):
+                    rnn.compile_rnn(module)
+        visualizer = VisualizerOpen(dataset, model.components[1], args.verbosity, args.savedir,
+                                    training_visuals=args.train_visuals, trace_movie=args.trace_movie)
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
-    visualizer = VisualizerOpen(dataset, dynamics_model, args.verbosity, args.savedir,
-                                training_visuals=args.train_visuals, trace_movie=args.trace_movie)
     simulator = OpenLoopSimulator(model=model, dataset=dataset, eval_sim=not args.skip_eval_sim)
     trainer = Trainer(model, dataset, optimizer, logger=logger, visualizer=visualizer,
                       simulator=simulator, epochs=args.epochs, eval_metric=args.eval_metric,
-                      patience=args.patience, warmup=args.warmup)
+                      patience=args.patience, warmup=args.warmup,
+                      batch_size=args.batch_size, accumulate=args.accumulate,
+                      eval_every=args.eval_every, eval_budget=args.eval_budget, async_eval=args.async_eval,
+                      checkpoint=CheckpointManager(model, ema_decay=args.ema_decay,
+                                                   savedir=args.savedir, every=args.checkpoint_every,
+                                                   resume_every=args.resume_every))
     best_model = trainer.train()
-    trainer.evaluate(best_model)
+    output = trainer.evaluate(best_model)
+    # deferred and background dataset plots are written once training is done
+    dataset.save_plots()
     logger.clean_up()
+    return {'best_devloss': float(trainer.best_devloss),
+            **{k: v.item() for k, v in output.items() if isinstance(v, torch.Tensor) and v.dim() == 0}}
+
+
+if __name__ == '__main__':
+    args = parse().parse_args()
+    print({k: str(getattr(args, k)) for k in vars(args) if getattr(args, k)})
+    run(args)
@@ -20,6 +20,7 @@ import torch
 # local imports
 from neuromancer.plot import pltCL, pltOL
 from neuromancer.datasets import FileDataset
+import neuromancer.runtime as runtime
 import psl
 
 
@@ -28,6 +29,9 @@ def parse():
     parser.add_argument('-ref_type', type=str, default='periodic', choices=['steps', 'periodic'],
                         help="shape of the reference signal")
     parser.add_argument('-dynamic_constraints', type=int, default=0, choices=[0, 1])
+    parser.add_argument('-artifact', type=str, default=None,
+                        help='Controller artifact written by neuromancer.runtime.export '
+                             'to use in place of the pickled estimator and policy')
     return parser
 
 
@@ -130,6 +134,7 @@ if __name__ == '__main__':
         policy.input_keys[0] = 'Yp'
 
     HW_emulator = Simulator(estimator=estimator, dynamics=dynamics)
+    controller = runtime.load(args.artifact) if args.artifact is not None else None
 
     # dataset
     nsim = 3000
@@ -163,22 +168,25 @@ if __name__ == '__main__':
     pltCL(Y=np.asarray(Y), R=dataset.data['Y'][:,:1], U=np.asarray(U))
 
     # Closed loop
-    yN = torch.zeros(nsteps, 1, 1)
+    # preview signals, the runtime keeps windows of nsteps samples of them in ring buffers
+    previews = {'Y_minf': bounds_reference['Y_min'], 'Y_maxf': bounds_reference['Y_max'],
+                'Rf': bounds_reference['R'], 'Df': dataset.data['D']}
+    previews = {k: torch.tensor(v).float().reshape(nsim, 1, -1) for k, v in previews.items()}
+    example = {'Yp': torch.zeros(nsteps, 1, ny), **{k: v[:nsteps] for k, v in previews.items()}}
+    mpc = runtime.MPCRuntime(controller if controller is not None else [estimator, policy],
+                             example=example, outputs=['U_pred_policy'], warmup=100, budget=1e-3)
+    previews = {k: v for k, v in previews.items() if k in mpc.input_keys}
+    for key, v in previews.items():
+        mpc.fill(key, v[:nsteps])
     Y, U, R = [], [], []
     Ymin, Ymax, Umin, Umax = [], [], [], []
     for k in range(nsim-nsteps):
         y, x = HW_emulator.get_state()
-        yN = torch.cat([yN, y])[1:]
-        estim_out = estimator({'Yp': yN})
-        features = {'x0_estim': estim_out['x0_estim'], 'Yp': yN,
-                    'Y_minf': torch.tensor(bounds_reference['Y_min'][k:nsteps + k]).float().reshape(nsteps, 1, -1),
-                    'Y_maxf': torch.tensor(bounds_reference['Y_max'][k:nsteps + k]).float().reshape(nsteps, 1, -1),
-                    'Rf': torch.tensor(bounds_reference['R'][k:nsteps+k]).float().reshape(nsteps,1,-1),
-                    'Df': torch.tensor(dataset.data['D'][k:nsteps+k]).float().reshape(nsteps,1,-1)}
-        policy_out = policy(features)
-        uopt = policy_out['U_pred_policy'][0].reshape(1,1,-1).float()
+        # the preview windows advance by their newest sample once the loop is past the initial window
+        samples = {key: v[nsteps + k - 1] for key, v in previews.items()} if k > 0 else dict()
+        uopt = mpc.step({'Yp': y.reshape(1, -1), **samples}).reshape(1, 1, -1)
         d = torch.tensor(dataset.data['D'][k]).reshape(1,1,-1).float()
-        HW_emulator.send_control(uopt, d=d, Y=yN, x=x)
+        HW_emulator.send_control(uopt, d=d, Y=mpc.window('Yp'), x=x)
         U.append(uopt.detach().numpy().reshape(-1))
         Y.append(y.detach().numpy().reshape(-1))
         R.append(bounds_reference['R'][k])
@@ -188,4 +196,5 @@ if __name__ == '__main__':
         Umin.append(bounds_reference['U_min'][k])
     pltCL(Y=np.asarray(Y), R=np.asarray(R), U=np.asarray(U),
           Ymin=np.asarray(Ymin), Ymax=np.asarray(Ymax),
-          Umin=np.asarray(Umin), Umax=np.asarray(Umax))
\ No newline at end of file
+          Umin=np.asarray(Umin), Umax=np.asarray(Umax))
+    print(f'control update latency: {mpc.latency()}')
\ No newline at end of file
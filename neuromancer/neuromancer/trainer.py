@@ -3,6 +3,8 @@
 """
 # python base imports
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 # machine learning/data science imports
 import torch
@@ -13,8 +15,9 @@ import numpy as np
 from neuromancer.loggers import BasicLogger
 from neuromancer.visuals import Visualizer
 from neuromancer.problem import Problem
-from neuromancer.datasets import Dataset
+from neuromancer.datasets import Dataset, batch_iterator, get_batch, nstep_samples
 from neuromancer.simulators import Simulator
+from neuromancer.checkpoints import CheckpointManager, rng_state, set_rng_state
 
 
 def reset(module):
@@ -23,6 +26,31 @@ def reset(module):
             mod.reset()
 
 
+def merge_outputs(outputs, sizes):
+    """
+    Combines model outputs of consecutive chunks of an nstep dataset into the output of the whole dataset.
+    Scalar metrics are averaged weighted by the chunk sizes, sequences dims=(nsteps, nsamples, dim) are concatenated
+    along the sample dimension and per sample tensors dims=(nsamples, dim) along the first dimension.
+    Other entries, e.g. parameters, are taken from the last chunk.
+
+    :param outputs: (list of dict {str: Tensor}) Outputs of the chunks in order
+    :param sizes: (list of int) Number of samples of each chunk
+    :return: (dict {str: Tensor})
+    """
+    merged = dict(outputs[-1])
+    for k, v in outputs[0].items():
+        if not isinstance(v, torch.Tensor):
+            continue
+        values = [output[k] for output in outputs]
+        if v.dim() == 0:
+            merged[k] = sum(value * n for value, n in zip(values, sizes)) / sum(sizes)
+        elif v.dim() == 3 and all(value.shape[1] == n for value, n in zip(values, sizes)):
+            merged[k] = torch.cat(values, dim=1)
+        elif v.dim() == 2 and all(value.shape[0] == n for value, n in zip(values, sizes)):
+            merged[k] = torch.cat(values, dim=0)
+    return merged
+
+
 class Trainer:
 
     def __init__(self, problem: Problem,
@@ -34,7 +62,14 @@ class Trainer:
                  lr_scheduler=False,
                  epochs=1000, eval_metric='loop_dev_loss', patience=5,
                  warmup=0,
-                 clip=100.0):
+                 clip=100.0,
+                 batch_size=None,
+                 accumulate=1,
+                 shuffle=True,
+                 eval_every=1,
+                 eval_budget=None,
+                 async_eval=False,
+                 checkpoint: CheckpointManager = None):
         """
 
         :param problem: Object which defines multi-objective loss function and computational graph
@@ -47,6 +82,19 @@ class Trainer:
         :param eval_metric: (str) Performance metric for model selection and early stopping
         :param patience: (int) Number of epochs to allow no improvement before early stopping
         :param warmstart: (int) How many epochs to wait before enacting early stopping policy
+        :param clip: (float) Maximum norm of gradients
+        :param batch_size: (int) Number of nstep samples per mini-batch. If None train on the full batch every epoch
+        :param accumulate: (int) Number of mini-batches to accumulate gradients over per optimizer step
+        :param shuffle: (bool) Whether to shuffle samples over the batch dimension every epoch
+        :param eval_every: (int) Evaluate the dev set and dev simulation every eval_every epochs.
+                           Patience and warmup then count evaluations rather than epochs.
+        :param eval_budget: (float) Optional fraction of wall time that blocking evaluations may take.
+                            A scheduled evaluation is skipped while evaluation time exceeds this share of the elapsed time.
+        :param async_eval: (bool) Evaluate a snapshot of the weights in a background thread while training continues.
+                           Model selection and early stopping act on each result once it arrives, and a scheduled
+                           evaluation is skipped while the previous one is still running.
+        :param checkpoint: Object holding the best weights, optionally their moving average and periodic disk writes.
+                           Defaults to a CheckpointManager keeping only the best weights in memory.
         """
         self.model = problem
         self.optimizer = optimizer
@@ -62,46 +110,255 @@ class Trainer:
         self.warmup = warmup
         self.badcount = 0
         self.clip = clip
+        self.batch_size = batch_size
+        self.accumulate = accumulate
+        self.shuffle = shuffle
+        self.device = getattr(dataset, 'device', 'cpu')
+        self.eval_every = eval_every
+        self.eval_budget = eval_budget
+        self.async_eval = async_eval
+        self.eval_time = 0.0
+        self.eval_executor = None
+        self.checkpoint = CheckpointManager(self.model) if checkpoint is None else checkpoint
+
+    def optimizer_step(self):
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        self.checkpoint.update_ema()
+
+    def train_epoch(self):
+        """
+        One pass over the training set. Either a single full batch gradient step or
+        mini-batch gradient steps with gradients accumulated over self.accumulate mini-batches.
+
+        :return: (dict {str: Tensor}) Output of the last batch with scalar metrics averaged over all batches
+        """
+        self.optimizer.zero_grad()
+        if self.batch_size is None:
+            output = self.model(get_batch(self.dataset.train_data, slice(None), device=self.device))
+            output['nstep_train_loss'].backward()
+            self.optimizer_step()
+            return output
+
+        metrics = dict()
+        nbatches = -(-nstep_samples(self.dataset.train_data) // self.batch_size)
+        for k, batch in enumerate(batch_iterator(self.dataset.train_data, self.batch_size,
+                                                 shuffle=self.shuffle, device=self.device)):
+            # the last group holds the remaining mini-batches and is averaged over its actual size
+            group = min(self.accumulate, nbatches - k // self.accumulate * self.accumulate)
+            output = self.model(batch)
+            (output['nstep_train_loss'] / group).backward()
+            if (k + 1) % self.accumulate == 0 or k + 1 == nbatches:
+                self.optimizer_step()
+            for name, v in output.items():
+                if isinstance(v, torch.Tensor) and v.dim() == 0:
+                    metrics.setdefault(name, []).append(v.detach())
+        return {**output, **{name: torch.stack(v).mean() for name, v in metrics.items()}}
 
     ########################################
     ############# TRAIN LOOP ###############
     ########################################
+    def dev_eval(self, model, simulator):
+        """
+        Dev set response and dev simulation of a model.
+
+        :param model: (Problem) Model to evaluate, either the trained model or a snapshot of it
+        :param simulator: (Simulator) Simulator bound to model
+        :return: (dict {str: Tensor})
+        """
+        with torch.no_grad():
+            model.eval()
+            dev_data_output = model(get_batch(self.dataset.dev_data, slice(None), device=self.device))
+            dev_sim_output = simulator.dev_eval()
+        return {**dev_data_output, **dev_sim_output}
+
+    def eval_due(self, epoch, start_time):
+        """
+        Whether the evaluation schedule calls for a dev evaluation at this epoch.
+
+        :param epoch: (int)
+        :param start_time: (float) Wall time at which training started
+        :return: (bool)
+        """
+        if epoch == self.epochs - 1:
+            return True
+        if epoch % self.eval_every != 0:
+            return False
+        if self.eval_budget is not None and epoch > 0:
+            return self.eval_time <= self.eval_budget * (time.time() - start_time)
+        return True
+
+    def submit_eval(self, epoch):
+        """
+        Copies the current weights into a snapshot model and evaluates it in a background thread.
+
+        :param epoch: (int) Epoch of the snapshot
+        :return: (concurrent.futures.Future) Resolves to the epoch and dev output of the snapshot
+        """
+        if self.eval_executor is None:
+            self.eval_executor = ThreadPoolExecutor(max_workers=1)
+            # one memo for model and simulator, so a torch emulator that is also a component of the model
+            # is copied once and the snapshot shares no modules with training; the dataset is read only
+            dataset = getattr(self.simulator, 'dataset', None)
+            memo = {id(dataset): dataset}
+            self.eval_model = deepcopy(self.model, memo)
+            self.eval_simulator = deepcopy(self.simulator, memo)
+        with torch.no_grad():
+            for v, w in zip(self.eval_model.state_dict().values(), self.model.state_dict().values()):
+                v.copy_(w)
+        return self.eval_executor.submit(lambda: (epoch, self.dev_eval(self.eval_model, self.eval_simulator)))
+
+    def select(self, dev_output, model):
+        """
+        Model selection and early stopping bookkeeping for one dev evaluation.
+
+        :param dev_output: (dict {str: Tensor}) Output of dev_eval
+        :param model: (Problem) Model which produced dev_output
+        """
+        if getattr(model, 'nmembers', None) is not None:
+            return self.select_members(dev_output, model)
+        if dev_output[self.eval_metric] < self.best_devloss:
+            self.checkpoint.save_best(model)
+            self.best_devloss = dev_output[self.eval_metric]
+            self.badcount = 0
+        else:
+            if self.nevals > self.warmup:
+                self.badcount += 1
+        self.nevals += 1
+
+    def select_members(self, dev_output, model):
+        """
+        Model selection and early stopping for each member of an Ensemble on its own {eval_metric}_member{i}.
+        Every member keeps the weights of its best evaluation in its slice of the best weights, and training stops
+        once all members have run out of patience. best_devloss is the mean of the members' best metrics.
+
+        :param dev_output: (dict {str: Tensor}) Output of dev_eval
+        :param model: (Ensemble) Model which produced dev_output
+        """
+        if self.member_best is None:
+            self.member_best = [float(np.finfo(np.float32).max)] * model.nmembers
+            self.member_badcount = [0] * model.nmembers
+        for i in range(model.nmembers):
+            metric = float(dev_output[f'{self.eval_metric}_member{i}'])
+            if metric < self.member_best[i]:
+                self.checkpoint.save_best(model, member=i)
+                self.member_best[i] = metric
+                self.member_badcount[i] = 0
+            elif self.nevals > self.warmup:
+                self.member_badcount[i] += 1
+        self.best_devloss = float(np.mean(self.member_best))
+        self.badcount = min(self.member_badcount)
+        self.nevals += 1
+
+    def training_state(self):
+        """
+        :return: (dict) Everything needed to continue training from the current epoch
+        """
+        return {'model': self.model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'lr_scheduler': None if self.lr_scheduler is None else self.lr_scheduler.state_dict(),
+                'best_model': self.checkpoint.best,
+                'ema_model': self.checkpoint.ema,
+                'best_devloss': float(self.best_devloss),
+                'badcount': self.badcount,
+                'member_best': self.member_best,
+                'member_badcount': self.member_badcount,
+                'nevals': self.nevals,
+                'rng': rng_state()}
+
+    def load_training_state(self, state):
+        """
+        Restores a state returned by training_state.
+
+        :param state: (dict)
+        """
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.lr_scheduler is not None and state['lr_scheduler'] is not None:
+            self.lr_scheduler.load_state_dict(state['lr_scheduler'])
+        self.checkpoint.load_best(state['best_model'], state['ema_model'])
+        self.best_devloss = state['best_devloss']
+        self.badcount = state['badcount']
+        self.member_best, self.member_badcount = state['member_best'], state['member_badcount']
+        self.nevals = state['nevals']
+        set_rng_state(state['rng'])
+
     def train(self):
-        best_devloss = np.finfo(np.float32).max
-        best_model = deepcopy(self.model.state_dict())
-        for i in range(self.epochs):
+        self.best_devloss = np.finfo(np.float32).max
+        self.member_best, self.member_badcount = None, None
+        self.checkpoint.save_best()
+        self.best_model = self.checkpoint.best
+        self.nevals = 0
+        start_time, pending, start_epoch = time.time(), None, 0
+        state = self.checkpoint.load_resume()
+        if state is not None:
+            self.load_training_state(state)
+            start_epoch = self.epochs if state['done'] else state['epoch'] + 1
+        for i in range(start_epoch, self.epochs):
             self.model.train()
-            output = self.model(self.dataset.train_data)
-            self.optimizer.zero_grad()
-            output['nstep_train_loss'].backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-            self.optimizer.step()
+            output = self.train_epoch()
             if self.lr_scheduler is not None:
                 self.lr_scheduler.step(output['nstep_train_loss'])
-            with torch.no_grad():
-                self.model.eval()
-                dev_data_output = self.model(self.dataset.dev_data)
-                dev_sim_output = self.simulator.dev_eval()
-                output = {**output, **dev_data_output, **dev_sim_output}
-                if output[self.eval_metric] < best_devloss:
-                    best_model = deepcopy(self.model.state_dict())
-                    best_devloss = output[self.eval_metric]
-                    self.badcount = 0
-                else:
-                    if i > self.warmup:
-                        self.badcount += 1
-                self.logger.log_metrics(output, step=i)
-                self.visualizer.train_plot(output, i)
+            dev_output = dict()
+            if self.async_eval:
+                if pending is not None and (pending.done() or i == self.epochs - 1):
+                    epoch, snapshot_output = pending.result()
+                    pending = None
+                    self.select(snapshot_output, self.eval_model)
+                    self.logger.log_metrics(snapshot_output, step=epoch)
+                if pending is None and self.eval_due(i, start_time):
+                    pending = self.submit_eval(i)
+                    if i == self.epochs - 1:
+                        _, dev_output = pending.result()
+                        pending = None
+                        self.select(dev_output, self.eval_model)
+            elif self.eval_due(i, start_time):
+                eval_start = time.time()
+                dev_output = self.dev_eval(self.model, self.simulator)
+                self.eval_time += time.time() - eval_start
+                self.select(dev_output, self.model)
+            output = {**output, **dev_output}
+            self.logger.log_metrics(output, step=i)
+            self.visualizer.train_plot(output, i)
+            self.checkpoint.periodic(i)
+            self.checkpoint.save_resume(self.training_state, i)
             if self.badcount > self.patience:
                 break
+        if pending is not None:
+            pending.cancel()
+        if self.eval_executor is not None:
+            self.eval_executor.shutdown()
+            self.eval_executor = None
+        self.checkpoint.close()
+        if start_epoch < self.epochs:
+            self.checkpoint.save_resume(self.training_state, i, final=True, done=self.badcount > self.patience)
 
         plots = self.visualizer.train_output()
-        self.logger.log_artifacts({'best_model_state_dict.pth': best_model, 'best_model.pth': self.model, **plots})
-        return best_model
+        ema = {} if self.checkpoint.ema is None else {'ema_model_state_dict.pth': self.checkpoint.ema}
+        self.logger.log_artifacts({'best_model_state_dict.pth': self.best_model, 'best_model.pth': self.model,
+                                   **ema, **plots})
+        return self.best_model
 
     ########################################
     ########## EVALUATE MODEL ##############
     ########################################
+    def dataset_eval(self, data):
+        """
+        Model response on a dataset split. With mini-batch training the split is evaluated in chunks of batch_size
+        samples, so that memory mapped data is only read and moved to device one chunk at a time.
+
+        :param data: (dict, str: 3-d np.array or torch.Tensor) dims=(nsteps, nsamples, dim)
+        :return: (dict {str: Tensor})
+        """
+        if self.batch_size is None:
+            return self.model(get_batch(data, slice(None), device=self.device))
+        outputs, sizes = [], []
+        for batch in batch_iterator(data, self.batch_size, shuffle=False, device=self.device):
+            outputs.append(self.model(batch))
+            sizes.append(nstep_samples(batch))
+        return merge_outputs(outputs, sizes)
+
     def evaluate(self, best_model):
         self.model.eval()
         self.model.load_state_dict(best_model)
@@ -114,7 +371,7 @@ class Trainer:
             all_output = dict()
             for dset, dname in zip([self.dataset.train_data, self.dataset.dev_data, self.dataset.test_data],
                                    ['train', 'dev', 'test']):
-                all_output = {**all_output, **self.model(dset)}
+                all_output = {**all_output, **self.dataset_eval(dset)}
             ########################################
             ########## SIMULATOR RESPONSE ##########
             ########################################
@@ -146,8 +403,8 @@ class TrainerMPP:
     ########################################
     def train(self):
         best_devloss = np.finfo(np.float32).max
-        best_model = deepcopy(self.model.state_dict())
-        best_model_full = self.model
+        checkpoint = CheckpointManager(self.model)
+        best_model = checkpoint.best
         for i in range(self.epochs):
             self.model.train()
             output = self.model(self.dataset.train_data)
@@ -160,13 +417,14 @@ class TrainerMPP:
                 dev_data_output = self.model(self.dataset.dev_data)
                 self.logger.log_metrics({**dev_data_output, **output}, step=i)
                 if dev_data_output[self.eval_metric] < best_devloss:
-                    best_model = deepcopy(self.model.state_dict())
-                    best_model_full = self.model
+                    checkpoint.save_best()
                     best_devloss = dev_data_output[self.eval_metric]
                 self.visualizer.train_plot(dev_data_output, i)
 
         plots = self.visualizer.train_output()
         self.logger.log_artifacts({'best_model_stat_dict.pth': best_model, **plots})
+        best_model_full = deepcopy(self.model)
+        best_model_full.load_state_dict(best_model)
         return best_model, best_model_full
 
     ########################################
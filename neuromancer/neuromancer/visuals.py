@@ -6,14 +6,14 @@ import os
 
 # machine learning/data science imports
 import numpy as np
-import matplotlib.pyplot as plt
 import scipy.linalg as LA
 
 # local imports
 from neuromancer.datasets import unbatch_data
-import neuromancer.plot as plot
 import slim
 
+# matplotlib and neuromancer.plot are imported where figures are made so headless training never loads them
+
 
 class Visualizer:
 
@@ -42,6 +42,7 @@ class VisualizerOpen(Visualizer):
         self.dataset = dataset
         self.verbosity = verbosity
         if training_visuals:
+            import neuromancer.plot as plot
             self.anime = plot.Animator(model)
         self.training_visuals = training_visuals
         self.savedir = savedir
@@ -59,6 +60,8 @@ class VisualizerOpen(Visualizer):
                 self.anime()
 
     def plot_matrix(self):
+        import matplotlib.pyplot as plt
+        import neuromancer.plot as plot
         if hasattr(self.model, 'fx'):
             if hasattr(self.model.fx, 'effective_W'):
                 rows = 1
@@ -124,6 +127,7 @@ class VisualizerOpen(Visualizer):
             plt.savefig(os.path.join(self.savedir, 'eigmat.png'))
 
     def plot_traj(self, true_traj, pred_traj, figname='open_loop.png'):
+        import matplotlib.pyplot as plt
         try:
             plt.style.use('dark_background')
             fig, ax = plt.subplots(len(true_traj), 1)
@@ -176,6 +180,7 @@ class VisualizerOpen(Visualizer):
         self.plot_matrix()
 
         if self.trace_movie:
+            import neuromancer.plot as plot
             plot.trajectory_movie(np.concatenate(Ytrue).transpose(1, 0),
                                   np.concatenate(Ypred).transpose(1, 0),
                                   figname=os.path.join(self.savedir, f'open_movie.mp4'),
@@ -192,6 +197,7 @@ class VisualizerTrajectories(Visualizer):
         self.plot_keys = plot_keys
 
     def eval(self, outputs):
+        import neuromancer.plot as plot
         data = {k:  unbatch_data(v).squeeze(1).detach().cpu().numpy()
                 for (k, v) in outputs.items() if any([plt_k in k for plt_k in self.plot_keys])}
         for k, v in data.items():
@@ -209,6 +215,7 @@ class VisualizerClosedLoop(Visualizer):
         self.savedir = savedir
 
     def eval(self, outputs):
+        import neuromancer.plot as plot
         D = outputs['D'] if 'D' in outputs.keys() else None
         R = outputs['R'] if 'R' in outputs.keys() else None
         Ymin = outputs['Ymin'] if 'Ymin' in outputs.keys() else None
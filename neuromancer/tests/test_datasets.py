@@ -0,0 +1,145 @@
+import os
+import subprocess
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from neuromancer.datasets import EmulatorDataset, MultiExperimentDataset, ExperimentWindows, ingest_csv, \
+    batch_mh_data, unbatch_mh_data, to_tensor, get_batch, batch_iterator, DataDict
+
+
+def reference_batch_mh_data(data, nsteps):
+    end_step = data.shape[0] - nsteps
+    data = np.asarray([data[k:k+nsteps, :] for k in range(0, end_step)])
+    return data.transpose(1, 0, 2)
+
+
+def reference_unbatch_mh_data(data):
+    data_unmove = np.asarray([data[0, k, :] for k in range(0, data.shape[1])])
+    return data_unmove.reshape(-1, 1, data_unmove.shape[-1])
+
+
+def test_batch_mh_data():
+    data = np.random.rand(50, 3).astype(np.float32)
+    expected = reference_batch_mh_data(data, 8)
+    windows = batch_mh_data(data, 8)
+    assert windows.shape == expected.shape
+    assert np.array_equal(windows, expected)
+    assert np.array_equal(batch_mh_data(torch.tensor(data), 8).numpy(), expected)
+    assert np.array_equal(to_tensor(windows).numpy(), expected)
+
+
+def test_get_batch_copies_windows():
+    data = np.random.rand(50, 3).astype(np.float32)
+    expected = reference_batch_mh_data(data, 8)
+    with warnings.catch_warnings():
+        # only the warning about wrapping read-only views is silenced
+        warnings.simplefilter('error')
+        windows = to_tensor(batch_mh_data(data, 8))
+    # windows are aliases of data
+    assert np.shares_memory(windows.numpy(), data)
+    for nstep_data in [windows, batch_mh_data(torch.tensor(data), 8)]:
+        nstep_data = DataDict(Yf=nstep_data)
+        nstep_data.name = 'nstep_train'
+        for idx in [slice(None), slice(3, 20), np.array([4, 5, 6, 30])]:
+            batch = get_batch(nstep_data, idx)
+            assert batch.name == 'nstep_train' and batch['Yf'].is_contiguous()
+            assert np.array_equal(batch['Yf'].numpy(), expected[:, idx])
+            batch['Yf'].add_(1.0)
+            assert np.array_equal(nstep_data['Yf'].numpy(), expected)
+    assert np.array_equal(data[:42], expected[0])
+
+
+def test_unbatch_mh_data():
+    windows = batch_mh_data(np.random.rand(50, 3), 8)
+    assert np.array_equal(unbatch_mh_data(windows), reference_unbatch_mh_data(windows))
+    assert np.array_equal(unbatch_mh_data(torch.tensor(windows)).numpy(), reference_unbatch_mh_data(windows))
+
+
+def test_cache_key_seed(tmp_path):
+    kwargs = dict(system='TwoTank', nsim=200, nsteps=4, norm=['Y'], savedir=str(tmp_path),
+                  cache=str(tmp_path / 'cache'), plot='off')
+    first = EmulatorDataset(seed=1, **kwargs)
+    second = EmulatorDataset(seed=2, **kwargs)
+    assert first.cache_key() != second.cache_key()
+    assert not np.array_equal(first.data['Y'], second.data['Y'])
+    cached = EmulatorDataset(seed=1, **kwargs)
+    assert np.array_equal(cached.data['Y'], first.data['Y'])
+
+
+def experiment_log(path, nexp=4, length=30):
+    """
+    CSV log with interleaved experiments, experiment 2 is recorded in two separate runs.
+    """
+    ids = np.concatenate([np.full(length, i) for i in [0, 2, 1, 2, 3]][:nexp + 1])
+    log = pd.DataFrame({'y1': np.random.rand(len(ids)), 'y2': np.random.rand(len(ids)),
+                        'u1': np.random.rand(len(ids)), 'exp_id': ids})
+    log.to_csv(path, index=False)
+    return log
+
+
+def test_ingest_csv_chunks(tmp_path):
+    log = experiment_log(tmp_path / 'log.csv')
+    store = ingest_csv(str(tmp_path / 'log.csv'), str(tmp_path / 'store'), chunksize=7)
+    assert np.allclose(store.data['Y'], log[['y1', 'y2']].to_numpy(), atol=1e-7)
+    assert np.allclose(store.min['Y'], log[['y1', 'y2']].min().to_numpy(), atol=1e-7)
+    assert np.allclose(store.max['U'], log[['u1']].max().to_numpy(), atol=1e-7)
+    assert store.experiment_runs() == {0.0: [(0, 30)], 1.0: [(60, 90)], 2.0: [(30, 60), (90, 120)], 3.0: [(120, 150)]}
+    assert store.experiment_runs(slice(45, 100)) == {1.0: [(60, 90)], 2.0: [(45, 60), (90, 100)]}
+
+
+@pytest.mark.parametrize('batch_type', ['batch', 'mh'])
+def test_experiment_store_dataset(tmp_path, batch_type):
+    experiment_log(tmp_path / 'log.csv')
+    kwargs = dict(system=str(tmp_path / 'log.csv'), nsim=140, ninit=5, norm=['Y', 'U'], nsteps=4,
+                  savedir=str(tmp_path), plot='off', batch_type=batch_type)
+    plain = MultiExperimentDataset(**kwargs)
+    stored = MultiExperimentDataset(store=str(tmp_path / 'store'), **kwargs)
+    for k in ['Ymin', 'Ymax', 'Umin', 'Umax']:
+        assert np.allclose(stored.min_max_norms[k], plain.min_max_norms[k], atol=1e-6), k
+    assert stored.dims == plain.dims
+    for dset in ['train_data', 'dev_data', 'test_data']:
+        expected, data = getattr(plain, dset), getattr(stored, dset)
+        assert set(data) == set(expected)
+        # windows stay on disk until a batch of them is read
+        assert all(isinstance(v, ExperimentWindows) for v in data.values())
+        batch = get_batch(data, slice(None))
+        assert batch.name == expected.name
+        for k, v in expected.items():
+            assert batch[k].dtype == torch.float32
+            assert torch.allclose(batch[k], v, atol=1e-6), (dset, k)
+        for batch in batch_iterator(data, 5):
+            assert all(v.shape[1] <= 5 for v in batch.values())
+    for dset in ['train_loop', 'dev_loop', 'test_loop']:
+        expected, loops = getattr(plain, dset), getattr(stored, dset)
+        assert len(loops) == len(expected)
+        for d, loop in zip(expected, loops):
+            assert loop.name == d.name and set(loop) == set(d)
+            for k, v in d.items():
+                assert torch.allclose(loop[k], v, atol=1e-6), (dset, k)
+
+
+def test_plot_policies(tmp_path):
+    kwargs = dict(system='TwoTank', nsim=200, nsteps=4, norm=['Y'])
+    for plot in ['manual', 'background']:
+        savedir = tmp_path / plot
+        dataset = EmulatorDataset(savedir=str(savedir), plot=plot, **kwargs)
+        if plot == 'manual':
+            assert not list(savedir.glob('*.png'))
+        dataset.save_plots()
+        assert sorted(p.name for p in savedir.glob('*.png')) == ['TwoTank.png', 'TwoTank_open.png'], plot
+        assert not dataset.pending_plots and not dataset.plot_jobs
+
+
+def test_plot_off_skips_matplotlib(tmp_path):
+    script = ('import sys\n'
+              'from neuromancer.datasets import EmulatorDataset\n'
+              f'dataset = EmulatorDataset(system="TwoTank", nsim=200, nsteps=4, savedir={str(tmp_path)!r}, plot="off")\n'
+              'dataset.save_plots()\n'
+              'assert "matplotlib" not in sys.modules\n')
+    subprocess.run([sys.executable, '-c', script], check=True, env=os.environ.copy())
+    assert not list(tmp_path.glob('*.png'))
@@ -0,0 +1,56 @@
+import warnings
+
+import numpy as np
+import pytest
+import scipy.linalg
+import torch
+
+import slim
+import neuromancer.blocks as blocks
+import neuromancer.dynamics as dynamics
+from neuromancer.estimators import LinearKalmanFilter
+
+
+def kalman_filter(nx=4, ny=2, nu=1, nd=1, **kwargs):
+    torch.manual_seed(0)
+    dims = {'x0_kalman': (nx,), 'Yf': (10, ny), 'Uf': (10, nu), 'Df': (10, nd)}
+    model = dynamics.linear(True, slim.Linear, blocks.MLP, dims, name='dynamics', input_keys={'x0': 'x0_kalman'})
+    with torch.no_grad():
+        # a stable state transition matrix
+        model.fx.linear.weight.mul_(0.9 / torch.linalg.eigvals(model.fx.linear.weight).abs().max())
+    return LinearKalmanFilter(model=model, name='kalman', **kwargs)
+
+
+def test_riccati_matches_scipy():
+    estimator = kalman_filter()
+    rng = np.random.default_rng(0)
+    A, C = rng.standard_normal((4, 4)), rng.standard_normal((4, 2))
+    B = rng.standard_normal((4, 4))
+    Q, R = B @ B.T + np.eye(4), np.diag([0.5, 2.0])
+    P = estimator.riccati(*[torch.tensor(M) for M in [A, C, Q, R]])
+    assert np.allclose(P.numpy(), scipy.linalg.solve_discrete_are(A, C, Q, R), rtol=1e-8, atol=1e-8)
+
+
+def test_steady_state_matches_time_varying():
+    """
+    The error covariance of the time-varying filter converges to the Riccati solution,
+    after a long horizon both filters give the same estimate.
+    """
+    estimator = kalman_filter()
+    data = {'Yp': torch.randn(300, 5, 2), 'Up': torch.randn(300, 5, 1), 'Dp': torch.randn(300, 5, 1)}
+    with torch.no_grad():
+        time_varying = estimator(data)['x0_kalman']
+        estimator.steady_state = True
+        steady_state = estimator(data)['x0_kalman']
+    assert torch.allclose(steady_state, time_varying, atol=1e-4)
+
+
+def test_riccati_warns_without_convergence():
+    estimator = kalman_filter(max_iter=20)
+    # the unstable first state is not observed, no stabilizing solution exists
+    A, C = torch.diag(torch.tensor([1.5, 0.5], dtype=torch.float64)), torch.tensor([[0.0], [1.0]], dtype=torch.float64)
+    with pytest.warns(RuntimeWarning, match='did not converge'):
+        estimator.riccati(A, C, torch.eye(2, dtype=torch.float64), torch.eye(1, dtype=torch.float64))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        estimator.riccati(0.5 * A, C, torch.eye(2, dtype=torch.float64), torch.eye(1, dtype=torch.float64))
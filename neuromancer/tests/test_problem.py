@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+from neuromancer.checkpoints import CheckpointManager
+from neuromancer.loggers import BasicLogger
+from neuromancer.problem import Problem, Objective, Ensemble
+from neuromancer.trainer import Trainer
+from neuromancer.visuals import Visualizer
+from test_trainer import Affine, nstep_data
+
+
+def ensemble(nmembers=2):
+    torch.manual_seed(0)
+    return Ensemble([Problem([Objective(['Y_pred_affine', 'Yf'], F.mse_loss, name='ref_loss')], [], [Affine(2, 2)])
+                     for _ in range(nmembers)])
+
+
+def test_member():
+    model = ensemble(3)
+    model.template.components[0].register_buffer('scale', torch.ones(1), persistent=False)
+    model.register_buffer(f'member_buffer_{len(model.buffer_names)}', torch.arange(3.).reshape(3, 1))
+    model.buffer_names.append('components.0.scale')
+    data = nstep_data('nstep_dev')
+    output = model(data)
+    for i in range(3):
+        member = model.member(i)
+        assert torch.equal(member.components[0].scale, torch.tensor([float(i)]))
+        assert torch.allclose(member(data)['nstep_dev_Y_pred_affine'], output['nstep_dev_Y_pred_affine'][i])
+        assert torch.allclose(member(data)['nstep_dev_loss'], output[f'nstep_dev_loss_member{i}'])
+
+
+def test_member_selection(tmp_path):
+    """
+    Every member keeps the weights of its own best evaluation and early stopping waits for the last member.
+    """
+    model = ensemble()
+    dataset = SimpleNamespace(train_data=nstep_data('nstep_train'), dev_data=nstep_data('nstep_dev'))
+    trainer = Trainer(model, dataset, torch.optim.SGD(model.parameters(), lr=0.1),
+                      logger=BasicLogger(savedir=str(tmp_path), verbosity=1), visualizer=Visualizer(),
+                      checkpoint=CheckpointManager(model), eval_metric='dev_loss', patience=1)
+    trainer.best_devloss, trainer.nevals, trainer.member_best = float('inf'), 0, None
+    first = {k: v.clone() for k, v in model.state_dict().items()}
+    trainer.select({'dev_loss_member0': torch.tensor(1.0), 'dev_loss_member1': torch.tensor(2.0)}, model)
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(1.0)
+    trainer.select({'dev_loss_member0': torch.tensor(0.5), 'dev_loss_member1': torch.tensor(3.0)}, model)
+    for k, v in trainer.checkpoint.best.items():
+        assert torch.equal(v[0], model.state_dict()[k][0]), k
+        assert torch.equal(v[1], first[k][1]), k
+    assert trainer.best_devloss == 1.25
+    assert trainer.member_badcount == [0, 1] and trainer.badcount == 0
+    trainer.select({'dev_loss_member0': torch.tensor(0.6), 'dev_loss_member1': torch.tensor(3.0)}, model)
+    trainer.select({'dev_loss_member0': torch.tensor(0.6), 'dev_loss_member1': torch.tensor(3.0)}, model)
+    assert trainer.badcount == 2 > trainer.patience
@@ -0,0 +1,77 @@
+import pickle
+
+import torch
+import torch.nn as nn
+
+import neuromancer.estimators as estimators
+import neuromancer.runtime as runtime
+from neuromancer.rnn import RNN, compile_rnn
+
+
+def cell_recurrence(rnn, sequence):
+    """
+    Output of the same RNN evaluated cell by cell instead of through the fused kernels.
+    """
+    fused, rnn.torch_nonlin = rnn.torch_nonlin, None
+    try:
+        return rnn(sequence)
+    finally:
+        rnn.torch_nonlin = fused
+
+
+def test_fused_matches_cells():
+    torch.manual_seed(0)
+    x = torch.randn(12, 5, 3, dtype=torch.float64)
+    for nonlin in [nn.Tanh, nn.ReLU]:
+        for bias in [False, True]:
+            rnn = RNN(3, hsizes=[8, 8], bias=bias, nonlin=nonlin).double()
+            assert rnn.torch_nonlin is not None
+            out, hn = rnn(x)
+            ref, ref_hn = cell_recurrence(rnn, x)
+            assert torch.allclose(out, ref, atol=1e-12) and torch.allclose(hn, ref_hn, atol=1e-12)
+            params = [p for p in rnn.parameters() if p.requires_grad]
+            grads = torch.autograd.grad(out.sum() + hn.sum(), params, allow_unused=True)
+            ref_grads = torch.autograd.grad(ref.sum() + ref_hn.sum(), params, allow_unused=True)
+            for g, r in zip(grads, ref_grads):
+                assert (g is None and r is None) or torch.allclose(g, r, atol=1e-10)
+
+
+def test_compiled_matches_eager():
+    torch.manual_seed(0)
+    rnn = RNN(3, hsizes=[8, 8], nonlin=nn.GELU)
+    compiled = compile_rnn(RNN(3, hsizes=[8, 8], nonlin=nn.GELU))
+    compiled.load_state_dict(rnn.state_dict())
+    assert rnn.torch_nonlin is None and 'recurrence' in vars(compiled) and 'recurrence' not in vars(rnn)
+    x = torch.randn(12, 5, 3)
+    out, hn = rnn(x)
+    cout, chn = compiled(x)
+    assert torch.allclose(out, cout, atol=1e-5) and torch.allclose(hn, chn, atol=1e-5)
+    grads = torch.autograd.grad(out.sum() + hn.sum(), list(rnn.parameters()), allow_unused=True)
+    cgrads = torch.autograd.grad(cout.sum() + chn.sum(), list(compiled.parameters()), allow_unused=True)
+    for g, c in zip(grads, cgrads):
+        assert (g is None and c is None) or torch.allclose(g, c, atol=1e-5)
+    with torch.no_grad():
+        assert torch.allclose(rnn(x)[0], compiled(x)[0], atol=1e-5)
+    # whole models are pickled by the loggers
+    restored = pickle.loads(pickle.dumps(compiled))
+    assert 'recurrence' in vars(restored) and torch.allclose(restored(x)[0], out, atol=1e-5)
+
+
+def test_trace():
+    rnn = RNN(3, hsizes=[8, 8], nonlin=nn.Tanh).eval()
+    x = torch.randn(12, 1, 3)
+    traced = torch.jit.trace(rnn, (x,))
+    y = torch.randn(12, 1, 3)
+    for a, b in zip(traced(y), rnn(y)):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def test_export_rnn_estimator(tmp_path):
+    dims = {'x0': (4,), 'Yp': (100, 2)}
+    estimator = estimators.RNNEstimator(dims, nsteps=6, window_size=6, nonlin=nn.Tanh, hsizes=[8], name='estim')
+    example = {'Yp': torch.randn(6, 1, 2)}
+    runtime.export(str(tmp_path / 'estimator.ts'), [estimator], example, outputs=['x0_estim'])
+    artifact = runtime.load(str(tmp_path / 'estimator.ts'))
+    data = {'Yp': torch.randn(6, 1, 2)}
+    with torch.no_grad():
+        assert torch.allclose(artifact(data)['x0_estim'], estimator(data)['x0_estim'], atol=1e-6)
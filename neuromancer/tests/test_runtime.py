@@ -0,0 +1,83 @@
+import pytest
+import torch
+
+import neuromancer.estimators as estimators
+import neuromancer.policies as policies
+import neuromancer.runtime as runtime
+from neuromancer.train_scripts.base_control_flexy import export_controller
+
+
+def flexy_components(nsteps=4, nx=3):
+    """
+    Estimator and output feedback policy as trained by base_control_flexy, reading generated outputs Y_ctrl_p.
+    """
+    torch.manual_seed(0)
+    dims = {'x0': (nx,), 'x0_estim': (nx,), 'Yp': (100, 1), 'Y_ctrl_p': (100, 1), 'Rf': (100, 1), 'U': (100, 1)}
+    estimator = estimators.MLPEstimator(dims, nsteps=nsteps, window_size=nsteps, hsizes=[8],
+                                        input_keys=['Y_ctrl_p'], name='estim')
+    policy = policies.MLPPolicy(dims, nsteps=nsteps, hsizes=[8], input_keys=['Y_ctrl_p', 'Rf'], name='policy')
+    return estimator, policy
+
+
+def test_export_controller(tmp_path):
+    estimator, policy = flexy_components()
+    example = {'Yp': torch.rand(4, 1, 1), 'Rf': torch.rand(4, 1, 1), 'Df': torch.rand(4, 1, 1)}
+    spec = export_controller(str(tmp_path / 'controller.ts'), estimator, policy, example)
+    assert estimator.input_keys[0] == 'Y_ctrl_p' and policy.input_keys[0] == 'Y_ctrl_p'
+    assert list(spec['inputs']) == ['Yp', 'Rf']
+    assert list(spec['outputs']) == ['U_pred_policy', 'x0_estim']
+
+    controller = runtime.load(str(tmp_path / 'controller.ts'))
+    assert controller.spec == spec
+    data = {'Yp': torch.rand(4, 1, 1), 'Rf': torch.rand(4, 1, 1)}
+    with torch.no_grad():
+        expected = {'Y_ctrl_p': data['Yp'], 'Rf': data['Rf']}
+        expected.update(estimator(expected))
+        expected.update(policy(expected))
+    outputs = controller(data)
+    for k in ['U_pred_policy', 'x0_estim']:
+        assert torch.allclose(outputs[k], expected[k], atol=1e-6), k
+
+
+def test_mpc_runtime_step(tmp_path):
+    """
+    Receding horizon loop against eager evaluation of the components on windows kept by hand,
+    for traced components and an artifact whose control plan is not the first output.
+    """
+    estimator, policy = flexy_components()
+    estimator.input_keys[0], policy.input_keys[0] = 'Yp', 'Yp'
+    window = {'Yp': torch.rand(4, 1, 1), 'Rf': torch.rand(4, 1, 1)}
+    runtime.export(str(tmp_path / 'controller.ts'), [estimator, policy], window, outputs=['x0_estim', 'U_pred_policy'])
+    controllers = [runtime.MPCRuntime([estimator, policy], example=window, outputs=['x0_estim', 'U_pred_policy'],
+                                      warmup=2),
+                   runtime.MPCRuntime(str(tmp_path / 'controller.ts'), warmup=2)]
+    for mpc in controllers:
+        assert mpc.output_keys == ['x0_estim', 'U_pred_policy']
+        for k, v in window.items():
+            mpc.fill(k, v)
+    data = {k: v.clone() for k, v in window.items()}
+    for _ in range(6):
+        sample = {'Yp': torch.rand(1, 1), 'Rf': torch.rand(1, 1)}
+        data = {k: torch.cat([v[1:], sample[k].reshape(1, 1, 1)]) for k, v in data.items()}
+        with torch.no_grad():
+            expected = dict(data)
+            expected.update(estimator(expected))
+            expected = policy(expected)['U_pred_policy'][0]
+        for mpc in controllers:
+            u = mpc.step(sample)
+            assert torch.allclose(mpc.window('Yp'), data['Yp'])
+            assert torch.allclose(u, expected, atol=1e-6)
+    assert controllers[0].latency()['steps'] == 6
+
+
+def test_mpc_runtime_control_key(tmp_path):
+    estimator, policy = flexy_components()
+    estimator.input_keys[0], policy.input_keys[0] = 'Yp', 'Yp'
+    window = {'Yp': torch.rand(4, 1, 1), 'Rf': torch.rand(4, 1, 1)}
+    runtime.export(str(tmp_path / 'estimator.ts'), [estimator], window, outputs=['x0_estim'])
+    with pytest.raises(ValueError):
+        runtime.MPCRuntime(str(tmp_path / 'estimator.ts'), warmup=0)
+    with pytest.raises(ValueError):
+        runtime.MPCRuntime(str(tmp_path / 'estimator.ts'), outputs=['U_pred_policy'], control_key='x0_estim', warmup=0)
+    mpc = runtime.MPCRuntime(str(tmp_path / 'estimator.ts'), control_key='x0_estim', warmup=0)
+    assert mpc.step().shape == (3,)
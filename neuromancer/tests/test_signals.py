@@ -0,0 +1,133 @@
+import numpy as np
+import psl
+import torch
+
+import slim
+import neuromancer.blocks as blocks
+import neuromancer.dynamics as dynamics
+import neuromancer.estimators as estimators
+from neuromancer.signals import periodic, random_walk, nstep_windows, seeded_generator, minmax, \
+    PeriodicGenerator, WhiteNoiseGenerator, StepGenerator, RandomWalkGenerator, SplineGenerator, \
+    WhiteNoisePeriodicGenerator, AddGenerator, SignalGeneratorDynamics
+
+
+def test_periodic_matches_psl():
+    for nsim in [100, 101, 37]:
+        for periods in [1, 3, 7]:
+            for form in ['sin', 'cos']:
+                signal = periodic(nsim, 2, nsamples=3, periods=periods, xmin=-1.0, xmax=2.0, form=form)
+                expected = psl.Periodic(nx=2, nsim=nsim, numPeriods=periods, xmax=2.0, xmin=-1.0, form=form)
+                assert signal.shape == (nsim, 3, 2)
+                for sample in range(3):
+                    assert np.allclose(signal[:, sample].numpy(), expected, atol=1e-6), (nsim, periods, form)
+
+
+def test_nstep_windows():
+    signal = torch.arange(5 * 4 * 2, dtype=torch.float32).reshape(-1, 2)
+    past, future = nstep_windows(signal, 4)
+    assert past.shape == future.shape == (4, 4, 2)
+    for i in range(4):
+        assert torch.equal(past[:, i], signal[4 * i:4 * (i + 1)])
+        assert torch.equal(future[:, i], signal[4 * (i + 1):4 * (i + 2)])
+
+
+def generators(seed):
+    return [PeriodicGenerator(4, 2, xmax=0.8, xmin=0.2, name='R', seed=seed),
+            WhiteNoiseGenerator(4, 2, xmax=0.8, xmin=0.2, name='R', seed=seed),
+            StepGenerator(4, 2, xmax=0.8, xmin=0.2, name='R', seed=seed),
+            RandomWalkGenerator(4, 2, xmax=0.8, xmin=0.2, name='R', seed=seed),
+            SplineGenerator(4, 2, xmax=0.8, xmin=0.2, name='R', seed=seed),
+            WhiteNoisePeriodicGenerator(4, 2, xmax=(0.1, 0.5), xmin=0.2, name='R', seed=seed)]
+
+
+def test_generator_windows():
+    """
+    Whatever the batch size, the windows are consecutive windows of one normalized sequence.
+    """
+    for nbatch in [5, 8]:
+        data = {'Yp': torch.zeros(4, nbatch, 1)}
+        for generator, reference in zip(generators(0), generators(0)):
+            out = generator(data)
+            assert set(out) == {'Rp', 'Rf'}
+            assert out['Rp'].shape == out['Rf'].shape == (4, nbatch, 2), type(generator).__name__
+            nsim = (nbatch + 1) * 4
+            R = minmax(reference.sequence_generator(nsim, reference.get_xmin(), reference.get_xmax()))
+            assert R.shape == (nsim, 2)
+            for i in range(nbatch):
+                assert torch.allclose(out['Rp'][:, i], R[4 * i:4 * (i + 1)])
+                assert torch.allclose(out['Rf'][:, i], R[4 * (i + 1):4 * (i + 2)])
+
+
+def test_generator_seed():
+    data = {'Yp': torch.zeros(4, 6, 1)}
+    for first, second, other in zip(generators(1), generators(1), generators(2)):
+        a, b, c = first(data), second(data), other(data)
+        assert torch.equal(a['Rp'], b['Rp']) and torch.equal(a['Rf'], b['Rf'])
+        assert not torch.equal(a['Rp'], c['Rp']), type(first).__name__
+    # without a seed the generators follow the global torch generator
+    torch.manual_seed(3)
+    a = PeriodicGenerator(4, 2, xmax=0.8, xmin=0.2)(data)
+    torch.manual_seed(3)
+    b = PeriodicGenerator(4, 2, xmax=0.8, xmin=0.2)(data)
+    assert torch.equal(a['periodp'], b['periodp'])
+
+
+def test_random_walk_bounds():
+    xmin, xmax = torch.tensor([0.0, -1.0, 2.0]), torch.tensor([1.0, 1.0, 2.5])
+    walk = random_walk(5000, 3, nsamples=4, sigma=0.2, xmin=xmin, xmax=xmax, generator=seeded_generator(0))
+    assert walk.shape == (5000, 4, 3)
+    assert torch.allclose(walk[0], xmin.expand(4, 3))
+    assert torch.all(walk >= xmin) and torch.all(walk <= xmax)
+    # the walk spans the interval rather than sticking to a bound
+    assert torch.all(walk.amax(0) - walk.amin(0) > 0.9 * (xmax - xmin))
+
+
+def test_add_generator():
+    SG1 = PeriodicGenerator(4, 2, xmax=0.8, xmin=0.2, seed=5)
+    SG2 = WhiteNoiseGenerator(4, 2, xmax=0.1, xmin=0.0, seed=6)
+    added = AddGenerator(SG1, SG2, 4, 2, xmax=1.0, xmin=0.0, name='R', seed=7)
+    out = added({'Yp': torch.zeros(4, 7, 1)})
+    first = PeriodicGenerator(4, 2, xmax=0.8, xmin=0.2, seed=5).sequence_generator(32, 0.2, 0.8)
+    second = WhiteNoiseGenerator(4, 2, xmax=0.1, xmin=0.0, seed=6).sequence_generator(32, 0.0, 0.1)
+    Rp, Rf = nstep_windows(minmax(first + second), 4)
+    assert torch.allclose(out['Rp'], Rp) and torch.allclose(out['Rf'], Rf)
+
+
+def dynamics_generator(nsteps, parallel, seed=0, nx=3, ny=2):
+    torch.manual_seed(0)
+    dims = {'x0': (nx,), 'x0_estim': (nx,), 'Yp': (100, ny), 'Yf': (100, ny), 'Uf': (100, 1), 'Df': (100, 1)}
+    estimator = estimators.MLPEstimator(dims, nsteps=nsteps, window_size=nsteps, hsizes=[8], input_keys=['Yp'],
+                                        name='estim')
+    model = dynamics.blocknlin(True, slim.Linear, blocks.MLP, dims, name='dynamics', input_keys={'x0': 'x0_estim'})
+    return SignalGeneratorDynamics(model, estimator, nsteps, name='Y_ctrl_', parallel=parallel, seed=seed)
+
+
+def test_dynamics_generator_single_trajectory():
+    """
+    Without parallel the windows are consecutive windows of a single rollout, excitations are drawn in the order
+    of forward: estimator inputs, then the Y, U and D inputs of the dynamics model.
+    """
+    for nsteps, nbatch in [(4, 5), (6, 7)]:
+        generator, reference = dynamics_generator(nsteps, False), dynamics_generator(nsteps, False)
+        out = generator({'Yp': torch.zeros(nsteps, nbatch, 2)})
+        assert out['Y_ctrl_p'].shape == out['Y_ctrl_f'].shape == (nsteps, nbatch, 2)
+        with torch.no_grad():
+            x0 = reference.estimator({'Yp': reference.excitation(1, 1, 2)})
+            inputs = {k: reference.excitation(nbatch + 1, 1, dim)
+                      for dim, k in zip([2, 1, 1], reference.dynamics_input_keys)}
+            Y = reference.dynamics({**x0, **inputs})['Y_pred_dynamics'][:, 0]
+        assert Y.shape == ((nbatch + 1) * nsteps, 2)
+        for i in range(nbatch):
+            assert torch.allclose(out['Y_ctrl_p'][:, i], Y[nsteps * i:nsteps * (i + 1)])
+            assert torch.allclose(out['Y_ctrl_f'][:, i], Y[nsteps * (i + 1):nsteps * (i + 2)])
+
+
+def test_dynamics_generator_parallel():
+    for nsteps, nbatch in [(4, 5), (6, 7), (4, 1)]:
+        out = dynamics_generator(nsteps, True)({'Yp': torch.zeros(nsteps, nbatch, 2)})
+        again = dynamics_generator(nsteps, True)({'Yp': torch.zeros(nsteps, nbatch, 2)})
+        assert out['Y_ctrl_p'].shape == out['Y_ctrl_f'].shape == (nsteps, nbatch, 2)
+        assert torch.equal(out['Y_ctrl_p'], again['Y_ctrl_p']) and torch.equal(out['Y_ctrl_f'], again['Y_ctrl_f'])
+        if nbatch > 1:
+            # independent trajectories rather than successive windows of one
+            assert not torch.allclose(out['Y_ctrl_f'][:, :-1], out['Y_ctrl_p'][:, 1:])
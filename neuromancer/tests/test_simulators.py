@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import slim
+import neuromancer.blocks as blocks
+import neuromancer.dynamics as dynamics
+import neuromancer.estimators as estimators
+import neuromancer.policies as policies
+from neuromancer.datasets import DataDict
+from neuromancer.problem import Problem, Objective
+from neuromancer.simulators import ClosedLoopSimulator, BatchedClosedLoopSimulator, MultiSequenceOpenLoopSimulator
+
+
+def closed_loop(nsteps=4, nx=3):
+    """
+    Estimator, policy and dynamics model with scalar outputs, inputs and disturbances
+    as the per sample ClosedLoopSimulator expects of torch emulators.
+    """
+    torch.manual_seed(0)
+    dims = {'x0': (nx,), 'x0_estim': (nx,), 'Yp': (100, 1), 'Yf': (100, 1), 'Up': (100, 1), 'U': (100, 1),
+            'U_pred_policy': (100, 1), 'Df': (100, 1), 'Rf': (100, 1)}
+    estimator = estimators.MLPEstimator(dims, nsteps=nsteps, window_size=nsteps, hsizes=[8],
+                                        input_keys=['Yp'], name='estim')
+    policy = policies.MLPPolicy(dims, nsteps=nsteps, hsizes=[8], input_keys=['x0_estim', 'Up', 'Rf'], name='policy')
+    dynamics_model = dynamics.blocknlin(True, slim.Linear, blocks.MLP, dims, name='dynamics',
+                                        input_keys={'x0': 'x0_estim', 'Uf': 'U_pred_policy'})
+    return Problem([], [], [estimator, policy, dynamics_model]), dynamics_model
+
+
+def loop_data(nsteps=4, nsim=20):
+    data = DataDict({k: torch.rand(nsteps, nsim, 1)
+                     for k in ['Yp', 'Yf', 'Up', 'Df', 'Rf', 'Y_minf', 'Y_maxf', 'U_minf', 'U_maxf']})
+    data.name = 'loop_test'
+    return data
+
+
+def test_batched_closed_loop():
+    model, emulator = closed_loop()
+    data = loop_data()
+    dataset = SimpleNamespace(nstep_data={'Yf': data['Yf']}, norm=[], min_max_norms=dict())
+    reference = ClosedLoopSimulator(model=model, dataset=dataset, emulator=emulator).simulate(data)
+    batched = BatchedClosedLoopSimulator(model=model, dataset=dataset, emulator=emulator).simulate([data, data])
+    for k in ['Y', 'X', 'U', 'D', 'R']:
+        for scenario in range(2):
+            assert np.allclose(batched[k][:, scenario].numpy(), reference[k], atol=1e-6), k
+    assert torch.allclose(batched['U_pred'][:, :, 0], reference['U_pred'], atol=1e-6)
+
+
+def test_batched_closed_loop_test_eval():
+    model, emulator = closed_loop()
+    loops = {name: loop_data() for name in ['train_loop', 'dev_loop', 'test_loop']}
+    dataset = SimpleNamespace(nstep_data={'Yf': loops['test_loop']['Yf']}, norm=[], min_max_norms=dict(), **loops)
+    reference = ClosedLoopSimulator(model=model, dataset=dataset, emulator=emulator).test_eval()
+    batched = BatchedClosedLoopSimulator(model=model, dataset=dataset, emulator=emulator).test_eval()
+    assert set(batched) <= set(reference)
+    for k in ['Y', 'X', 'U', 'D', 'R', 'Ymin', 'Ymax', 'Umin', 'Umax']:
+        assert isinstance(batched[k], np.ndarray) and batched[k].shape == reference[k].shape, k
+        assert np.allclose(batched[k], reference[k], atol=1e-6), k
+    assert torch.allclose(batched['U_pred'], reference['U_pred'], atol=1e-6)
+
+
+def open_loop(estimator='kalman', nx=3, ny=2, nu=1, nd=1):
+    """
+    Kalman filter over the whole past horizon or a time delay estimator, followed by a linear state space model.
+    """
+    torch.manual_seed(0)
+    dims = {'x0': (nx,), 'x0_estim': (nx,), 'Yp': (10, ny), 'Yf': (10, ny), 'Uf': (10, nu), 'Df': (10, nd)}
+    dynamics_model = dynamics.linear(True, slim.Linear, blocks.MLP, dims, name='dynamics',
+                                     input_keys={'x0': 'x0_estim'})
+    if estimator == 'mlp':
+        estimator = estimators.MLPEstimator(dims, nsteps=4, window_size=4, hsizes=[8], name='estim')
+    else:
+        estimator = estimators.LinearKalmanFilter(model=dynamics_model, name='estim',
+                                                  steady_state=estimator == 'steady_state')
+    objective = Objective(['Y_pred_dynamics', 'Yf'], F.mse_loss, name='ref_loss')
+    return Problem([objective], [], [estimator, dynamics_model])
+
+
+@pytest.mark.parametrize('estimator', ['kalman', 'steady_state', 'mlp'])
+def test_batched_open_loop_unequal_lengths(estimator):
+    model = open_loop(estimator)
+    data = []
+    for length in [30, 20, 30, 17, 25, 31, 20]:
+        d = DataDict({k: torch.randn(length, 1, n) for k, n in
+                      [('Yp', 2), ('Yf', 2), ('Up', 1), ('Uf', 1), ('Dp', 1), ('Df', 1)]})
+        d.name = 'loop_dev'
+        data.append(d)
+    step, calls = model.step, []
+    model.step = lambda batch: calls.append(batch) or step(batch)
+    with torch.no_grad():
+        reference = MultiSequenceOpenLoopSimulator(model=model, dataset=None, batched=False).simulate(data)
+        assert len(calls) == len(data)
+        simulator = MultiSequenceOpenLoopSimulator(model=model, dataset=SimpleNamespace(dev_loop=data))
+        batched = simulator.dev_eval()
+    # a single pass over all sequences padded to the longest one
+    assert len(calls) == len(data) + 1 and calls[-1]['Yf'].shape == (31, 7, 2)
+    assert set(batched) == set(reference)
+    for k, v in reference.items():
+        assert batched[k].shape == v.shape, k
+        assert torch.allclose(batched[k], v, atol=1e-5), k
@@ -0,0 +1,57 @@
+import argparse
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+from neuromancer.checkpoints import CheckpointManager
+from neuromancer.loggers import BasicLogger
+from neuromancer.problem import Problem, Objective
+from neuromancer.simulators import OpenLoopSimulator
+from neuromancer.sweep import Sweep, grid
+from neuromancer.trainer import Trainer
+from neuromancer.visuals import Visualizer
+from test_trainer import Affine, nstep_data
+
+
+# this module doubles as the training script of the sweep, see neuromancer.sweep
+def parse():
+    parser = argparse.ArgumentParser()
+    opt_group = parser.add_argument_group('OPTIMIZATION PARAMETERS')
+    opt_group.add_argument('-epochs', type=int, default=2)
+    opt_group.add_argument('-lr', type=float, default=0.1)
+    data_group = parser.add_argument_group('DATA PARAMETERS')
+    data_group.add_argument('-nsamples', type=int, default=10)
+    log_group = parser.add_argument_group('LOGGING PARAMETERS')
+    log_group.add_argument('-savedir', type=str, default='test')
+    log_group.add_argument('-resume_every', type=int, default=None)
+    return parser
+
+
+def dataset_load(args, device):
+    torch.manual_seed(0)
+    return SimpleNamespace(train_data=nstep_data('nstep_train', nsamples=args.nsamples),
+                           dev_data=nstep_data('nstep_dev', nsamples=args.nsamples),
+                           dev_loop=nstep_data('loop_dev', nsamples=args.nsamples))
+
+
+def run(args, dataset):
+    problem = Problem([Objective(['Y_pred_affine', 'Yf'], F.mse_loss, name='ref_loss')], [], [Affine(2, 2)])
+    trainer = Trainer(problem, dataset, torch.optim.SGD(problem.parameters(), lr=args.lr),
+                      logger=BasicLogger(savedir=args.savedir, verbosity=1), visualizer=Visualizer(),
+                      simulator=OpenLoopSimulator(model=problem, dataset=dataset), epochs=args.epochs,
+                      checkpoint=CheckpointManager(problem, savedir=args.savedir, resume_every=args.resume_every))
+    epochs = []
+    train_epoch = trainer.train_epoch
+    trainer.train_epoch = lambda: epochs.append(1) or train_epoch()
+    trainer.train()
+    return {'best_devloss': float(trainer.best_devloss), 'trained': len(epochs)}
+
+
+def test_successive_halving_resumes(tmp_path):
+    """
+    The run promoted to the second rung continues from its first rung checkpoint instead of starting over.
+    """
+    results = Sweep(__name__, grid(lr=[0.1, 0.001]), base={'epochs': 4}, savedir=str(tmp_path),
+                    nprocs=1, min_epochs=2, eta=2).run()
+    assert [(r['epochs'], r['trained']) for r in results] == [(4, 2), (2, 2)]
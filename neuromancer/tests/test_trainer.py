@@ -0,0 +1,109 @@
+from copy import deepcopy
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from neuromancer.datasets import DataDict, get_batch
+from neuromancer.checkpoints import CheckpointManager
+from neuromancer.loggers import BasicLogger
+from neuromancer.problem import Problem, Objective
+from neuromancer.simulators import OpenLoopSimulator
+from neuromancer.trainer import Trainer
+from neuromancer.visuals import Visualizer
+
+
+class Affine(nn.Module):
+    def __init__(self, nin, nout):
+        super().__init__()
+        self.linear = nn.Linear(nin, nout)
+        self.input_keys = ['Yp']
+        self.name = 'affine'
+
+    def forward(self, data):
+        return {'Y_pred_affine': self.linear(data['Yp'])}
+
+
+def nstep_data(name, nsteps=4, nsamples=10, ny=2):
+    data = DataDict({'Yp': torch.randn(nsteps, nsamples, ny), 'Yf': torch.randn(nsteps, nsamples, ny)})
+    data.name = name
+    return data
+
+
+def build(tmp_path, resume_every=None, **kwargs):
+    torch.manual_seed(0)
+    problem = Problem([Objective(['Y_pred_affine', 'Yf'], F.mse_loss, name='ref_loss')], [], [Affine(2, 2)])
+    dataset = SimpleNamespace(train_data=nstep_data('nstep_train'), dev_data=nstep_data('nstep_dev'),
+                              test_data=nstep_data('nstep_test'), dev_loop=nstep_data('loop_dev'))
+    optimizer = torch.optim.SGD(problem.parameters(), lr=0.1)
+    logger = BasicLogger(savedir=str(tmp_path), verbosity=1)
+    simulator = OpenLoopSimulator(model=problem, dataset=dataset)
+    checkpoint = CheckpointManager(problem, savedir=str(tmp_path), resume_every=resume_every)
+    return Trainer(problem, dataset, optimizer, logger=logger, visualizer=Visualizer(), simulator=simulator,
+                   checkpoint=checkpoint, shuffle=False, **kwargs)
+
+
+def test_accumulation_last_group(tmp_path):
+    """
+    10 samples in mini-batches of 3 give groups of 3 and 1 mini-batches, each group step averages its own gradients.
+    """
+    trainer = build(tmp_path, batch_size=3, accumulate=3)
+    reference = deepcopy(trainer.model)
+    optimizer = torch.optim.SGD(reference.parameters(), lr=0.1)
+    data = trainer.dataset.train_data
+    for group in [[0, 1, 2], [3]]:
+        optimizer.zero_grad()
+        for k in group:
+            batch = get_batch(data, np.arange(3 * k, min(3 * k + 3, 10)))
+            (reference(batch)['nstep_train_loss'] / len(group)).backward()
+        optimizer.step()
+    trainer.train_epoch()
+    for p, q in zip(trainer.model.parameters(), reference.parameters()):
+        assert torch.allclose(p, q, atol=1e-6)
+
+
+def test_chunked_evaluation(tmp_path):
+    trainer = build(tmp_path, batch_size=3)
+    chunked = trainer.dataset_eval(trainer.dataset.dev_data)
+    trainer.batch_size = None
+    full = trainer.dataset_eval(trainer.dataset.dev_data)
+    assert set(chunked) == set(full)
+    for k, v in full.items():
+        assert torch.allclose(chunked[k], v, atol=1e-6), k
+
+
+def test_async_eval_snapshot(tmp_path):
+    """
+    The snapshot simulator must run on the snapshot model, including an emulator that is a component of the model.
+    """
+    trainer = build(tmp_path, async_eval=True)
+    component = trainer.model.components[0]
+    trainer.simulator = OpenLoopSimulator(model=trainer.model, dataset=trainer.dataset, emulator=component)
+    epoch, _ = trainer.submit_eval(3).result()
+    trainer.eval_executor.shutdown()
+    assert epoch == 3
+    assert trainer.eval_simulator.model is trainer.eval_model
+    assert trainer.eval_simulator.emulator is trainer.eval_model.components[0]
+    assert trainer.eval_simulator.dataset is trainer.dataset
+    live = {id(p) for p in trainer.model.parameters()}
+    assert not live & {id(p) for p in trainer.eval_simulator.emulator.parameters()}
+
+
+def test_resume(tmp_path):
+    """
+    A run interrupted after two epochs and restarted with four continues to the weights of an uninterrupted run.
+    """
+    full = build(tmp_path / 'full', epochs=4, batch_size=3)
+    full.train()
+    build(tmp_path / 'part', epochs=2, batch_size=3, resume_every=1).train()
+    resumed = build(tmp_path / 'part', epochs=4, batch_size=3, resume_every=1)
+    epochs = []
+    train_epoch = resumed.train_epoch
+    resumed.train_epoch = lambda: epochs.append(1) or train_epoch()
+    resumed.train()
+    assert len(epochs) == 2
+    assert resumed.best_devloss == full.best_devloss
+    for p, q in zip(resumed.model.parameters(), full.model.parameters()):
+        assert torch.equal(p, q)
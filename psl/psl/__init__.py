@@ -3,7 +3,18 @@ from .emulator import *
 from .nonautonomous import *
 from .datasets import *
 from .perturb import *
-from .plot import *
+
+
+def __getattr__(name):
+    # psl.plot and its plotting functions are loaded on first access so importing psl does not load matplotlib
+    import importlib
+    plot = importlib.import_module('.plot', __name__)
+    if name == 'plot':
+        return plot
+    if not name.startswith('_') and hasattr(plot, name):
+        return getattr(plot, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 emulators = {
     # non-autonomous ODEs
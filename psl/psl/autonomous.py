@@ -51,15 +51,9 @@ class Lorenz96(ODE_Autonomous):
         self.nx = self.N
 
     def equations(self, x, t):
-        # Compute state derivatives
-        dx = np.zeros(self.N)
-        # First the 3 edge cases: i=1,2,N
-        dx[0] = (x[1] - x[self.N - 2]) * x[self.N - 1] - x[0]
-        dx[1] = (x[2] - x[self.N - 1]) * x[0] - x[1]
-        dx[self.N - 1] = (x[0] - x[self.N - 3]) * x[self.N - 2] - x[self.N - 1]
-        # Then the general case
-        for i in range(2, self.N - 1):
-            dx[i] = (x[i + 1] - x[i - 2]) * x[i - 1] - x[i]
+        # Compute state derivatives dx[i] = (x[i+1] - x[i-2]) * x[i-1] - x[i] with periodic indices
+        x = np.asarray(x)
+        dx = (np.roll(x, -1, axis=0) - np.roll(x, 2, axis=0)) * np.roll(x, 1, axis=0) - x
         # Add the forcing term
         dx = dx + self.F
         return dx
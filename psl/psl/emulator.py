@@ -11,6 +11,150 @@ import gym
 from psl.perturb import Steps
 
 
+def rk4(equations, x0, t, U=None, nsubsteps=1):
+    """
+    Vectorized fixed step 4th order Runge-Kutta integration of a batch of initial conditions.
+    Equations are evaluated on arrays with the state on the first axis and the batch on the second axis,
+    i.e. x[i] in the equations is the i-th state of all batch elements.
+
+    :param equations: (callable) equations(x, t) or equations(x, t, u) returning dx/dt
+    :param x0: (ndarray, shape=(nbatch, nx)) Initial states
+    :param t: (ndarray, shape=(nsim+1,)) Time points
+    :param U: (ndarray, shape=(nsim, nbatch, nu)) Control inputs held constant over each time step
+    :param nsubsteps: (int) Number of integration steps per time step
+    :return: (ndarray, shape=(nsim, nbatch, nx)) States at time points t[1:]
+    """
+    x = np.asarray(x0, dtype=np.float64).T
+    X = np.empty((len(t) - 1, *x0.shape))
+    for N in range(len(t) - 1):
+        args = () if U is None else (U[N].T,)
+        f = lambda x, t: np.asarray(equations(x, t, *args), dtype=np.float64).reshape(x.shape)
+        h = (t[N + 1] - t[N]) / nsubsteps
+        for k in range(nsubsteps):
+            tk = t[N] + k * h
+            k1 = f(x, tk)
+            k2 = f(x + h / 2 * k1, tk + h / 2)
+            k3 = f(x + h / 2 * k2, tk + h / 2)
+            k4 = f(x + h * k3, tk + h)
+            x = x + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        X[N] = x.T
+    return X
+
+
+# Dormand-Prince 5(4) Butcher tableau
+DP_C = [0., 1/5, 3/10, 4/5, 8/9, 1., 1.]
+DP_A = [[1/5],
+        [3/40, 9/40],
+        [44/45, -56/15, 32/9],
+        [19372/6561, -25360/2187, 64448/6561, -212/729],
+        [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+        [35/384, 0., 500/1113, 125/192, -2187/6784, 11/84]]
+DP_E = [71/57600, 0., -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+
+def rk45(equations, x0, t, U=None, rtol=1.49012e-8, atol=1.49012e-8, hmin=1e-12):
+    """
+    Vectorized adaptive Dormand-Prince 5(4) integration of a batch of initial conditions.
+    The batch shares a step size controlled by the largest local error estimate among batch elements.
+    Equations are evaluated on arrays with the state on the first axis and the batch on the second axis.
+
+    :param equations: (callable) equations(x, t) or equations(x, t, u) returning dx/dt
+    :param x0: (ndarray, shape=(nbatch, nx)) Initial states
+    :param t: (ndarray, shape=(nsim+1,)) Time points
+    :param U: (ndarray, shape=(nsim, nbatch, nu)) Control inputs held constant over each time step
+    :param rtol: (float) Relative error tolerance
+    :param atol: (float) Absolute error tolerance
+    :param hmin: (float) Minimum step size relative to the sampling interval, smaller steps are accepted regardless of error
+    :return: (ndarray, shape=(nsim, nbatch, nx)) States at time points t[1:]
+    """
+    x = np.asarray(x0, dtype=np.float64).T
+    X = np.empty((len(t) - 1, *x0.shape))
+    h = t[1] - t[0]
+    for N in range(len(t) - 1):
+        args = () if U is None else (U[N].T,)
+        f = lambda x, t: np.asarray(equations(x, t, *args), dtype=np.float64).reshape(x.shape)
+        tk, tend = t[N], t[N + 1]
+        while tend - tk > 1e-10 * (t[N + 1] - t[N]):
+            hk = min(h, tend - tk)
+            k = [f(x, tk)]
+            for c, a in zip(DP_C[1:], DP_A):
+                k.append(f(x + hk * sum(aj * kj for aj, kj in zip(a, k)), tk + c * hk))
+            x_new = x + hk * sum(bj * kj for bj, kj in zip(DP_A[-1], k))
+            scale = atol + rtol * np.maximum(np.abs(x), np.abs(x_new))
+            error = hk * sum(ej * kj for ej, kj in zip(DP_E, k)) / scale
+            error = np.nan_to_num(np.sqrt(np.mean(error ** 2, axis=0)).max(), nan=np.inf)
+            if error <= 1.0 or hk <= hmin * (t[N + 1] - t[N]):
+                tk, x = tk + hk, x_new
+            h = max(hmin * (t[N + 1] - t[N]), hk) * min(5.0, max(0.2, 0.9 * error ** -0.2)) if error > 0 else 5.0 * hk
+        X[N] = x.T
+    return X
+
+
+integrators = {'rk4': rk4, 'rk45': rk45}
+
+
+def batch_x0(x0, nx, nbatch=None):
+    """
+    :param x0: (ndarray, shape=(nx,) or (nbatch, nx)) Initial conditions
+    :param nx: (int) Number of states
+    :param nbatch: (int) Number of batch elements to repeat a single initial condition for
+    :return: (ndarray, shape=(nbatch, nx))
+    """
+    x0 = np.asarray(x0, dtype=np.float64).reshape(-1, nx)
+    if nbatch is not None and x0.shape[0] == 1:
+        x0 = np.repeat(x0, nbatch, axis=0)
+    return x0
+
+
+def lti_rollout(A, W, x0, block=None):
+    """
+    Rollout of the linear state recurrence x_{k+1} = A x_k + w_k for a batch of initial states.
+    With the block formulation the sequence is split into blocks of length L; the input responses of all blocks
+    are accumulated at once, block initial states are propagated with A^L, and the states inside the blocks
+    are recovered with precomputed matrix powers, so only about 2*sqrt(nsim) sequential steps remain.
+
+    :param A: (ndarray, shape=(nx, nx)) State transition matrix
+    :param W: (ndarray, shape=(nsim, nbatch, nx)) Precomputed input responses w_k
+    :param x0: (ndarray, shape=(nbatch, nx)) Initial states
+    :param block: (int) Block length, 1 gives the plain step by step recurrence. Defaults to sqrt(nsim) for small
+                  nbatch*nx, where per step overhead dominates, and to 1 otherwise as blocks double the flop count.
+    :return: (ndarray, shape=(nsim, nbatch, nx)) States x_1, ..., x_nsim
+    """
+    nsim, nbatch, nx = W.shape
+    if block is None:
+        block = int(np.sqrt(nsim)) if nbatch * nx < 256 else 1
+    L = max(1, min(block, nsim))
+    AT = np.ascontiguousarray(A.T)
+    if L == 1:
+        X = np.empty_like(W)
+        x = x0
+        for k in range(nsim):
+            x = X[k] = x @ AT + W[k]
+        return X
+    nblocks = -(-nsim // L)
+    Wb = np.zeros((nblocks * L, nbatch, nx), dtype=W.dtype)
+    Wb[:nsim] = W
+    Wb = Wb.reshape(nblocks, L, nbatch, nx).transpose(1, 0, 2, 3)
+    # zero state responses of all blocks at once: S[j] = A S[j-1] + W[j]
+    S = np.empty_like(Wb)
+    S[0] = Wb[0]
+    for j in range(1, L):
+        S[j] = S[j - 1] @ AT + Wb[j]
+    # transposed powers A^1, ..., A^L
+    P = np.empty((L, nx, nx), dtype=AT.dtype)
+    P[0] = AT
+    for j in range(1, L):
+        P[j] = P[j - 1] @ AT
+    # initial state of each block
+    Xb = np.empty((nblocks, nbatch, nx), dtype=W.dtype)
+    x = x0
+    for b in range(nblocks):
+        Xb[b] = x
+        x = x @ P[-1] + S[-1, b]
+    X = np.matmul(Xb.reshape(1, nblocks * nbatch, nx), P).reshape(L, nblocks, nbatch, nx) + S
+    return X.transpose(1, 0, 2, 3).reshape(nblocks * L, nbatch, nx)[:nsim]
+
+
 class EmulatorBase(ABC):
     """
     base class of the emulator
@@ -132,6 +276,26 @@ class ODE_Autonomous(EmulatorBase):
         Yout = np.asarray(X).reshape(nsim, -1)
         return {'Y': Yout, 'X': np.asarray(X)}
 
+    def simulate_batch(self, ninit=None, nsim=None, ts=None, x0=None, method='rk45', **kwargs):
+        """
+        Simulate a batch of initial conditions at once with a vectorized integrator.
+
+        :param nsim: (int) Number of steps for open loop response
+        :param ninit: (float) initial simulation time
+        :param ts: (float) step size, sampling time
+        :param x0: (ndarray, shape=(nbatch, self.nx)) state initial conditions
+        :param method: (str) 'rk45' for adaptive Dormand-Prince or 'rk4' for fixed step Runge-Kutta
+        :param kwargs: Integrator options, rtol and atol for rk45 or nsubsteps for rk4
+        :return: The response matrices, i.e. X, dims=(nsim, nbatch, self.nx)
+        """
+        ninit = self.ninit if ninit is None else ninit
+        nsim = self.nsim if nsim is None else nsim
+        ts = self.ts if ts is None else ts
+        x0 = batch_x0(self.x0 if x0 is None else x0, self.nx)
+        t = np.arange(0, nsim+1) * ts + ninit
+        X = integrators[method](self.equations, x0, t, **kwargs)
+        return {'Y': X, 'X': X}
+
 
 class ODE_NonAutonomous(EmulatorBase, ABC):
     """
@@ -183,6 +347,31 @@ class ODE_NonAutonomous(EmulatorBase, ABC):
         Uout = np.asarray(U).reshape(nsim, -1)
         return {'Y': Yout, 'U': Uout, 'X': np.asarray(X)}
 
+    def simulate_batch(self, U=None, ninit=None, nsim=None, ts=None, x0=None, method='rk45', **kwargs):
+        """
+        Simulate a batch of initial conditions and control sequences at once with a vectorized integrator.
+
+        :param U: (ndarray, shape=(nsim, nbatch, self.nu) or (nsim, self.nu)) control signals,
+                  a single sequence is applied to all batch elements
+        :param nsim: (int) Number of steps for open loop response
+        :param ninit: (float) initial simulation time
+        :param ts: (float) step size, sampling time
+        :param x0: (ndarray, shape=(nbatch, self.nx) or (self.nx,)) state initial conditions
+        :param method: (str) 'rk45' for adaptive Dormand-Prince or 'rk4' for fixed step Runge-Kutta
+        :param kwargs: Integrator options, rtol and atol for rk45 or nsubsteps for rk4
+        :return: X, Y, U, dims=(nsim, nbatch, dim)
+        """
+        ninit = self.ninit if ninit is None else ninit
+        nsim = self.nsim if nsim is None else nsim
+        ts = self.ts if ts is None else ts
+        U = np.asarray(self.U if U is None else U, dtype=np.float64)[:nsim]
+        U = U.reshape(nsim, 1, -1) if U.ndim < 3 else U
+        x0 = batch_x0(self.x0 if x0 is None else x0, self.nx, U.shape[1])
+        U = np.broadcast_to(U, (nsim, x0.shape[0], U.shape[-1]))
+        t = np.arange(0, nsim+1) * ts + ninit
+        X = integrators[method](self.equations, x0, t, U=U, **kwargs)
+        return {'Y': X, 'U': np.array(U), 'X': X}
+
 
 class GymWrapper(EmulatorBase):
     """
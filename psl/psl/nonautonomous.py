@@ -10,7 +10,7 @@ import os
 from psl.emulator import ODE_NonAutonomous
 from psl.perturb import Steps
 from psl.perturb import SplineSignal
-from psl.emulator import SSM
+from psl.emulator import SSM, batch_x0, lti_rollout
 from psl.perturb import Periodic, RandomWalk
 
 
@@ -100,8 +100,7 @@ class Tank(ODE_NonAutonomous):
         valve = u[1]
         # equations
         dx_dt = (c / (self.rho*self.A)) * valve
-        if x >= 1.0 and dx_dt > 0.0:
-            dx_dt = 0
+        dx_dt = np.where((x >= 1.0) & (dx_dt > 0.0), 0.0, dx_dt)
         return dx_dt
 
 
@@ -138,10 +137,8 @@ class TwoTank(ODE_NonAutonomous):
         # equations
         dhdt1 = self.c1 * (1.0 - valve) * pump - self.c2 * np.sqrt(h1)
         dhdt2 = self.c1 * valve * pump + self.c2 * np.sqrt(h1) - self.c2 * np.sqrt(h2)
-        if h1 >= 1.0 and dhdt1 > 0.0:
-            dhdt1 = 0
-        if h2 >= 1.0 and dhdt2 > 0.0:
-            dhdt2 = 0
+        dhdt1 = np.where((h1 >= 1.0) & (dhdt1 > 0.0), 0.0, dhdt1)
+        dhdt2 = np.where((h2 >= 1.0) & (dhdt2 > 0.0), 0.0, dhdt2)
         dhdt = [dhdt1, dhdt2]
         return dhdt
 
@@ -193,7 +190,7 @@ class CSTR(ODE_NonAutonomous):
     def equations(self, x, t, u):
         # Inputs (1):
         # Temperature of cooling jacket (K)
-        Tc = u
+        Tc = u[0]
         # Disturbances (2):
         # Tf = Feed Temperature (K)
         # Caf = Feed Concentration (mol/m^3)
@@ -211,9 +208,7 @@ class CSTR(ODE_NonAutonomous):
         dTdt = self.q / self.V * (self.Tf - T) \
                + self.mdelH / (self.rho * self.Cp) * rA \
                + self.UA / self.V / self.rho / self.Cp * (Tc - T)
-        xdot = np.zeros(2)
-        xdot[0] = dCadt
-        xdot[1] = dTdt
+        xdot = [dCadt, dTdt]
         return xdot
 
       
@@ -266,13 +261,10 @@ class UAV3D_kin(ODE_NonAutonomous):
         U2 = u[1]
         U3 = u[2]
 
-        dx_dt = np.zeros(4)
-        dx_dt[0] = U1 * np.cos(x[3])
-        dx_dt[1] = U1 * np.sin(x[3])
-        dx_dt[2] = U2
-        if x[2] <= self.h:
-            dx_dt[2] = 0.0
-        dx_dt[3] = U3
+        dx_dt = [U1 * np.cos(x[3]),
+                 U1 * np.sin(x[3]),
+                 np.where(x[2] <= self.h, 0.0, U2),
+                 U3]
 
         return dx_dt
 
@@ -310,13 +302,12 @@ class UAV2D_kin(ODE_NonAutonomous):
 
         # Inputs
         V = self.V
-        phi = u
+        phi = u[0] if np.ndim(u) > 0 else u
 
-        dx_dt = np.zeros(4)
-        dx_dt[0] = V * np.cos(x[3])
-        dx_dt[1] = V * np.sin(x[3])
-        dx_dt[2] = 0.0
-        dx_dt[3] = (self.g/V) * (np.tan(phi))
+        dx_dt = [V * np.cos(x[3]),
+                 V * np.sin(x[3]),
+                 np.zeros_like(x[2]),
+                 (self.g/V) * (np.tan(phi))]
 
         return dx_dt
 
@@ -368,12 +359,9 @@ class UAV3D_reduced(ODE_NonAutonomous):
         U2 = u[1]
         U3 = u[2]
 
-        dx_dt = np.zeros(3)
-        dx_dt[0] = U1 * np.cos(U3)
-        dx_dt[1] = U1 * np.sin(U3)
-        dx_dt[2] = U2
-        if x[2] <= self.h:
-            dx_dt[2] = 0.0
+        dx_dt = [U1 * np.cos(U3),
+                 U1 * np.sin(U3),
+                 np.where(x[2] <= self.h, 0.0, U2)]
 
         return dx_dt
 
@@ -431,14 +419,12 @@ class UAV3D_dyn(ODE_NonAutonomous):
         drag = self.rho * V ** 2 * self.S * CD   # Total drag
         # T = drag         # For level flight
 
-        dx_dt = np.zeros(6)
-
-        dx_dt[0] = V * np.cos(x[3]) * np.cos(x[4])
-        dx_dt[1] = V * np.sin(x[3]) * np.cos(x[4])
-        dx_dt[2] = V * np.sin(x[4])
-        dx_dt[3] = (self.g/V) * (load * np.sin(phi)) / np.cos(x[4])
-        dx_dt[4] = (self.g/V) * (load * np.cos(phi) - np.cos(x[4]))
-        dx_dt[5] = self.g * ((T - drag)/self.W - np.sin(x[4]))
+        dx_dt = [V * np.cos(x[3]) * np.cos(x[4]),
+                 V * np.sin(x[3]) * np.cos(x[4]),
+                 V * np.sin(x[4]),
+                 (self.g/V) * (load * np.sin(phi)) / np.cos(x[4]),
+                 (self.g/V) * (load * np.cos(phi) - np.cos(x[4])),
+                 self.g * ((T - drag)/self.W - np.sin(x[4]))]
 
         return dx_dt
 
@@ -477,7 +463,7 @@ class HindmarshRose(ODE_NonAutonomous):
         # Derivatives
         theta = -self.a*x[0]**3 + self.b*x[0]**2
         phi = self.c -self.d*x[0]**2
-        dx1 = x[1] + theta - x[2] + u
+        dx1 = x[1] + theta - x[2] + (u[0] if np.ndim(u) > 0 else u)
         dx2 = phi - x[1]
         dx3 = self.r*(self.s*(x[0]-self.xR)-x[2])
         dx = [dx1, dx2, dx3]
@@ -579,14 +565,61 @@ class BuildingEnvelope(SSM):
             self.DT = RandomWalk(nx=self.n_dT, nsim=self.nsim, xmax=self.dT_max*0.6, xmin=self.dT_min, sigma=0.05)
             self.U = np.hstack([self.M_flow, self.DT])
 
-    def equations(self, x, u, d):
+    def heat_flow(self, u):
+        """
+        :param u: (ndarray, shape=(..., self.nu)) control inputs, heat flows or mass flows and temperature differences
+        :return: (ndarray, shape=(..., self.nq)) heat flows
+        """
         if self.linear:
-            q = u
-        else:
-            m_flow = u[0:self.n_mf]
-            dT = u[self.n_mf:self.n_mf+self.n_dT]
-            q = m_flow * self.rho * self.cp * self.time_reg * dT
+            return u
+        m_flow = u[..., 0:self.n_mf]
+        dT = u[..., self.n_mf:self.n_mf+self.n_dT]
+        return m_flow * self.rho * self.cp * self.time_reg * dT
+
+    def equations(self, x, u, d):
+        q = self.heat_flow(u)
         x = np.matmul(self.A, x) + np.matmul(self.B, q) + np.matmul(self.E, d) + self.G.ravel()
         y = np.matmul(self.C, x) + self.F.ravel()
         return x, y
 
+    def simulate(self, ninit=None, nsim=None, U=None, D=None, x0=None, **kwargs):
+        """
+        :param nsim: (int) Number of steps for open loop response
+        :param U: (ndarray, shape=(nsim, self.nu)) control signals
+        :param D: (ndarray, shape=(nsim, self.nd)) measured disturbance signals
+        :param x0: (ndarray, shape=(self.nx)) Initial state.
+        :return: The response matrices, i.e. X, Y, U, D
+        """
+        if x0 is not None:
+            assert x0.shape[0] == self.nx, "Mismatch in x0 size"
+        out = self.simulate_batch(ninit=ninit, nsim=nsim, U=U, D=D, x0=x0, **kwargs)
+        return {k: v[:, 0] for k, v in out.items()}
+
+    def simulate_batch(self, ninit=None, nsim=None, U=None, D=None, x0=None, block=None, **kwargs):
+        """
+        Open loop response of a batch of initial states and input sequences.
+        The building envelope dynamics are linear in the states, hence the heat flow and disturbance responses
+        are computed for all time steps at once and the state recurrence is rolled out with lti_rollout.
+
+        :param nsim: (int) Number of steps for open loop response
+        :param U: (ndarray, shape=(nsim, nbatch, self.nu) or (nsim, self.nu)) control signals
+        :param D: (ndarray, shape=(nsim, nbatch, self.nd) or (nsim, self.nd)) measured disturbance signals
+        :param x0: (ndarray, shape=(nbatch, self.nx) or (self.nx,)) Initial states
+        :param block: (int) Block length of the rollout, see lti_rollout
+        :return: The response matrices, i.e. X, Y, U, D, dims=(nsim, nbatch, dim)
+        """
+        ninit = self.ninit if ninit is None else ninit
+        nsim = self.nsim if nsim is None else nsim
+        U = np.asarray(self.U[ninit: ninit + nsim, :] if U is None else U, dtype=np.float64)
+        D = np.asarray(self.D[ninit: ninit + nsim, :] if D is None else D, dtype=np.float64)
+        U = U.reshape(nsim, 1, self.nu) if U.ndim < 3 else U
+        D = D.reshape(nsim, 1, self.nd) if D.ndim < 3 else D
+        x0 = batch_x0(self.x0 if x0 is None else x0, self.nx, max(U.shape[1], D.shape[1]))
+        # input responses are computed before broadcasting shared sequences over the batch
+        W = self.heat_flow(U) @ self.B.T + D @ self.E.T + self.G.ravel()
+        X = lti_rollout(self.A, np.broadcast_to(W, (nsim, x0.shape[0], self.nx)), x0, block=block)
+        U = np.broadcast_to(U, (nsim, x0.shape[0], self.nu))
+        D = np.broadcast_to(D, (nsim, x0.shape[0], self.nd))
+        Y = X @ self.C.T + self.F.ravel()
+        return {'X': X + np.ravel(self.x_ss), 'Y': Y - np.ravel(self.y_ss), 'U': np.array(U), 'D': np.array(D)}
+
@@ -1,5 +1,10 @@
 """
 Base Control Profiles for System excitation
+
+All profiles return arrays of shape (nsim, nx) and are computed with array operations over time and signals.
+Random profiles draw from rng, which may be a np.random.Generator or a seed for one, so that many independent
+signals are produced in one call and reproduced exactly. Without rng they draw from the global numpy random state
+and return the same values as before, RandomWalk then keeps its sequential redrawing walk.
 """
 
 import numpy as np
@@ -8,57 +13,88 @@ from scipy import interpolate
 from scipy import signal as sig
 
 
-def RandomWalk(nx=1, nsim=100, xmax=1, xmin=0, sigma=0.05, rseed=1):
+def get_rng(rng=None):
+    """
+    :param rng: (np.random.Generator/int/None) Generator, seed of a new generator or None for the global numpy state
+    :return: np.random.Generator or the np.random module
     """
+    return np.random if rng is None else np.random.default_rng(rng)
 
-    :param nx:
-    :param nsim:
-    :param xmax:
-    :param xmin:
-    :return:
+
+def bounds(nx, xmax, xmin):
+    """
+    :param nx: (int) Number signals
+    :param xmax: (int/list/ndarray) signal maximum value, scalar or one per signal
+    :param xmin: (int/list/ndarray) signal minimum value, scalar or one per signal
+    :return: (tuple of ndarray, shape=(nx,))
     """
+    return (np.broadcast_to(np.asarray(xmax, dtype=float).ravel(), (nx,)),
+            np.broadcast_to(np.asarray(xmin, dtype=float).ravel(), (nx,)))
 
-    rd.seed(rseed)
 
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray(nx*[xmax]).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray(nx*[xmin]).ravel()
+def legacy_walk(nx, nsim, sigma):
+    """
+    Random walks on [0, 1] from the global numpy random state, a step leaving the interval is redrawn
+    towards its inside. Steps depend on the previous ones, so the walks are computed one step at a time.
 
-    Signals = []
+    :param nx: (int) Number signals
+    :param nsim: (int) Number time steps
+    :param sigma: (float) standard deviation of the steps
+    :return: (ndarray, shape=(nsim, nx))
+    """
+    walk = np.zeros((nsim, nx))
     for k in range(nx):
-        Signal = [0]
         for t in range(1, nsim):
-            yt = Signal[t - 1] + np.random.normal(0, sigma)
-            if (yt > 1):
-                yt = Signal[t - 1] - abs(np.random.normal(0, sigma))
-            elif (yt < 0):
-                yt = Signal[t - 1] + abs(np.random.normal(0, sigma))
-            Signal.append(yt)
-        Signals.append(xmin[k] + (xmax[k] - xmin[k])*np.asarray(Signal))
-    return np.asarray(Signals).T
+            yt = walk[t - 1, k] + np.random.normal(0, sigma)
+            if yt > 1:
+                yt = walk[t - 1, k] - abs(np.random.normal(0, sigma))
+            elif yt < 0:
+                yt = walk[t - 1, k] + abs(np.random.normal(0, sigma))
+            walk[t, k] = yt
+    return walk
 
 
-def WhiteNoise(nx=1, nsim=100, xmax=1, xmin=0, rseed=1):
+def RandomWalk(nx=1, nsim=100, xmax=1, xmin=0, sigma=0.05, rseed=1, rng=None):
     """
-    White Noise
+    Gaussian random walks starting at xmin and kept within xmin and xmax. With an rng the walks are reflected
+    at the bounds and computed with array operations. Without an rng they are the walks of legacy_walk, which
+    the emulators, e.g. BuildingEnvelope, rely on for reproducible trajectories.
+
     :param nx: (int) Number signals
     :param nsim: (int) Number time steps
     :param xmax: (int/list/ndarray) signal maximum value
     :param xmin: (int/list/ndarray) signal minimum value
+    :param sigma: (float) standard deviation of the steps relative to xmax - xmin
+    :param rseed: (int) legacy seed of the python random module, unused by the numpy draws
+    :param rng: (np.random.Generator/int) random number generator or its seed
+    :return: (ndarray, shape=(nsim, nx))
     """
-
     rd.seed(rseed)
+    xmax, xmin = bounds(nx, xmax, xmin)
+    if rng is None:
+        return xmin + (xmax - xmin)*legacy_walk(nx, nsim, sigma)
+    steps = get_rng(rng).normal(0, sigma, size=(nsim, nx))
+    steps[0] = 0.0
+    # folding the free walk onto [0, 1] reflects it at both bounds
+    walk = np.cumsum(steps, axis=0) % 2.0
+    walk = np.where(walk > 1.0, 2.0 - walk, walk)
+    return xmin + (xmax - xmin)*walk
 
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray(nx*[xmax]).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray(nx*[xmin]).ravel()
-    Signal = []
-    for k in range(nx):
-        signal = xmin[k] + (xmax[k] - xmin[k])*np.random.rand(nsim)
-        Signal.append(signal)
-    return np.asarray(Signal).T
+
+def WhiteNoise(nx=1, nsim=100, xmax=1, xmin=0, rseed=1, rng=None):
+    """
+    White Noise
+    :param nx: (int) Number signals
+    :param nsim: (int) Number time steps
+    :param xmax: (int/list/ndarray) signal maximum value
+    :param xmin: (int/list/ndarray) signal minimum value
+    :param rseed: (int) legacy seed of the python random module, unused by the numpy draws
+    :param rng: (np.random.Generator/int) random number generator or its seed
+    """
+    rd.seed(rseed)
+    xmax, xmin = bounds(nx, xmax, xmin)
+    # signal by signal, as the global numpy state drew them before
+    return xmin + (xmax - xmin)*get_rng(rng).random((nx, nsim)).T
 
 
 def Step(nx=1, nsim=100, tstep=50, xmax=1, xmin=0, rseed=1):
@@ -66,56 +102,39 @@ def Step(nx=1, nsim=100, tstep=50, xmax=1, xmin=0, rseed=1):
     step change
     :param nx: (int) Number signals
     :param nsim: (int) Number time steps
-    :param tstep: (int) time of the step
+    :param tstep: (int/list/ndarray) time of the step, scalar or one per signal
     :param xmax: (int/list/ndarray) signal maximum value
     :param xmin: (int/list/ndarray) signal minimum value
     """
-
     rd.seed(rseed)
-
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray(nx * [xmax]).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray(nx * [xmin]).ravel()
-    Signal = []
-    for k in range(nx):
-        signal = np.ones(nsim)
-        signal[0:tstep] = xmin[k]
-        signal[tstep:] = xmax[k]
-        Signal.append(signal)
-    return np.asarray(Signal).T
-
+    xmax, xmin = bounds(nx, xmax, xmin)
+    t = np.arange(nsim).reshape(-1, 1)
+    return np.where(t < np.asarray(tstep).ravel(), xmin, xmax)
 
 
-def Steps(nx=1, nsim=100, values=None, randsteps=5, xmax=1, xmin=0, rseed=1):
+def Steps(nx=1, nsim=100, values=None, randsteps=5, xmax=1, xmin=0, rseed=1, rng=None):
     """
 
     :param nx: (int) Number signals
     :param nsim: (int) Number time steps
-    :param values: (list/ndarray) sequence of step changes, e.g., [0.4, 0.8, 1, 0.7, 0.3, 0.0]
+    :param values: (list/ndarray) sequence of step changes, e.g., [0.4, 0.8, 1, 0.7, 0.3, 0.0],
+                   shape=(nchanges,) shared by all signals or shape=(nchanges, nx)
     :param randsteps: (int) number of random step changes if values is None
     :param xmax: (int/ndarray) signal maximum value
     :param xmin: (int/ndarray) signal minimum value
+    :param rseed: (int) legacy seed of the python random module, unused by the numpy draws
+    :param rng: (np.random.Generator/int) random number generator or its seed
     :return:
     """
-
     rd.seed(rseed)
-
     if values is None:
-        values = np.round(np.random.rand(randsteps), 3)
-    if type(values) is not np.ndarray:
-        values = np.asarray([values]).ravel()
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray(nx*[xmax]).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray(nx*[xmin]).ravel()
+        values = np.round(get_rng(rng).random(randsteps), 3)
+    values = np.atleast_1d(np.asarray(values, dtype=float))
+    values = values.reshape(len(values), -1)
+    xmax, xmin = bounds(nx, xmax, xmin)
 
     step_length = int(np.ceil(nsim/len(values)))
-    signal = np.ones([nx, nsim])
-    for j in range(nx):
-        for k in range(len(values)):
-            signal[j, k*step_length:(k+1)*step_length] = values[k]*(xmax[j]-xmin[j])+xmin[j]
-    return signal.T
+    return values[np.arange(nsim) // step_length]*(xmax - xmin) + xmin
 
 
 def sawtooth(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0, rseed=1):
@@ -123,28 +142,16 @@ def sawtooth(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0, rseed=1):
     ramp change
     :param nx: (int) Number signals
     :param nsim: (int) Number time steps
-    :param numPeriods: (int) Number of periods
+    :param numPeriods: (int/list/ndarray) Number of periods, scalar or one per signal
     :param xmax: (int/list/ndarray) signal maximum value
     :param xmin: (int/list/ndarray) signal minimum value
     """
-
     rd.seed(rseed)
-
-    assert nsim >= numPeriods, 'numPeriods must be smaller than nsim'
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray([xmax] * nx).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray([xmin] * nx).ravel()
-
-    xmax = xmax.reshape(nx)
-    xmin = xmin.reshape(nx)
-
-    t = np.linspace(0, 1, nsim)
-    Signal = []
-    for k in range(nx):
-        signal = xmin[k] + (xmax[k] - xmin[k])*(0.5 * (sig.sawtooth(2 * np.pi * numPeriods * t) + 1))
-        Signal.append(signal)
-    return np.asarray(Signal).T
+    numPeriods = np.asarray(numPeriods).ravel()
+    assert np.all(nsim >= numPeriods), 'numPeriods must be smaller than nsim'
+    xmax, xmin = bounds(nx, xmax, xmin)
+    t = np.linspace(0, 1, nsim).reshape(-1, 1)
+    return xmin + (xmax - xmin)*(0.5 * (sig.sawtooth(2 * np.pi * numPeriods * t) + 1))
 
 
 def Periodic(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0, form='sin', rseed=1):
@@ -152,49 +159,37 @@ def Periodic(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0, form='sin', rseed=1):
     periodic signals, sine, cosine
     :param nx: (int) Number signals
     :param nsim: (int) Number time steps
-    :param numPeriods: (int) Number of periods
+    :param numPeriods: (int/list/ndarray) Number of periods, scalar or one per signal
     :param xmax: (int/list/ndarray) signal maximum value
     :param xmin: (int/list/ndarray) signal minimum value
     :param form: (str) form of the periodic signal 'sin' or 'cos'
     """
-
     rd.seed(rseed)
+    numPeriods = np.asarray(numPeriods).ravel()
+    assert np.all(nsim >= numPeriods), 'numPeriods must be smaller than nsim'
+    xmax, xmin = bounds(nx, xmax, xmin)
 
-    assert nsim >= numPeriods, 'numPeriods must be smaller than nsim'
-    if type(xmax) is not np.ndarray:
-        xmax = np.asarray([xmax]*nx).ravel()
-    if type(xmin) is not np.ndarray:
-        xmin = np.asarray([xmin]*nx).ravel()
-
-    xmax = xmax.reshape(nx)
-    xmin = xmin.reshape(nx)
-
-    samples_period = nsim// numPeriods
-    leftover = nsim % numPeriods
-    Signal = []
-    extraPeriods = 0
-    if leftover > samples_period:
-        extraPeriods = leftover//samples_period
-        leftover = leftover % samples_period
-    for k in range(nx):
-        if form == 'sin':
-            base = xmin[k] + (xmax[k] - xmin[k])*(0.5 + 0.5 * np.sin(np.arange(0, 2 * np.pi, 2 * np.pi / samples_period)))
-        elif form == 'cos':
-            base = xmin[k] + (xmax[k] - xmin[k])*(0.5 + 0.5 * np.cos(np.arange(0, 2 * np.pi, 2 * np.pi / samples_period)))
-        signal = np.tile(base, numPeriods+extraPeriods)
-        signal = np.append(signal, base[0:leftover])
-        Signal.append(signal)
-    return np.asarray(Signal).T
-
-  
-def SplineSignal(nsim=500, values=None, xmin=0, xmax=1, rseed=1):
+    # each period spans nsim // numPeriods samples and the last period is cut at nsim
+    samples_period = nsim // numPeriods
+    phase = 2 * np.pi * (np.arange(nsim).reshape(-1, 1) % samples_period) / samples_period
+    base = np.sin(phase) if form == 'sin' else np.cos(phase)
+    return xmin + (xmax - xmin)*(0.5 + 0.5 * base)
+
+
+def SplineSignal(nsim=500, values=None, xmin=0, xmax=1, rseed=1, rng=None):
     """
     Generates a smooth cubic spline trajectory by interpolating
     between data points
+
+    :param rng: (np.random.Generator/int) random number generator or its seed for the values,
+                by default the values are drawn from the python random module seeded with rseed
     """
     if values is None:
-        rd.seed(rseed)
-        values = [rd.triangular(xmin, xmax) for _ in range(30)]
+        if rng is None:
+            rd.seed(rseed)
+            values = [rd.triangular(xmin, xmax) for _ in range(30)]
+        else:
+            values = get_rng(rng).triangular(xmin, (xmin + xmax) / 2, xmax, size=30)
     dt = int(np.ceil(nsim / len(values)))
     dt_time = np.arange(0, nsim, dt)
     cs = interpolate.CubicSpline(dt_time, values, extrapolate='periodic')
@@ -216,4 +211,3 @@ def SignalSeries():
     allows combining sequence of different signals
     """
     pass
-
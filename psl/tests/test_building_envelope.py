@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import psl
+from psl.emulator import SSM, lti_rollout
+
+
+def building(system, linear):
+    """
+    The default Reno_full parameters are not shipped, load one of the available buildings instead.
+    """
+    model = object.__new__(psl.BuildingEnvelope)
+    model.resource_path = os.path.join(os.path.dirname(psl.__file__), 'parameters/buildings')
+    model.parameters(system=system, linear=linear)
+    return model
+
+
+def test_simulate_matches_step_loop():
+    for system in ['SimpleSingleZone', 'Infrax_ROM100']:
+        for linear in [True, False]:
+            model = building(system, linear)
+            out = model.simulate(nsim=200)
+            reference = SSM.simulate(model, nsim=200)
+            for k in ['X', 'Y', 'U', 'D']:
+                assert np.allclose(out[k], reference[k], rtol=1e-10, atol=1e-10), (system, linear, k)
+
+
+def test_simulate_batch_columns():
+    model = building('SimpleSingleZone', linear=False)
+    x0 = model.x0.reshape(1, -1) + np.array([[0.0], [1.0]])
+    batch = model.simulate_batch(nsim=100, x0=x0)
+    for j in range(2):
+        reference = SSM.simulate(model, nsim=100, x0=x0[j])
+        assert np.allclose(batch['X'][:, j], reference['X'], rtol=1e-10, atol=1e-10)
+        assert np.allclose(batch['Y'][:, j], reference['Y'], rtol=1e-10, atol=1e-10)
+
+
+def test_lti_rollout_blocks():
+    A = 0.3 * np.random.rand(5, 5)
+    W, x0 = np.random.rand(50, 3, 5), np.random.rand(3, 5)
+    reference = lti_rollout(A, W, x0, block=1)
+    for block in [4, 7, 50]:
+        assert np.allclose(lti_rollout(A, W, x0, block=block), reference, atol=1e-12)
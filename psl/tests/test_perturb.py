@@ -0,0 +1,159 @@
+import numpy as np
+from scipy import signal as sig
+
+import psl.perturb as perturb
+
+
+def reference_periodic(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0, form='sin'):
+    xmax = np.asarray([xmax]*nx).ravel() if type(xmax) is not np.ndarray else xmax.reshape(nx)
+    xmin = np.asarray([xmin]*nx).ravel() if type(xmin) is not np.ndarray else xmin.reshape(nx)
+    samples_period = nsim // numPeriods
+    leftover = nsim % numPeriods
+    Signal = []
+    extraPeriods = 0
+    if leftover > samples_period:
+        extraPeriods = leftover//samples_period
+        leftover = leftover % samples_period
+    for k in range(nx):
+        f = np.sin if form == 'sin' else np.cos
+        base = xmin[k] + (xmax[k] - xmin[k])*(0.5 + 0.5 * f(np.arange(0, 2 * np.pi, 2 * np.pi / samples_period)))
+        signal = np.tile(base, numPeriods+extraPeriods)
+        signal = np.append(signal, base[0:leftover])
+        Signal.append(signal)
+    return np.asarray(Signal).T
+
+
+def reference_sawtooth(nx=1, nsim=100, numPeriods=1, xmax=1, xmin=0):
+    xmax = np.asarray([xmax]*nx).ravel() if type(xmax) is not np.ndarray else xmax.reshape(nx)
+    xmin = np.asarray([xmin]*nx).ravel() if type(xmin) is not np.ndarray else xmin.reshape(nx)
+    t = np.linspace(0, 1, nsim)
+    return np.asarray([xmin[k] + (xmax[k] - xmin[k])*(0.5 * (sig.sawtooth(2 * np.pi * numPeriods * t) + 1))
+                       for k in range(nx)]).T
+
+
+def reference_step(nx=1, nsim=100, tstep=50, xmax=1, xmin=0):
+    xmax = np.asarray(nx*[xmax]).ravel() if type(xmax) is not np.ndarray else xmax
+    xmin = np.asarray(nx*[xmin]).ravel() if type(xmin) is not np.ndarray else xmin
+    Signal = []
+    for k in range(nx):
+        signal = np.ones(nsim)
+        signal[0:tstep] = xmin[k]
+        signal[tstep:] = xmax[k]
+        Signal.append(signal)
+    return np.asarray(Signal).T
+
+
+def reference_steps(nx=1, nsim=100, values=None, randsteps=5, xmax=1, xmin=0):
+    if values is None:
+        values = np.round(np.random.rand(randsteps), 3)
+    values = np.asarray([values]).ravel() if type(values) is not np.ndarray else values
+    xmax = np.asarray(nx*[xmax]).ravel() if type(xmax) is not np.ndarray else xmax
+    xmin = np.asarray(nx*[xmin]).ravel() if type(xmin) is not np.ndarray else xmin
+    step_length = int(np.ceil(nsim/len(values)))
+    signal = np.ones([nx, nsim])
+    for j in range(nx):
+        for k in range(len(values)):
+            signal[j, k*step_length:(k+1)*step_length] = values[k]*(xmax[j]-xmin[j])+xmin[j]
+    return signal.T
+
+
+def reference_white_noise(nx=1, nsim=100, xmax=1, xmin=0):
+    xmax = np.asarray(nx*[xmax]).ravel() if type(xmax) is not np.ndarray else xmax
+    xmin = np.asarray(nx*[xmin]).ravel() if type(xmin) is not np.ndarray else xmin
+    return np.asarray([xmin[k] + (xmax[k] - xmin[k])*np.random.rand(nsim) for k in range(nx)]).T
+
+
+def reference_random_walk(nx=1, nsim=100, xmax=1, xmin=0, sigma=0.05):
+    xmax = np.asarray(nx*[xmax]).ravel() if type(xmax) is not np.ndarray else xmax
+    xmin = np.asarray(nx*[xmin]).ravel() if type(xmin) is not np.ndarray else xmin
+    Signals = []
+    for k in range(nx):
+        Signal = [0]
+        for t in range(1, nsim):
+            yt = Signal[t - 1] + np.random.normal(0, sigma)
+            if (yt > 1):
+                yt = Signal[t - 1] - abs(np.random.normal(0, sigma))
+            elif (yt < 0):
+                yt = Signal[t - 1] + abs(np.random.normal(0, sigma))
+            Signal.append(yt)
+        Signals.append(xmin[k] + (xmax[k] - xmin[k])*np.asarray(Signal))
+    return np.asarray(Signals).T
+
+
+def test_periodic():
+    for nsim in [100, 101, 37, 500]:
+        for numPeriods in [1, 3, 7, 20]:
+            for form in ['sin', 'cos']:
+                for xmax, xmin in [(1, 0), (np.array([2.0, 5.0]), np.array([-1.0, 1.0]))]:
+                    expected = reference_periodic(2, nsim, numPeriods, xmax, xmin, form)
+                    out = perturb.Periodic(2, nsim, numPeriods, xmax, xmin, form)
+                    assert out.shape == expected.shape, (nsim, numPeriods)
+                    assert np.allclose(out, expected), (nsim, numPeriods, form)
+
+
+def test_periodic_per_signal():
+    out = perturb.Periodic(nx=2, nsim=90, numPeriods=[2, 5], xmax=[1, 3], xmin=[0, 1])
+    assert np.allclose(out[:, 0], reference_periodic(1, 90, 2)[:, 0])
+    assert np.allclose(out[:, 1], reference_periodic(1, 90, 5, 3, 1)[:, 0])
+
+
+def test_sawtooth():
+    for nsim, numPeriods in [(100, 1), (101, 4), (37, 9)]:
+        assert np.allclose(perturb.sawtooth(3, nsim, numPeriods, 2, -1), reference_sawtooth(3, nsim, numPeriods, 2, -1))
+
+
+def test_step():
+    for tstep in [0, 1, 50, 100]:
+        xmax, xmin = np.array([1.0, 2.0, 3.0]), np.array([0.0, -1.0, 0.5])
+        assert np.array_equal(perturb.Step(3, 100, tstep, xmax, xmin), reference_step(3, 100, tstep, xmax, xmin))
+
+
+def test_steps():
+    for nsim, values in [(100, [0.4, 0.8, 1, 0.7, 0.3, 0.0]), (101, [0.2, 0.5]), (7, 0.3)]:
+        expected = reference_steps(2, nsim, values, xmax=np.array([2.0, 1.0]), xmin=np.array([0.0, -1.0]))
+        assert np.allclose(perturb.Steps(2, nsim, values, xmax=np.array([2.0, 1.0]), xmin=np.array([0.0, -1.0])),
+                           expected)
+    np.random.seed(3)
+    expected = reference_steps(2, 100, randsteps=4)
+    np.random.seed(3)
+    assert np.allclose(perturb.Steps(2, 100, randsteps=4), expected)
+
+
+def test_white_noise():
+    for nx in [1, 3]:
+        np.random.seed(4)
+        expected = reference_white_noise(nx, 100, 3, 1)
+        np.random.seed(4)
+        assert np.array_equal(perturb.WhiteNoise(nx, 100, 3, 1), expected), nx
+    out = perturb.WhiteNoise(4, 1000, xmax=[1, 2, 3, 4], xmin=0, rng=0)
+    assert np.array_equal(out, perturb.WhiteNoise(4, 1000, xmax=[1, 2, 3, 4], xmin=0, rng=0))
+    assert np.all(out >= 0) and np.all(out <= [1, 2, 3, 4])
+
+
+def test_random_walk_legacy():
+    """
+    Without an rng the emulators keep their input trajectories, e.g. M_flow and DT of BuildingEnvelope.
+    """
+    np.random.seed(5)
+    expected = reference_random_walk(3, 2000, np.array([1.0, 2.0, 4.0]), np.array([0.0, 1.0, 0.0]), sigma=0.2)
+    np.random.seed(5)
+    out = perturb.RandomWalk(3, 2000, np.array([1.0, 2.0, 4.0]), np.array([0.0, 1.0, 0.0]), sigma=0.2)
+    assert np.array_equal(out, expected)
+
+
+def test_random_walk():
+    """
+    The walk is reflected at the bounds by folding instead of redrawing steps, away from the bounds
+    its increments are the gaussian steps, with the sign flipped after an odd number of reflections.
+    """
+    nsim, sigma = 5000, 0.05
+    out = perturb.RandomWalk(3, nsim, xmax=[1, 2, 4], xmin=[0, 1, 0], sigma=sigma, rng=0)
+    assert np.array_equal(out, perturb.RandomWalk(3, nsim, xmax=[1, 2, 4], xmin=[0, 1, 0], sigma=sigma, rng=0))
+    walk = (out - [0, 1, 0]) / [1, 1, 4]
+    assert np.allclose(walk[0], 0.0)
+    assert np.all(walk >= 0.0) and np.all(walk <= 1.0)
+    steps = np.random.default_rng(0).normal(0, sigma, size=(nsim, 3))[1:]
+    increments = np.diff(walk, axis=0)
+    assert np.all(np.abs(increments) <= np.abs(steps) + 1e-12)
+    inside = (walk[:-1] > 0.3) & (walk[:-1] < 0.7)
+    assert np.allclose(np.abs(increments[inside]), np.abs(steps[inside]))
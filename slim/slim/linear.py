@@ -21,13 +21,50 @@ torch.nn.init.sparse_(tensor, sparsity, std=0.01)
 """
 
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import math
+import threading
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from slim.butterfly import Butterfly
 
 
+class CacheScope(threading.local):
+    """
+    Nesting depth of slim.cached() and the maps holding cached weights, kept per thread so that a model
+    evaluated in a background thread never shares or releases the caches of the training thread.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.maps = []
+
+
+cache_scope = CacheScope()
+
+
+@contextmanager
+def cached():
+    """
+    Context in which linear maps compute their effective weight once and reuse it in every forward call,
+    e.g. over the steps of a rollout or an evaluation pass. A cached weight is recomputed when the parameters
+    it depends on change, and all cached weights are released when the outermost context exits, so the
+    autograd graph of a weight never outlives the pass it was built for.
+
+    with slim.cached():
+        Y = model(data)
+    """
+    cache_scope.depth += 1
+    try:
+        yield
+    finally:
+        cache_scope.depth -= 1
+        if cache_scope.depth == 0:
+            for linmap in cache_scope.maps:
+                linmap.__dict__['weight_cache'] = dict()
+            cache_scope.maps = []
+
+
 class LinearBase(nn.Module, ABC):
     """
     """
@@ -50,8 +87,31 @@ class LinearBase(nn.Module, ABC):
     def effective_W(self):
         pass
 
+    def cached_W(self, key='effective_W', weight=None):
+        """
+        Matrix computed by weight, reused inside slim.cached() until a parameter of the map is modified.
+
+        :param key: (str) Name of the cached matrix
+        :param weight: (callable) Computes the matrix, defaults to effective_W
+        :return: (torch.Tensor)
+        """
+        weight = self.effective_W if weight is None else weight
+        if cache_scope.depth == 0:
+            return weight()
+        try:
+            version = (torch.is_grad_enabled(),) + tuple((p._version, p.data_ptr()) for p in self.parameters())
+        except RuntimeError:
+            # parameters substituted by torch.func transforms, e.g. vmap over stacked ensemble members, have no storage
+            return weight()
+        cache = self.__dict__.setdefault('weight_cache', dict())
+        if key not in cache or cache[key][0] != version:
+            if not cache:
+                cache_scope.maps.append(self)
+            cache[key] = (version, weight())
+        return cache[key][1]
+
     def forward(self, x):
-        return torch.matmul(x, self.effective_W()) + self.bias
+        return torch.matmul(x, self.cached_W()) + self.bias
 
 
 class ButterflyLinear(LinearBase):
@@ -423,6 +483,46 @@ def Hprod(x, u, k):
         return x[:, -k:] - torch.matmul(alpha.view(-1, 1), u[-k:].view(1, -1))
 
 
+def householder_product(x, U, transpose=False):
+    """
+    Product of x with the Householder reflectors H_0 H_1 ... H_{m-1} applied by Hprod(x, U[i], dim - i) in a loop.
+    Reflector i is the i-th row of triu(U), so it acts on the last dim - i coordinates. The product is evaluated
+    in compact WY form Q = I - V^T S^-1 V with S = triu(V V^T, 1) + diag(V V^T) / 2, which needs a single
+    m X m triangular solve instead of m sequential rank one updates.
+
+    :param x: bs X dim
+    :param U: m X dim, m <= dim
+    :param transpose: (bool) Multiply with Q^T = H_{m-1} ... H_1 H_0, i.e. apply the reflectors in reverse order
+    :return: bs X dim
+    """
+    V = torch.triu(U)
+    G = torch.matmul(V, V.T)
+    S = torch.triu(G, 1) + torch.diag(torch.diagonal(G)) / 2
+    Z = torch.matmul(x, V.T)
+    if transpose:
+        Z = torch.linalg.solve_triangular(S.T, Z, upper=False, left=False)
+    else:
+        Z = torch.linalg.solve_triangular(S, Z, upper=True, left=False)
+    return x - torch.matmul(Z, V)
+
+
+def rotation_blocks(theta, gamma):
+    """
+    Block diagonal matrix of scaled 2 X 2 rotations gamma_k [[cos theta_k, -sin theta_k], [sin theta_k, cos theta_k]]
+    assembled from its three diagonals.
+
+    :param theta: (torch.Tensor, shape=[n]) Rotation angles
+    :param gamma: (torch.Tensor, shape=[n]) Scalings
+    :return: (torch.Tensor, shape=[2n, 2n])
+    """
+    c, s = gamma * torch.cos(theta), gamma * torch.sin(theta)
+    zeros = torch.zeros_like(s)
+    diagonal = torch.stack([c, c], dim=1).flatten()
+    upper = torch.stack([-s, zeros], dim=1).flatten()[:-1]
+    lower = torch.stack([s, zeros], dim=1).flatten()[:-1]
+    return torch.diag(diagonal) + torch.diag(upper, 1) + torch.diag(lower, -1)
+
+
 class OrthogonalLinear(SquareLinear):
 
     def __init__(self, insize, outsize, bias=False, **kwargs):
@@ -432,15 +532,24 @@ class OrthogonalLinear(SquareLinear):
     def effective_W(self):
         return self.forward(torch.eye(self.in_features).to(self.U.device))
 
+    def reflect(self, x):
+        """
+
+        :param x: BS X dim
+        :return: BS X dim product of x with the Householder reflectors
+        """
+        return householder_product(x, self.U)
+
     def forward(self, x):
         """
 
         :param x: BS X dim
         :return: BS X dim
         """
-        for i in range(0, self.in_features):
-            x = Hprod(x, self.U[i], self.in_features - i)
-        return x + self.bias
+        if cache_scope.depth > 0:
+            eye = torch.eye(self.in_features).to(self.U.device)
+            return torch.matmul(x, self.cached_W('reflect', lambda: self.reflect(eye))) + self.bias
+        return self.reflect(x) + self.bias
 
 
 class SchurDecompositionLinear(SquareLinear):
@@ -453,21 +562,16 @@ class SchurDecompositionLinear(SquareLinear):
         self.P = OrthogonalLinear(insize, insize)
         self.theta = nn.Parameter(2*math.pi*torch.rand([insize//2]))
         self.gamma = nn.Parameter(torch.ones([insize//2]))
-        self.T = self.build_T(torch.zeros(insize, insize))
         self.l2 = l2
 
-    def build_T(self, T):
-        for k, (theta, gamma) in enumerate(zip(self.theta, self.gamma)):
-            rk = gamma * torch.tensor([[torch.cos(theta), -torch.sin(theta)],
-                                       [torch.sin(theta), torch.cos(theta)]])
-            T[2*k:2*k+2, 2*k:2*k+2] = rk
-        return T
+    def build_T(self):
+        return rotation_blocks(self.theta, self.gamma)
 
     def reg_error(self):
-        return self.l2*F.mse_loss(torch.ones(self.insize/2), self.gamma)
+        return self.l2*F.mse_loss(torch.ones_like(self.gamma), self.gamma)
 
     def effective_W(self):
-        return self.P(self.T) @ self.P.effective_W().T
+        return self.P(self.build_T()) @ self.P.effective_W().T
 
 
 class SpectralLinear(LinearBase):
@@ -516,9 +620,7 @@ class SpectralLinear(LinearBase):
         :return: BS X dim
         """
         assert x.shape[1] == self.in_features, f'x.shape: {x.shape}, in_features: {self.in_features}'
-        for i in range(0, self.n_U_reflectors):
-            x = Hprod(x, self.U[i], self.in_features - i)
-        return x
+        return householder_product(x, self.U[:self.n_U_reflectors])
 
     def Vmultiply(self, x):
         """
@@ -526,13 +628,20 @@ class SpectralLinear(LinearBase):
         :return:
         """
         assert x.shape[1] == self.out_features
-        for i in range(self.n_V_reflectors - 1, -1, -1):
-            x = Hprod(x, self.V[i], self.out_features - i)
-        return x
+        return householder_product(x, self.V[:self.n_V_reflectors], transpose=True)
 
     def effective_W(self):
         return self.forward(torch.eye(self.in_features).to(self.p.device))
 
+    def multiply(self, x):
+        """
+        :param x: bs X in_features
+        :return: bs X out_features product of x with U Sigma V
+        """
+        x = self.Umultiply(x)
+        x = torch.matmul(x, self.Sigma())
+        return self.Vmultiply(x)
+
     def forward(self, x):
         """
         args: a list of 2D, batch x n, Tensors.
@@ -540,10 +649,10 @@ class SpectralLinear(LinearBase):
         :param args:
         :return:
         """
-        x = self.Umultiply(x)
-        x = torch.matmul(x, self.Sigma())
-        x = self.Vmultiply(x)
-        return x + self.bias
+        if cache_scope.depth > 0:
+            eye = torch.eye(self.in_features).to(self.p.device)
+            return torch.matmul(x, self.cached_W('multiply', lambda: self.multiply(eye))) + self.bias
+        return self.multiply(x) + self.bias
 
 
 class SymplecticLinear(SquareLinear):
@@ -0,0 +1,56 @@
+import torch
+import slim
+from slim.linear import Hprod, householder_product, rotation_blocks
+
+
+def reflector_loop(x, U):
+    for i in range(U.shape[0]):
+        x = Hprod(x, U[i], x.shape[1] - i)
+    return x
+
+
+def reversed_reflector_loop(x, U):
+    for i in range(U.shape[0] - 1, -1, -1):
+        x = Hprod(x, U[i], x.shape[1] - i)
+    return x
+
+
+def test_householder_product():
+    torch.manual_seed(0)
+    x = torch.randn(16, 9, dtype=torch.float64)
+    for m in [9, 5, 1]:
+        U = torch.randn(m, 9, dtype=torch.float64, requires_grad=True)
+        for transpose, loop in [(False, reflector_loop), (True, reversed_reflector_loop)]:
+            out = householder_product(x, U, transpose=transpose)
+            expected = loop(x, U)
+            assert torch.allclose(out, expected, atol=1e-12), (m, transpose)
+            grad, = torch.autograd.grad(out.sum(), U)
+            expected_grad, = torch.autograd.grad(expected.sum(), U)
+            assert torch.allclose(grad, expected_grad, atol=1e-10), (m, transpose)
+
+
+def test_orthogonal_and_spectral():
+    torch.manual_seed(0)
+    x = torch.randn(16, 8)
+    orthogonal = slim.linear.OrthogonalLinear(8, 8)
+    assert torch.allclose(orthogonal.reflect(x), reflector_loop(x, orthogonal.U), atol=1e-5)
+    W = orthogonal.effective_W()
+    assert torch.allclose(W @ W.T, torch.eye(8), atol=1e-5)
+    spectral = slim.linear.SpectralLinear(8, 8, n_U_reflectors=5, n_V_reflectors=3)
+    assert torch.allclose(spectral.Umultiply(x), reflector_loop(x, spectral.U[:5]), atol=1e-5)
+    assert torch.allclose(spectral.Vmultiply(x), reversed_reflector_loop(x, spectral.V[:3]), atol=1e-5)
+
+
+def test_schur_rotation_blocks():
+    theta, gamma = torch.rand(4), torch.rand(4) + 0.5
+    T = torch.zeros(8, 8)
+    for k in range(4):
+        T[2*k:2*k+2, 2*k:2*k+2] = gamma[k] * torch.tensor([[torch.cos(theta[k]), -torch.sin(theta[k])],
+                                                           [torch.sin(theta[k]), torch.cos(theta[k])]])
+    assert torch.allclose(rotation_blocks(theta, gamma), T, atol=1e-6)
+    schur = slim.linear.SchurDecompositionLinear(8, 8)
+    x = torch.randn(4, 8)
+    for _ in range(2):
+        # the rotations are rebuilt from theta and gamma, so repeated backward passes reach them
+        schur(x).sum().backward()
+    assert schur.theta.grad is not None and schur.gamma.grad is not None